@@ -1,4 +1,5 @@
 from celery import Celery
+from celery.signals import worker_ready
 from django.conf import settings
 
 app = Celery('mums')
@@ -7,3 +8,11 @@ app = Celery('mums')
 # pickle the object when using Windows.
 app.config_from_object('django.conf:settings')
 app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
+
+
+@worker_ready.connect
+def warm_start(**kwargs):
+    """ Rebuild the reservations if they have been lost, see mums.wsgi """
+    from products import stock
+
+    stock.warm_start()
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/1.10/ref/settings/
 """
 import os
+from datetime import timedelta
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -53,6 +54,8 @@ LOCAL_APPS = [
 INSTALLED_APPS = DJANGO_APPS + THIRD_PARTY_APPS + LOCAL_APPS
 
 MIDDLEWARE = [
+    'products.metrics.MetricsMiddleware',
+    'products.tracing.TracingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -100,16 +103,17 @@ DATABASES = {
     }
 }
 
-# Redis
+# Redis, the cache (along with the orders pending) and the celery broker can
+# each have a node of their own, all of them share the same one by default
 REDIS_HOST = os.environ.get('REDIS_HOST', 'redis')
 REDIS_PORT = os.environ.get('REDIS_PORT', '6379')
 REDIS_DB = 0
+REDIS_URL = 'redis://{}:{}/{}'.format(REDIS_HOST, REDIS_PORT, REDIS_DB)
 
 CACHES = {
     'default': {
         'BACKEND': 'django_redis.cache.RedisCache',
-        'LOCATION': 'redis://{}:{}/{}'.format(REDIS_HOST, REDIS_PORT,
-                                              REDIS_DB),
+        'LOCATION': os.environ.get('CACHE_REDIS_URL', REDIS_URL),
         'OPTIONS': {
             'CLIENT_CLASS': 'django_redis.client.DefaultClient'
         }
@@ -117,11 +121,33 @@ CACHES = {
 }
 
 # Celery
-BROKER_URL = 'redis://{}:{}/{}'.format(REDIS_HOST, REDIS_PORT, REDIS_DB)
+BROKER_URL = os.environ.get('BROKER_URL', REDIS_URL)
 CELERY_ALWAYS_EAGER = False
 CELERY_IGNORE_RESULT = True
 CELERY_TASK_SERIALIZER = "json"
 CELERY_ACCEPT_CONTENT = ['application/json']
+CELERYBEAT_SCHEDULE = {
+    'release-expired-orders': {
+        'task': 'products.tasks.release_expired_orders',
+        'schedule': timedelta(seconds=1),
+        'options': {'expires': 1},
+    },
+    'flush-stock': {
+        'task': 'products.tasks.flush_stock',
+        'schedule': timedelta(seconds=5),
+        'options': {'expires': 5},
+    },
+    'compact-ledger': {
+        'task': 'products.tasks.compact_ledger',
+        'schedule': timedelta(minutes=1),
+        'options': {'expires': 60},
+    },
+    'roll-up-sales': {
+        'task': 'products.tasks.roll_up_sales',
+        'schedule': timedelta(minutes=1),
+        'options': {'expires': 60},
+    },
+}
 
 # Password validation
 # https://docs.djangoproject.com/en/1.10/ref/settings/#auth-password-validators
@@ -158,6 +184,58 @@ USE_TZ = True
 TASTYPIE_DEFAULT_FORMATS = ['json']
 
 ORDER_TIMEOUT = 10  # Timeout for processing an order, in seconds
+ORDER_SWEEP_BATCH = 500  # Expired orders released at once
+ORDER_BATCH_SIZE = 100  # Orders created at most by each batch request
+
+# Where the stock reserved by pending orders is kept, see products.reservations
+RESERVATION_BACKEND = os.environ.get('RESERVATION_BACKEND',
+                                     'products.reservations.RedisBackend')
+
+# Rebuild the reservations out of the orders on the start of every process if
+# the backend has lost them
+RESERVATION_WARM_START = True
+
+# Redis nodes the RedisRingBackend spreads the reservations over, comma
+# separated urls in the environment
+RESERVATION_REDIS_NODES = [
+    url for url in os.environ.get('RESERVATION_REDIS_NODES', '').split(',')
+    if url
+]
+
+# Leave the stock sold to be decremented by a periodic flush instead of by
+# each payment, see products.stock
+STOCK_WRITE_BEHIND = False
+STOCK_FLUSH_BATCH = 1000  # Orders flushed at once
+
+# Record the stock movements, to audit the stock and roll up the sales, and
+# the age of the ones folded into snapshots, see products.ledger
+STOCK_LEDGER = True
+STOCK_LEDGER_LAG = 60
+
+# Sale movements rolled up at once, see products.rollups
+SALES_ROLLUP_BATCH = 10000
+
+CATALOG_CACHE_TIMEOUT = 60 * 60  # Lifetime of the cached catalog responses
+
+# Results of the benchmark command to compare with, and slowdown allowed
+BENCHMARK_BASELINE = os.path.join(SITE_ROOT, 'products', 'benchmarks.json')
+BENCHMARK_THRESHOLD = 0.5
+
+# Networks allowed to read the metrics, along with the staff, comma separated
+# in the environment. Behind a proxy every request comes from the address of
+# the proxy, so it must not be allowed and /metrics/ blocked at the proxy
+METRICS_ALLOWED_NETWORKS = os.environ.get(
+    'METRICS_ALLOWED_NETWORKS', '127.0.0.0/8,::1/128'
+).split(',')
+
+# Tracing of the requests and tasks, recording a share of the traces to a file
+TRACING_ENABLED = False
+TRACING_SAMPLE_RATE = 0.01
+# Record every request whose traceparent header asks for it, whatever the
+# TRACING_SAMPLE_RATE. Only for clients that can be trusted, e.g. all of them
+# coming through a gateway that samples them
+TRACING_TRUST_TRACEPARENT = False
+TRACING_FILE = os.path.join(SITE_ROOT, 'traces.jsonl')
 
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/1.10/howto/static-files/
@@ -26,5 +26,7 @@ CACHES = {
     }
 }
 
+RESERVATION_BACKEND = 'products.reservations.LocalBackend'
+
 CELERY_ALWAYS_EAGER = True
 BROKER_BACKEND = 'memory'
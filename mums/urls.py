@@ -5,19 +5,22 @@ from django.contrib import admin
 from tastypie.api import Api
 
 from products.api.resources_v1 import OrderResource, ProductResource, \
-    OrderProductResource
-from products.views import index, new_order
-from products.utils import debug
+    OrderProductResource, HourlySalesResource, DailySalesResource
+from products.views import index, metrics_view, new_order
+from products.utils import debug, profile
 
 
 v1_api = Api(api_name='v1')
 v1_api.register(OrderResource())
 v1_api.register(ProductResource())
 v1_api.register(OrderProductResource())
+v1_api.register(HourlySalesResource())
+v1_api.register(DailySalesResource())
 
 urlpatterns = [
     url(r'^$', index, name='index'),
     url(r'^new_order/$', new_order, name='new_order'),
+    url(r'^metrics/$', metrics_view, name='metrics'),
     url(r'^api/', include(v1_api.urls)),
     url(r'^admin/', admin.site.urls),
 ]
@@ -26,4 +29,5 @@ if settings.DEBUG:
     urlpatterns += [
         url(r'^__debug__/', include(debug_toolbar.urls)),
         url(r'^debug/', debug),
+        url(r'^profile/', profile),
     ]
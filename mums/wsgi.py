@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "mums.settings")
 
 application = get_wsgi_application()
+
+# Rebuild the reservations out of the orders if they have been lost, e.g. by
+# a restart of redis, before taking any order
+from products import stock  # NOQA
+stock.warm_start()
@@ -0,0 +1,151 @@
+import base64
+import binascii
+import json
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from django.utils.http import urlencode
+from tastypie.exceptions import BadRequest
+from tastypie.paginator import Paginator
+
+
+class CursorPaginator(Paginator):
+    """
+    Keyset (cursor) pagination, opt-in by passing a ``cursor`` parameter (empty
+    for the first page).
+
+    Instead of an offset, each page is located by the ``cursor_fields`` values
+    of the last (or first) object of the previous one, so every page costs the
+    same no matter how deep it is. The total count is not computed either.
+    The ``next`` and ``previous`` links hold opaque cursors.
+
+    Requests without a ``cursor`` keep the default offset pagination.
+    """
+
+    cursor_fields = ('id', )
+
+    def page(self):
+        if 'cursor' not in self.request_data:
+            return super(CursorPaginator, self).page()
+
+        limit = self.get_limit()
+        direction, key = self.decode_cursor(self.request_data['cursor'])
+
+        objects = self.objects
+        if key is not None:
+            objects = objects.filter(self.get_key_filter(direction, key))
+
+        ordering = self.cursor_fields
+        if direction == 'previous':
+            ordering = ['-{}'.format(field) for field in ordering]
+        objects = objects.order_by(*ordering)
+
+        if limit:
+            objects = list(objects[:limit + 1])
+            more = len(objects) > limit
+            objects = objects[:limit]
+        else:
+            objects = list(objects)
+            more = False
+
+        if direction == 'previous':
+            objects.reverse()
+
+        # Coming from a cursor there are objects on the other side of it
+        if direction == 'next':
+            has_next, has_previous = more, key is not None
+        else:
+            has_next, has_previous = True, more
+
+        first_key = self.get_key(objects[0]) if objects else key
+        last_key = self.get_key(objects[-1]) if objects else key
+
+        meta = {
+            'limit': limit,
+            'next': None,
+            'previous': None,
+        }
+        if has_next and last_key is not None:
+            meta['next'] = self._generate_cursor_uri('next', last_key)
+        if has_previous and first_key is not None:
+            meta['previous'] = self._generate_cursor_uri('previous', first_key)
+
+        return {
+            self.collection_name: objects,
+            'meta': meta,
+        }
+
+    def get_key(self, obj):
+        """ Get the values of the cursor fields of the object """
+        return [getattr(obj, field) for field in self.cursor_fields]
+
+    def get_key_filter(self, direction, key):
+        """
+        Build the filter selecting the objects after (or before) the key, that
+        is (a, b) > (x, y) expanded as a > x OR (a = x AND b > y)
+        """
+        lookup = 'gt' if direction == 'next' else 'lt'
+
+        key_filter = Q()
+        for i, field in enumerate(self.cursor_fields):
+            condition = Q(**{'{}__{}'.format(field, lookup): key[i]})
+            for previous_field, value in zip(self.cursor_fields[:i], key):
+                condition &= Q(**{previous_field: value})
+            key_filter |= condition
+
+        return key_filter
+
+    def encode_cursor(self, direction, key):
+        """ Build an opaque cursor from the direction and the key values """
+        values = [
+            value.isoformat() if hasattr(value, 'isoformat') else value
+            for value in key
+        ]
+        cursor = json.dumps([direction, values]).encode('utf-8')
+
+        return base64.urlsafe_b64encode(cursor).decode('ascii')
+
+    def decode_cursor(self, cursor):
+        """
+        Get the direction and the key values out of a cursor. An empty cursor
+        stands for the first page
+        """
+        if not cursor:
+            return 'next', None
+
+        try:
+            cursor_json = base64.urlsafe_b64decode(cursor.encode('ascii'))
+            direction, values = json.loads(cursor_json.decode('utf-8'))
+            if direction not in ('next', 'previous') or \
+                    len(values) != len(self.cursor_fields):
+                raise ValueError()
+
+            model = self.objects.model
+            key = [
+                model._meta.get_field(field).to_python(value)
+                for field, value in zip(self.cursor_fields, values)
+            ]
+        except (ValueError, TypeError, binascii.Error, ValidationError):
+            raise BadRequest("Invalid cursor '%s' provided." % cursor)
+
+        return direction, key
+
+    def _generate_cursor_uri(self, direction, key):
+        if self.resource_uri is None:
+            return None
+
+        request_params = self.request_data.copy()
+        request_params.pop('offset', None)
+        request_params['cursor'] = self.encode_cursor(direction, key)
+
+        if hasattr(request_params, 'urlencode'):
+            encoded_params = request_params.urlencode()
+        else:
+            encoded_params = urlencode(request_params)
+
+        return '%s?%s' % (self.resource_uri, encoded_params)
+
+
+class OrderCursorPaginator(CursorPaginator):
+    """ Pages through the orders by creation date """
+
+    cursor_fields = ('created', 'id')
@@ -1,32 +1,328 @@
+import hashlib
 import json
+import operator
+from functools import reduce
 from django.conf import settings
-from django.shortcuts import get_object_or_404
+from django.conf.urls import url
+from django.core.cache import cache
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import connection, transaction
+from django.db.models import Case, F, IntegerField, Q, When
+from django.http import Http404
 from tastypie import fields
 from tastypie.authentication import Authentication
 from tastypie.authorization import Authorization
+from tastypie.constants import ALL
 from tastypie.exceptions import ImmediateHttpResponse
-from tastypie.http import HttpBadRequest
+from tastypie.http import HttpBadRequest, HttpNotFound, HttpNotModified
 from tastypie.resources import ModelResource
+from tastypie.utils import trailing_slash
 from tastypie.validation import Validation
 
-from products.models import Product, Order, OrderProduct
-from products.tasks import check_order
+from products import catalog, expiry, ledger, reservations, stock, tracing
+from products.api.paginators import CursorPaginator, OrderCursorPaginator
+from products.models import Product, Order, OrderProduct, StockMovement, \
+    HourlySales, DailySales
 
 
-class ProductResource(ModelResource):
+class FlatDehydrateMixin(object):
+    """
+    Fast read path for the resources. The data of each object is copied
+    straight from the model attributes behind its plain fields instead of
+    going through tastypie's per field dehydration, giving the very same
+    output. Related fields and ``dehydrate_<field>`` hooks are not handled,
+    resources needing them must fill them in their own ``full_dehydrate``
+    """
+
+    _flat_fields = None
+    _flat_uri_prefix = None
+
+    def full_dehydrate(self, bundle, for_list=False):
+        """ Build the data of the object from its attributes """
+        obj = bundle.obj
+
+        for field_name, attribute in self.get_flat_fields():
+            bundle.data[field_name] = getattr(obj, attribute)
+        bundle.data['resource_uri'] = self.get_flat_resource_uri(obj)
+
+        return self.dehydrate(bundle)
+
+    def get_flat_fields(self):
+        """ Get the (field name, attribute) of the plain fields, just once """
+        if self._flat_fields is None:
+            self._flat_fields = [
+                (field_name, field_object.attribute)
+                for field_name, field_object in self.fields.items()
+                if field_object.attribute and not field_object.is_related
+            ]
+
+        return self._flat_fields
+
+    def get_flat_resource_uri(self, obj):
+        """
+        Get the detail uri of the object without reversing the url of every
+        single one of them
+        """
+        if self._flat_uri_prefix is None:
+            self._flat_uri_prefix = self.get_resource_uri()
+
+        return '{}{}/'.format(self._flat_uri_prefix, obj.pk)
+
+
+class ProductResource(FlatDehydrateMixin, ModelResource):
 
     class Meta(object):
         queryset = Product.objects.all()
         resource_name = 'product'
         allowed_methods = ['get', ]
 
+    def get_list(self, request, **kwargs):
+        """
+        Returns the list of products, cached under the catalog version so the
+        database is only queried after the catalog has changed
+        """
+        version = catalog.get_version()
+        data = self.get_catalog_data(request, version, self.build_list_data,
+                                     **kwargs)
+        objects = data[self._meta.collection_name]
+        self._add_real_stock(objects)
+
+        return self.create_catalog_response(request, version, data, objects)
+
+    def get_detail(self, request, **kwargs):
+        """
+        Returns a single product, cached under the catalog version
+        """
+        version = catalog.get_version()
+        data = self.get_catalog_data(request, version, self.build_detail_data,
+                                     **kwargs)
+        if data is None:
+            return HttpNotFound()
+        self._add_real_stock([data])
 
-class OrderProductResource(ModelResource):
+        return self.create_catalog_response(request, version, data, [data])
+
+    def build_list_data(self, request, **kwargs):
+        """ Same as tastypie's ``get_list``, stopping before serializing """
+        base_bundle = self.build_bundle(request=request)
+        objects = self.obj_get_list(
+            bundle=base_bundle, **self.remove_api_resource_names(kwargs)
+        )
+        sorted_objects = self.apply_sorting(objects, options=request.GET)
+
+        paginator = self._meta.paginator_class(
+            request.GET, sorted_objects,
+            resource_uri=self.get_resource_uri(), limit=self._meta.limit,
+            max_limit=self._meta.max_limit,
+            collection_name=self._meta.collection_name
+        )
+        data = paginator.page()
+
+        data[self._meta.collection_name] = [
+            self.full_dehydrate(
+                self.build_bundle(obj=obj, request=request), for_list=True
+            ).data
+            for obj in data[self._meta.collection_name]
+        ]
+
+        return data
+
+    def build_detail_data(self, request, **kwargs):
+        """ Same as tastypie's ``get_detail``, stopping before serializing """
+        basic_bundle = self.build_bundle(request=request)
+
+        try:
+            obj = self.cached_obj_get(
+                bundle=basic_bundle, **self.remove_api_resource_names(kwargs)
+            )
+        except ObjectDoesNotExist:
+            return None
+
+        return self.full_dehydrate(
+            self.build_bundle(obj=obj, request=request)
+        ).data
+
+    def get_catalog_data(self, request, version, build, **kwargs):
+        """
+        Get the data for the request from the cache, building and caching it
+        if it is not there for the given catalog version
+        """
+        key = 'catalog_response_{}_{}'.format(
+            version,
+            hashlib.md5(request.get_full_path().encode('utf-8')).hexdigest()
+        )
+
+        data = cache.get(key)
+        if data is None:
+            data = build(request, **kwargs)
+            if data is not None:
+                cache.set(key, data, settings.CATALOG_CACHE_TIMEOUT)
+
+        return data
+
+    def create_catalog_response(self, request, version, data, objects):
+        """
+        Serialize the data tagging it with an ETag, or just reply it has not
+        been modified when the client already has it. Other than the catalog
+        version, only the real stock of the products may change the data
+        """
+        etag = '"{}"'.format(hashlib.md5(json.dumps([
+            version,
+            request.get_full_path(),
+            [obj['real_stock'] for obj in objects],
+        ]).encode('utf-8')).hexdigest())
+
+        if etag in request.META.get('HTTP_IF_NONE_MATCH', ''):
+            response = HttpNotModified()
+        else:
+            response = self.create_response(request, data)
+
+        response['ETag'] = etag
+        return response
+
+    def _add_real_stock(self, objects):
+        """
+        Set the real stock (stock minus the reserved items) of each product,
+        reading the reservations of all of them in a single call
+        """
+        reserved = reservations.get_reserved([obj['id'] for obj in objects])
+
+        for obj in objects:
+            obj['real_stock'] = obj['stock'] - reserved[obj['id']]
+
+
+class OrderProductResource(FlatDehydrateMixin, ModelResource):
 
     class Meta(object):
         queryset = OrderProduct.objects.all()
         resource_name = 'order_product'
         allowed_methods = ['get', ]
+        paginator_class = CursorPaginator
+
+
+class SalesResource(FlatDehydrateMixin, ModelResource):
+    """
+    Read only sales rollups, see the rollups module. The period, product and
+    category filters are meant to be used to read just the rows needed
+    """
+
+    product = fields.IntegerField(attribute='product_id', readonly=True)
+
+    class Meta(object):
+        allowed_methods = ['get', ]
+        paginator_class = CursorPaginator
+        filtering = {
+            'period': ALL,
+            'product': ['exact', 'in'],
+            'category': ['exact', 'in'],
+        }
+        ordering = ['period', 'quantity', 'revenue']
+
+
+class HourlySalesResource(SalesResource):
+
+    class Meta(SalesResource.Meta):
+        queryset = HourlySales.objects.all()
+        resource_name = 'hourly_sales'
+
+
+class DailySalesResource(SalesResource):
+
+    class Meta(SalesResource.Meta):
+        queryset = DailySales.objects.all()
+        resource_name = 'daily_sales'
+
+
+def get_cart_lines(carts):
+    """
+    Get the (product, quantity) lines of each one of the carts, given as lists
+    of product/quantity rows, loading the products of all of them with a
+    single query
+    """
+    products = {
+        str(product_id): product
+        for product_id, product in Product.objects.in_bulk(
+            [row.get('product') for rows in carts for row in rows]
+        ).items()
+    }
+
+    cart_lines = []
+    for rows in carts:
+        lines = []
+        for row in rows:
+            product = products.get(str(row.get('product')))
+            if product is None:
+                raise Http404('No Product matches the given query.')
+
+            lines.append((product, int(row.get('quantity'))))
+        cart_lines.append(lines)
+
+    return cart_lines
+
+
+def get_order_lines(bundle):
+    """
+    Get the (product, quantity) lines of the order being created, loading all
+    of its products with a single query. They are kept in the bundle so the
+    validation and the creation of the order share them
+    """
+    if not hasattr(bundle, 'order_lines'):
+        bundle.order_lines = get_cart_lines([bundle.data.get('products')])[0]
+
+    return bundle.order_lines
+
+
+def get_batch_lines(orders):
+    """
+    Get the (product, quantity) lines of each one of the orders of a batch,
+    loading the products of all of them with a single query. Returns the
+    lines, or None, and the errors of each order
+    """
+    rows = []
+    errors = []
+
+    for order in orders:
+        order_rows = []
+        order_errors = {}
+
+        products = order.get('products') if isinstance(order, dict) else None
+        if not products or not isinstance(products, list):
+            order_errors['products'] = 'No products provided'
+        else:
+            for row in products:
+                try:
+                    product_id = int(row.get('product'))
+                    quantity = int(row.get('quantity'))
+                except (AttributeError, TypeError, ValueError):
+                    order_errors['products'] = 'Invalid product or quantity'
+                    break
+                if quantity < 0:
+                    order_errors['quantity'] = 'Invalid quantity'
+                    break
+                order_rows.append((product_id, quantity))
+
+        rows.append(None if order_errors else order_rows)
+        errors.append(order_errors)
+
+    products = Product.objects.in_bulk(
+        [product_id for order_rows in rows if order_rows
+         for product_id, _ in order_rows]
+    )
+
+    lines = []
+    for order_rows, order_errors in zip(rows, errors):
+        if order_rows is not None and any(
+            product_id not in products for product_id, _ in order_rows
+        ):
+            order_errors['product'] = 'No Product matches the given query.'
+            order_rows = None
+
+        lines.append(order_rows and [
+            (products[product_id], quantity)
+            for product_id, quantity in order_rows
+        ])
+
+    return lines, errors
 
 
 class OrderValidation(Validation):
@@ -43,21 +339,28 @@ class OrderValidation(Validation):
         if not bundle.data.get('products'):
             errors['products'] = 'No products provided'
         else:
-            for product_row in bundle.data.get('products'):
-                product = get_object_or_404(
-                    Product, pk=product_row.get('product')
-                )
-                if not product.enough_stock(int(product_row.get('quantity'))):
+            lines = get_order_lines(bundle)
+            reserved = reservations.get_reserved(
+                [product.id for product, _ in lines]
+            )
+
+            for product, quantity in lines:
+                if product.stock - reserved[product.id] < quantity:
                     errors['quantity'] = 'Not enough stock'
 
         return errors
 
 
-class OrderResource(ModelResource):
+class OrderResource(FlatDehydrateMixin, ModelResource):
 
     products = fields.ToManyField(OrderProductResource, 'orderproduct_set',
                                   full=True)
 
+    # Computed when the order is created, never taken from the client
+    total = fields.FloatField(attribute='total', readonly=True, null=True)
+    line_count = fields.IntegerField(attribute='line_count', readonly=True)
+    discounts = fields.CharField(attribute='discounts', readonly=True)
+
     class Meta(object):
         queryset = Order.objects.all().prefetch_related('orderproduct_set')
         resource_name = 'order'
@@ -66,57 +369,320 @@ class OrderResource(ModelResource):
         authorization = Authorization()
         authentication = Authentication()
         allowed_methods = ['get', 'post', 'patch', ]
+        excludes = ['stock_pending']
+        paginator_class = OrderCursorPaginator
+        filtering = {
+            'complete': ALL,
+            'created': ALL,
+            'total': ALL,
+            'line_count': ALL,
+            'discounts': ALL,
+        }
+        ordering = ['created', 'total', 'line_count']
+
+    _order_product_resource = None
+
+    def prepend_urls(self):
+        return [
+            url(r'^(?P<resource_name>{})/quote{}$'.format(
+                self._meta.resource_name, trailing_slash()
+            ), self.wrap_view('quote'), name='api_order_quote'),
+            url(r'^(?P<resource_name>{})/batch{}$'.format(
+                self._meta.resource_name, trailing_slash()
+            ), self.wrap_view('batch'), name='api_order_batch'),
+        ]
+
+    def quote(self, request, **kwargs):
+        """
+        Prices a cart ({"products": [...]}) or many of them at once
+        ({"carts": [{"products": [...]}, ...]}) just like an order with the
+        same products would be priced. Nothing is created nor reserved, it is
+        a POST only to be able to send the carts in the body
+        """
+        self.method_check(request, allowed=['post'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+
+        data = self.deserialize(
+            request, request.body,
+            format=request.META.get('CONTENT_TYPE', 'application/json')
+        )
+
+        try:
+            if 'carts' in data:
+                carts = [cart['products'] for cart in data['carts']]
+            else:
+                carts = [data['products']]
+
+            if not carts or not all(carts):
+                raise ValueError('No products provided')
+
+            carts = get_cart_lines(carts)
+        except (AttributeError, KeyError, TypeError, ValueError):
+            raise ImmediateHttpResponse(HttpBadRequest())
+
+        if any(quantity < 0 for lines in carts for _, quantity in lines):
+            raise ImmediateHttpResponse(HttpBadRequest())
+
+        quotes = [
+            {
+                'total': quote.total,
+                'lines': quote.lines,
+                'discounts': quote.discounts,
+            }
+            for quote in Order.pricing_engine.quote_many(carts)
+        ]
+
+        self.log_throttled_access(request)
+
+        return self.create_response(
+            request, {'quotes': quotes} if 'carts' in data else quotes[0]
+        )
+
+    def full_dehydrate(self, bundle, for_list=False):
+        """ Build the data of the order along with its (prefetched) lines """
+        bundle = super(OrderResource, self).full_dehydrate(bundle, for_list)
+
+        if self._order_product_resource is None:
+            self._order_product_resource = OrderProductResource(
+                api_name=self._meta.api_name
+            )
+
+        bundle.data['products'] = [
+            self._order_product_resource.full_dehydrate(
+                self._order_product_resource.build_bundle(
+                    obj=order_product, request=bundle.request
+                ),
+                for_list=for_list
+            ).data
+            for order_product in bundle.obj.orderproduct_set.all()
+        ]
+
+        return bundle
+
+    def batch(self, request, **kwargs):
+        """
+        Creates many orders at once ({"orders": [{"products": [...]}, ...]}).
+        The products are loaded, the stock reserved, the orders inserted and
+        their expiry scheduled once for the whole batch, but each order is
+        created or rejected on its own. The result of each one is replied in
+        the same position it was sent
+        """
+        self.method_check(request, allowed=['post'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+
+        data = self.deserialize(
+            request, request.body,
+            format=request.META.get('CONTENT_TYPE', 'application/json')
+        )
+
+        orders = data.get('orders') if isinstance(data, dict) else None
+        if not orders or not isinstance(orders, list) or \
+                len(orders) > settings.ORDER_BATCH_SIZE:
+            raise ImmediateHttpResponse(HttpBadRequest())
+
+        lines, errors = get_batch_lines(orders)
+
+        # Orders later in the batch only get the stock left by the previous
+        # ones
+        pending = [i for i, order_lines in enumerate(lines) if order_lines]
+        reserved = reservations.reserve_many([lines[i] for i in pending])
+        for i, fits in zip(pending, reserved):
+            if not fits:
+                errors[i]['quantity'] = 'Not enough stock'
+                lines[i] = None
+
+        created = self.create_orders(
+            request, [i for i in pending if lines[i]], lines
+        )
+
+        self.log_throttled_access(request)
+
+        return self.create_response(request, {'orders': [
+            {'created': True, 'order': created[i]} if i in created else
+            {'created': False, 'errors': order_errors}
+            for i, order_errors in enumerate(errors)
+        ]})
+
+    def create_orders(self, request, indexes, lines):
+        """
+        Creates the orders with the given (already reserved) lines in a single
+        transaction, scheduling the expiry of all of them at once. Returns the
+        data of each order by its index
+        """
+        if not indexes:
+            return {}
+
+        orders = [Order() for _ in indexes]
+        quotes = Order.pricing_engine.quote_many([lines[i] for i in indexes])
+        for order, quote in zip(orders, quotes):
+            order.set_quote(quote)
+
+        try:
+            with transaction.atomic(), \
+                    tracing.span('order.batch_create', orders=len(orders)):
+                if connection.features.can_return_ids_from_bulk_insert:
+                    Order.objects.bulk_create(orders)
+                else:
+                    for order in orders:
+                        order.save()
+
+                order_products = OrderProduct.objects.bulk_create([
+                    OrderProduct(order=order, product=product,
+                                 quantity=quantity)
+                    for order, i in zip(orders, indexes)
+                    for product, quantity in lines[i]
+                ])
+                ledger.record_lines([StockMovement.KIND_RESERVE],
+                                    order_products)
+
+                order_ids = [order.id for order in orders]
+                traceparent = tracing.get_traceparent()
+                transaction.on_commit(
+                    lambda: expiry.schedule(order_ids, traceparent=traceparent)
+                )
+        except Exception:
+            reservations.release(
+                [line for i in indexes for line in lines[i]]
+            )
+            raise
+
+        objects = self._meta.queryset.filter(pk__in=order_ids).in_bulk()
+        return {
+            i: self.full_dehydrate(
+                self.build_bundle(obj=objects[order_id], request=request),
+                for_list=True
+            ).data
+            for i, order_id in zip(indexes, order_ids)
+        }
 
     def obj_update(self, bundle, **kwargs):
         """
         Marks an order as complete when the payment is done consolidating the
         stock (releasing the reserved units and setting them as sold)
         """
-        body = json.loads(bundle.request.body.decode())
+        if bundle.data.get('complete'):
+            self.complete_order(bundle.obj)
+
+        return bundle
+
+    def complete_order(self, order):
+        """
+        Completes the order and consolidates its stock in a single transaction.
+        Stock is decremented with a single conditional UPDATE that refuses to
+        leave any product below zero, and the reservations are then consumed
+        with a single call. With STOCK_WRITE_BEHIND the stock is left to be
+        decremented by the next flush instead, see the stock module
+        """
+        write_behind = stock.is_write_behind()
+
+        with transaction.atomic():
+            # Only the request actually completing the order consolidates it
+            updated = Order.objects.filter(pk=order.pk, complete=False) \
+                .update(complete=True, stock_pending=write_behind)
+            if not updated:
+                if not Order.objects.filter(pk=order.pk).exists():
+                    raise ImmediateHttpResponse(HttpNotFound())
+                return
+
+            order_products = list(OrderProduct.objects.filter(
+                order=order
+            ).select_related('product'))
+            lines = [
+                (order_product.product, order_product.quantity)
+                for order_product in order_products
+            ]
 
-        if body.get('complete'):
-            bundle.obj.complete = True
-            bundle.obj.save()
+            # Its reservations are released, as the units are sold
+            ledger.record_lines(
+                [StockMovement.KIND_RELEASE, StockMovement.KIND_SELL],
+                order_products
+            )
 
-            # Consolidate stock
-            for order_product in bundle.obj.orderproduct_set.all():
-                product = order_product.product
-                quantity = order_product.quantity
+            quantities = {}
+            for product, quantity in lines:
+                quantities[product.id] = \
+                    quantities.get(product.id, 0) + quantity
 
-                product.release_stock(quantity)
-                product.stock -= quantity
-                product.save()
+            if quantities and not write_behind:
+                sold = Product.objects.filter(reduce(operator.or_, [
+                    Q(pk=product_id, stock__gte=quantity)
+                    for product_id, quantity in quantities.items()
+                ])).update(stock=Case(
+                    *[When(pk=product_id, then=F('stock') - quantity)
+                      for product_id, quantity in quantities.items()],
+                    default=F('stock'),
+                    output_field=IntegerField()
+                ))
+                if sold != len(quantities):
+                    raise ImmediateHttpResponse(HttpBadRequest())
+
+                catalog.bump_version_on_commit()
+
+        order.complete = True
+
+        if write_behind:
+            # The units stay taken, as sold, until the flush decrements the
+            # stock
+            reservations.sell(lines)
+        else:
+            # The stock is already decremented, consuming the reservations
+            # only after that means no one can buy the units sold in the
+            # meanwhile, and the stock kept by the backend is decremented
+            # along with them
+            reservations.consume(lines)
+        expiry.forget([order.pk])
 
     def save(self, bundle, skip_errors=False):
         """
-        Creates a new pending order reserving the necessary stock and
-        scheduling a task to release the stock in case the order is not paid
-        within the ORDER_TIMEOUT
+        Creates a new pending order reserving the necessary stock and tracking
+        it so the stock is released in case the order is not paid within the
+        ORDER_TIMEOUT
         """
         if not self.is_valid(bundle):
             raise ImmediateHttpResponse(HttpBadRequest())
 
-        # It's already validated
-        bundle.obj.save()
+        lines = get_order_lines(bundle)
 
-        for product_row in bundle.data.get('products'):
-            product = Product.objects.get(id=product_row.get('product'))
-            quantity = int(product_row.get('quantity'))
+        # Prices are fixed when the order is created
+        bundle.obj.set_quote(Order.pricing_engine.quote(lines))
 
-            OrderProduct(
-                order=bundle.obj,
-                product=product,
-                quantity=quantity,
-            ).save()
+        # Reserve the stock of every line at once to avoid other orders buying
+        # our stock while we are paying. The stock may have been taken since
+        # the validation, in that case nothing is reserved
+        try:
+            reservations.reserve(lines)
+        except ValueError:
+            raise ImmediateHttpResponse(HttpBadRequest())
 
-            # Reserve the stock to avoid other orders buying our stock while
-            # we are paying
-            product.reserve_stock(quantity)
+        try:
+            with transaction.atomic(), \
+                    tracing.span('order.save', lines=len(lines)):
+                # It's already validated
+                bundle.obj.save()
 
-        # Schedule the task to check the order after ORDER_TIMEOUT
-        check_order.apply_async(
-            args=[bundle.obj.id, ],
-            countdown=settings.ORDER_TIMEOUT,
-        )
+                order_products = OrderProduct.objects.bulk_create([
+                    OrderProduct(
+                        order=bundle.obj,
+                        product=product,
+                        quantity=quantity,
+                    )
+                    for product, quantity in lines
+                ])
+                ledger.record_lines([StockMovement.KIND_RESERVE],
+                                    order_products)
+
+                # Release the stock if the order is not paid within the
+                # ORDER_TIMEOUT, once it can actually be found
+                order_id = bundle.obj.id
+                traceparent = tracing.get_traceparent()
+                transaction.on_commit(
+                    lambda: expiry.schedule([order_id],
+                                            traceparent=traceparent)
+                )
+        except Exception:
+            reservations.release(lines)
+            raise
 
         return bundle
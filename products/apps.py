@@ -3,3 +3,12 @@ from django.apps import AppConfig
 
 class ProductsConfig(AppConfig):
     name = 'products'
+
+    def ready(self):
+        # Connect the signals keeping the catalog version and the ledger up to
+        # date
+        from . import catalog, ledger, tracing  # NOQA
+
+        # Trace the celery tasks run by the workers too
+        if tracing.is_enabled():
+            tracing.install()
@@ -0,0 +1,298 @@
+"""
+Microbenchmarks of the hot paths.
+
+Each benchmark sets up the data for a given size (products in the catalog or
+lines in an order) and returns the function to time. Every function is timed
+as timeit does, keeping the best time per call of a few repeats, and compared
+with the baseline kept in the repository, so any of them slowing down beyond
+a threshold is found. See the benchmark command to run them.
+
+Timings depend on the machine, so a reference workload of plain Python is
+timed along with them, and each benchmark is compared by its time relative to
+the reference rather than by its absolute time. The baseline saved on one
+machine can then be compared with runs on another one.
+
+The reservation backends are compared apart, by the throughput of concurrent
+threads reserving and releasing the same few products, see the
+benchmark_reservations command.
+"""
+import json
+import random
+import threading
+import time
+import timeit
+from collections import Counter, OrderedDict
+from django.db import connection, transaction
+from django.test.client import RequestFactory
+from tastypie.bundle import Bundle
+
+from . import catalog, reservations
+from .api.resources_v1 import OrderValidation, ProductResource
+from .models import Order, OrderProduct, Product
+from .views import index
+
+
+BENCHMARKS = OrderedDict()
+
+# Key of the reference workload, see reference
+REFERENCE = 'reference'
+
+
+def benchmark(sizes):
+    """ Register the setup of a benchmark, to run at each one of the sizes """
+    def register(setup):
+        BENCHMARKS[setup.__name__] = (setup, sizes)
+        return setup
+
+    return register
+
+
+def make_products(size):
+    """ Create the given number of products, of every category """
+    categories = [choice[0] for choice in Product.CATEGORY_CHOICES]
+
+    Product.objects.bulk_create([
+        Product(
+            name='Benchmark {}'.format(i),
+            price=1 + i % 5,
+            category=categories[i % len(categories)],
+            unitary=bool(i % 2),
+            stock=1000,
+        )
+        for i in range(size)
+    ])
+
+    return list(Product.objects.order_by('-id')[:size])
+
+
+@benchmark(sizes=(1, 10, 100))
+def order_price(size):
+    """ Price an order of size lines """
+    order = Order.objects.create()
+    OrderProduct.objects.bulk_create([
+        OrderProduct(order=order, product=product, quantity=4)
+        for product in make_products(size)
+    ])
+
+    return order.price
+
+
+@benchmark(sizes=(1, 10, 100))
+def order_validation(size):
+    """ Validate a new order of size lines """
+    data = {'products': [
+        {'product': product.id, 'quantity': 1}
+        for product in make_products(size)
+    ]}
+    validation = OrderValidation()
+
+    return lambda: validation.is_valid(Bundle(data=data))
+
+
+@benchmark(sizes=(10, 100, 1000))
+def reserve_release(size):
+    """
+    Reserve and release the stock of a product, with size products already
+    reserved
+    """
+    products = make_products(size)
+    for product in products:
+        product.reserve_stock(1)
+    product = products[0]
+
+    def reserve_release():
+        product.reserve_stock(1)
+        product.release_stock(1)
+
+    return reserve_release
+
+
+@benchmark(sizes=(10, 100, 1000))
+def index_render(size):
+    """ Render the index with size products """
+    make_products(size)
+    request = RequestFactory().get('/')
+
+    return lambda: index(request)
+
+
+@benchmark(sizes=(10, 100, 1000))
+def product_list(size):
+    """
+    Serialize the list of size products. The catalog version is bumped
+    every time, so it is serialized instead of read from the cache
+    """
+    make_products(size)
+    resource = ProductResource(api_name='v1')
+    request = RequestFactory().get('/api/v1/product/', {'limit': 0})
+
+    def product_list():
+        catalog.bump_version()
+        return resource.get_list(request)
+
+    return product_list
+
+
+def reference():
+    """
+    Workload of plain Python, no database nor cache, whose time tells the
+    speed of the machine running the benchmarks
+    """
+    data = [{'id': i, 'name': 'Product {}'.format(i), 'price': i / 3}
+            for i in range(100)]
+
+    return lambda: json.loads(json.dumps(
+        sorted(data, key=lambda item: item['price'], reverse=True)
+    ))
+
+
+def time_call(func, repeat):
+    """ Get the best time per call of the function, as timeit does """
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def run(names=None, repeat=3):
+    """
+    Run the benchmarks (all of them or the given ones) at each one of their
+    sizes, returns the best time per call by benchmark and size, along with
+    the one of the reference workload
+    """
+    results = OrderedDict()
+    results[REFERENCE] = time_call(reference(), repeat)
+
+    for name, (setup, sizes) in BENCHMARKS.items():
+        if names and name not in names:
+            continue
+
+        for size in sizes:
+            with transaction.atomic():
+                results[get_key(name, size)] = time_call(setup(size), repeat)
+
+                # Every benchmark starts from the same empty data
+                transaction.set_rollback(True)
+            reservations.get_backend().clear()
+
+    return results
+
+
+def run_contention(backend, products, threads=8, operations=2000, seed=None):
+    """
+    Reserve and release a unit of the given products, picked at random, from
+    concurrent threads with the given backend. Returns the latency of every
+    operation, the operations rejected for lack of stock, the exceptions
+    raised and the elapsed time
+    """
+    latencies = []
+    rejected = [0]
+    exceptions = Counter()
+    lock = threading.Lock()
+    per_thread = [operations // threads + (i < operations % threads)
+                  for i in range(threads)]
+
+    def reserve_release(number):
+        rand = random.Random(None if seed is None else seed + number)
+        thread_latencies = []
+        thread_rejected = 0
+        thread_exceptions = Counter()
+
+        try:
+            for _ in range(per_thread[number]):
+                product = rand.choice(products)
+                start = time.perf_counter()
+                try:
+                    if backend.reserve_many([[(product, 1)]])[0]:
+                        backend.release([(product, 1)])
+                    else:
+                        thread_rejected += 1
+                except Exception as e:
+                    thread_exceptions['{}: {}'.format(type(e).__name__,
+                                                      e)] += 1
+                thread_latencies.append(time.perf_counter() - start)
+        finally:
+            connection.close()
+
+        with lock:
+            latencies.extend(thread_latencies)
+            rejected[0] += thread_rejected
+            exceptions.update(thread_exceptions)
+
+    workers = [
+        threading.Thread(target=reserve_release, args=(number, ))
+        for number in range(threads)
+    ]
+
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    return latencies, rejected[0], exceptions, time.perf_counter() - start
+
+
+def get_key(name, size):
+    """ Get the key of the results of a benchmark at a size """
+    return '{}[{}]'.format(name, size)
+
+
+def load_baseline(path):
+    """ Load the baseline results, none if there are no results yet """
+    try:
+        with open(path) as stream:
+            return json.load(stream)
+    except FileNotFoundError:
+        return {}
+
+
+def save_baseline(path, results):
+    """ Save the results as the baseline to compare with """
+    with open(path, 'w') as stream:
+        json.dump(results, stream, indent=4)
+        stream.write('\n')
+
+
+def rescale(results, baseline):
+    """
+    Get the results as if timed on the machine the baseline was saved on, so
+    the ones of some of the benchmarks can be saved along with the rest
+    """
+    if not results.get(REFERENCE) or not baseline.get(REFERENCE):
+        return results
+
+    scale = baseline[REFERENCE] / results[REFERENCE]
+    return OrderedDict(
+        (key, result * scale)
+        for key, result in results.items()
+        if key != REFERENCE
+    )
+
+
+def compare(results, baseline, threshold):
+    """
+    Compare the results with the baseline, returns the (key, result,
+    baseline, change) of every result and the keys of the ones slower than
+    the baseline beyond the threshold (e.g. 0.25 for 25% slower). The change
+    is the one of the time relative to the reference workload, nothing is
+    compared unless both have it
+    """
+    comparison = []
+    regressions = []
+
+    scale = None
+    if results.get(REFERENCE) and baseline.get(REFERENCE):
+        scale = results[REFERENCE] / baseline[REFERENCE]
+
+    for key, result in results.items():
+        base = baseline.get(key)
+        change = None
+        if key != REFERENCE and base and scale:
+            change = result / (base * scale) - 1
+
+        comparison.append((key, result, base, change))
+        if change is not None and change > threshold:
+            regressions.append(key)
+
+    return comparison, regressions
@@ -0,0 +1,55 @@
+"""
+Versioning of the product catalog.
+
+The catalog only changes on restocks, payments and admin edits, so every
+change bumps a version counter kept in the cache. Anything derived from the
+catalog (e.g. the serialized responses of the product API) can then be cached
+under the current version and is implicitly invalidated by the next bump.
+"""
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Product
+
+
+VERSION_KEY = 'catalog_version'
+
+
+def get_version():
+    """ Get the current version of the catalog """
+    version = cache.get(VERSION_KEY)
+
+    if version is None:
+        # Start from the current time instead of 0, so if the counter is lost
+        # (e.g. evicted) no stale data cached under old versions is reused
+        cache.add(VERSION_KEY, int(time.time() * 1000), None)
+        version = cache.get(VERSION_KEY)
+
+    return version
+
+
+def bump_version():
+    """ Mark the catalog as changed """
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        get_version()
+
+
+def bump_version_on_commit():
+    """
+    Mark the catalog as changed once the current transaction is committed, so
+    no one can cache the old data under the new version
+    """
+    transaction.on_commit(bump_version)
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def product_changed(sender, **kwargs):
+    """ Any change of a product changes the catalog """
+    bump_version_on_commit()
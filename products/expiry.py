@@ -0,0 +1,232 @@
+"""
+Expiration of the orders that are not paid in time.
+
+The deadline of every pending order is tracked in a sorted set (scored by the
+deadline timestamp) so a periodic sweep can pick all the expired orders at
+once and release them in batches, instead of scheduling a task per order.
+
+The sorted set lives in the cache, so it can be lost (e.g. redis restarting
+without persistence) along with the reservations. The pending orders are then
+tracked again out of the database on the start of the processes, see
+warm_start, otherwise their reservations would never be released.
+
+When tracing, the traceparent of the request creating each order is kept
+along with it, so its release is recorded in the trace of that request.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from . import ledger, reservations, tracing
+from .models import Order, OrderProduct, StockMovement
+from .utils import get_redis_client
+
+
+PENDING_KEY = 'orders_pending'
+
+# Set once the pending orders are tracked, if it is missing the sorted set has
+# been lost along with it (or never built), see warm_start
+TRACKED_KEY = 'orders_pending_tracked'
+TRACE_KEY = 'order_trace_{}'
+
+# Time the traceparent of an order is kept beyond its deadline, as the sweep
+# may be late
+TRACE_TIMEOUT = 60 * 60
+
+# Used to keep the pending orders consistent when the cache is not redis (the
+# local memory cache used by tests lives in this very process)
+_local_lock = threading.Lock()
+
+
+def schedule(order_ids, timeout=None, traceparent=None):
+    """
+    Track the given orders as pending, expiring after the timeout (defaults to
+    ORDER_TIMEOUT seconds). The traceparent of the trace creating them, if
+    any, is kept to trace their release
+    """
+    if not order_ids:
+        return
+
+    if timeout is None:
+        timeout = settings.ORDER_TIMEOUT
+    deadline = time.time() + timeout
+
+    client = get_redis_client()
+    if client is not None:
+        args = []
+        for order_id in order_ids:
+            args.extend([deadline, order_id])
+        client.execute_command('ZADD', cache.make_key(PENDING_KEY), *args)
+    else:
+        with _local_lock:
+            pending = cache.get(PENDING_KEY) or {}
+            pending.update((order_id, deadline) for order_id in order_ids)
+            cache.set(PENDING_KEY, pending, None)
+
+    if tracing.is_sampled(traceparent):
+        cache.set_many({
+            TRACE_KEY.format(order_id): traceparent for order_id in order_ids
+        }, timeout + TRACE_TIMEOUT)
+
+
+def track_pending():
+    """
+    Track every pending order of the database, expiring ORDER_TIMEOUT seconds
+    after it was created, with a single query and a single cache call. The
+    orders already tracked keep their deadline. Returns the number of
+    pending orders
+    """
+    deadlines = {
+        order_id: created.timestamp() + settings.ORDER_TIMEOUT
+        for order_id, created in Order.objects.filter(complete=False)
+        .values_list('id', 'created')
+    }
+
+    if deadlines:
+        client = get_redis_client()
+        if client is not None:
+            args = []
+            for order_id, deadline in sorted(deadlines.items()):
+                args.extend([deadline, order_id])
+            client.execute_command('ZADD', cache.make_key(PENDING_KEY), 'NX',
+                                   *args)
+        else:
+            with _local_lock:
+                pending = cache.get(PENDING_KEY) or {}
+                for order_id, deadline in deadlines.items():
+                    pending.setdefault(order_id, deadline)
+                cache.set(PENDING_KEY, pending, None)
+
+    cache.set(TRACKED_KEY, True, None)
+    return len(deadlines)
+
+
+def warm_start():
+    """
+    Track the pending orders again if the sorted set has been lost, so it is
+    safe to run on the start of every process (the ones running it at once
+    just track the same orders). Returns whether they were
+    """
+    if cache.get(TRACKED_KEY) is not None:
+        return False
+
+    track_pending()
+    return True
+
+
+def get_traces(order_ids):
+    """ Get the traceparent kept for each one of the given orders, if any """
+    traces = cache.get_many([
+        TRACE_KEY.format(order_id) for order_id in order_ids
+    ])
+
+    return {
+        order_id: traces[TRACE_KEY.format(order_id)]
+        for order_id in order_ids if TRACE_KEY.format(order_id) in traces
+    }
+
+
+def get_expired(now=None, limit=None):
+    """
+    Get the ids of the pending orders whose deadline has passed, the ones
+    expiring first come first
+    """
+    if now is None:
+        now = time.time()
+    if limit is None:
+        limit = settings.ORDER_SWEEP_BATCH
+
+    client = get_redis_client()
+    if client is not None:
+        return [
+            int(order_id) for order_id in client.zrangebyscore(
+                cache.make_key(PENDING_KEY), '-inf', now, start=0, num=limit
+            )
+        ]
+
+    pending = cache.get(PENDING_KEY) or {}
+    expired = sorted(
+        (deadline, order_id) for order_id, deadline in pending.items()
+        if deadline <= now
+    )
+    return [order_id for _, order_id in expired[:limit]]
+
+
+def forget(order_ids):
+    """ Stop tracking the given orders """
+    if not order_ids:
+        return
+
+    client = get_redis_client()
+    if client is not None:
+        client.zrem(cache.make_key(PENDING_KEY), *order_ids)
+    else:
+        with _local_lock:
+            pending = cache.get(PENDING_KEY) or {}
+            for order_id in order_ids:
+                pending.pop(order_id, None)
+            cache.set(PENDING_KEY, pending, None)
+
+
+def release_orders(order_ids):
+    """
+    Delete the given orders unless they have already been paid, releasing
+    their reserved stock. Everything is done in bulk: one query for the
+    lines, one insert of their movements, one delete and one call to release
+    the reservations.
+    Returns the number of orders released
+    """
+    start = time.time()
+
+    with transaction.atomic():
+        pending_ids = list(
+            Order.objects.select_for_update()
+            .filter(id__in=order_ids, complete=False)
+            .values_list('id', flat=True)
+        )
+
+        order_products = list(OrderProduct.objects.filter(
+            order_id__in=pending_ids
+        ).select_related('product'))
+        lines = [
+            (order_product.product, order_product.quantity)
+            for order_product in order_products
+        ]
+
+        ledger.record_lines([StockMovement.KIND_EXPIRE], order_products)
+        Order.objects.filter(id__in=pending_ids).delete()
+
+    reservations.release(lines)
+
+    if pending_ids and tracing.is_enabled():
+        end = time.time()
+        for order_id, traceparent in get_traces(pending_ids).items():
+            tracing.record('order.release', traceparent, start, end,
+                           **{'order.id': order_id,
+                              'orders.released': len(pending_ids)})
+
+    return len(pending_ids)
+
+
+def release_expired_orders(now=None):
+    """
+    Release every pending order whose deadline has passed, in batches of
+    ORDER_SWEEP_BATCH orders. Returns the number of orders released
+    """
+    released = 0
+
+    while True:
+        order_ids = get_expired(now)
+        if not order_ids:
+            break
+
+        released += release_orders(order_ids)
+        forget(order_ids)
+
+        if len(order_ids) < settings.ORDER_SWEEP_BATCH:
+            break
+
+    return released
@@ -0,0 +1,251 @@
+"""
+Ledger of the inventory movements.
+
+Every change of the stock of a product (restocks and sales) and of the amount
+reserved of it (reservations, and reservations released when their order is
+paid or expired) is inserted as a StockMovement, along with its order, in the
+same transaction that makes it. Movements are never updated, so recording
+them takes no lock of any hot row, and they keep the whole history to audit.
+
+A periodic compaction folds the movements into a StockSnapshot per product:
+its stock and amount reserved as of the last movement folded. The levels of a
+product are its snapshot plus the movements after it. Only the movements
+older than STOCK_LEDGER_LAG are folded, so the ones of transactions still in
+progress (whose ids may be lower than ones already committed) are not skipped.
+
+The ledger is the history of the stock, not its source: the product rows
+(and the reservation backend) still hold the stock orders are checked
+against, and the levels of the ledger are only read to audit them, see
+check. It is kept for that audit and to roll up the sales (see the rollups
+module), at the cost of an insert along with every order placed, paid or
+expired, and every restock. Sites needing neither can stop recording it with
+STOCK_LEDGER.
+"""
+import operator
+from datetime import timedelta
+from functools import reduce
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, IntegerField, Max, Q, Sum, Value, When
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from . import stock
+from .models import Order, Product, StockMovement, StockSnapshot
+
+
+# Sign of the quantity of each kind of movement, restocks are already signed
+SIGNS = {
+    StockMovement.KIND_RESTOCK: 1,
+    StockMovement.KIND_RESERVE: 1,
+    StockMovement.KIND_SELL: -1,
+    StockMovement.KIND_RELEASE: -1,
+    StockMovement.KIND_EXPIRE: -1,
+}
+
+# Kinds of the movements of the stock, the rest move the amount reserved
+STOCK_KINDS = (StockMovement.KIND_RESTOCK, StockMovement.KIND_SELL)
+
+
+def is_enabled():
+    return getattr(settings, 'STOCK_LEDGER', True)
+
+
+def record(movements):
+    """
+    Record the (kind, order id, product id, quantity) movements with a single
+    query, unless the ledger is not kept
+    """
+    if not is_enabled():
+        return
+
+    StockMovement.objects.bulk_create([
+        StockMovement(kind=kind, order_id=order_id, product_id=product_id,
+                      quantity=SIGNS[kind] * quantity)
+        for kind, order_id, product_id, quantity in movements if quantity
+    ])
+
+
+def record_lines(kinds, order_products):
+    """
+    Record a movement of each of the given kinds for each of the order
+    products, with a single query
+    """
+    record([
+        (kind, order_product.order_id, order_product.product_id,
+         order_product.quantity)
+        for order_product in order_products for kind in kinds
+    ])
+
+
+@receiver(post_save, sender=Product)
+def product_saved(sender, instance, created, raw=False, **kwargs):
+    """
+    Record the stock a product is created with, or the change of its stock
+    when saved (e.g. edited in the admin) as a restock
+    """
+    if instance.stock_change and not raw:
+        record([(StockMovement.KIND_RESTOCK, None, instance.id,
+                 instance.stock_change)])
+
+
+def get_changes(movements):
+    """
+    Sum the changes made by the given movements after the snapshot of their
+    products, in a single query. Returns (product id, last movement, snapshot
+    stock, snapshot reserved, stock change, reserved change) rows, the last
+    movement being 0 for products without a snapshot
+    """
+    moves_stock = Q(kind__in=STOCK_KINDS)
+
+    return movements.filter(
+        Q(product__snapshot__isnull=True) |
+        Q(id__gt=F('product__snapshot__last_movement'))
+    ).values('product').annotate(
+        last_movement=Max(Coalesce(F('product__snapshot__last_movement'),
+                                   0)),
+        snapshot_stock=Max(Coalesce(F('product__snapshot__stock'), 0)),
+        snapshot_reserved=Max(Coalesce(F('product__snapshot__reserved'), 0)),
+        stock_change=Sum(Case(When(moves_stock, then=F('quantity')),
+                              default=Value(0), output_field=IntegerField())),
+        reserved_change=Sum(Case(When(~moves_stock, then=F('quantity')),
+                                 default=Value(0),
+                                 output_field=IntegerField())),
+    ).values_list('product', 'last_movement', 'snapshot_stock',
+                  'snapshot_reserved', 'stock_change', 'reserved_change')
+
+
+def get_levels(product_ids):
+    """
+    Get the (stock, reserved) levels of the given products according to the
+    ledger: their snapshots plus the movements after them. The products with
+    no movement after their snapshot take another query
+    """
+    levels = {
+        product_id: (snapshot_stock + stock_change,
+                     snapshot_reserved + reserved_change)
+        for product_id, _, snapshot_stock, snapshot_reserved, stock_change,
+        reserved_change in get_changes(
+            StockMovement.objects.filter(product__in=product_ids)
+        )
+    }
+
+    missing = [product_id for product_id in product_ids
+               if product_id not in levels]
+    if missing:
+        snapshots = {
+            product_id: (snapshot_stock, snapshot_reserved)
+            for product_id, snapshot_stock, snapshot_reserved in
+            StockSnapshot.objects.filter(product__in=missing)
+            .values_list('product', 'stock', 'reserved')
+        }
+        for product_id in missing:
+            levels[product_id] = snapshots.get(product_id, (0, 0))
+
+    return levels
+
+
+def compact(lag=None):
+    """
+    Fold the movements older than lag seconds (STOCK_LEDGER_LAG by default)
+    into the snapshots of their products, creating and updating them with a
+    query each. A snapshot is only updated if no other compaction did in the
+    meanwhile, otherwise nothing is and the next compaction folds them.
+    Returns the number of snapshots created or updated
+    """
+    if lag is None:
+        lag = settings.STOCK_LEDGER_LAG
+
+    last = StockMovement.objects.filter(
+        created__lte=timezone.now() - timedelta(seconds=lag)
+    ).order_by('-id').values_list('id', flat=True).first()
+    if last is None:
+        return 0
+
+    changes = list(get_changes(StockMovement.objects.filter(id__lte=last)))
+    if not changes:
+        return 0
+
+    created = [row for row in changes if not row[1]]
+    updated = [row for row in changes if row[1]]
+
+    try:
+        with transaction.atomic():
+            StockSnapshot.objects.bulk_create([
+                StockSnapshot(product_id=product_id, last_movement=last,
+                              stock=snapshot_stock + stock_change,
+                              reserved=snapshot_reserved + reserved_change)
+                for product_id, _, snapshot_stock, snapshot_reserved,
+                stock_change, reserved_change in created
+            ])
+
+            # Only the snapshots still as they were read
+            if updated and StockSnapshot.objects.filter(
+                reduce(operator.or_, [
+                    Q(product=product_id, last_movement=last_movement)
+                    for product_id, last_movement, _, _, _, _ in updated
+                ])
+            ).update(
+                last_movement=last,
+                stock=Case(*[
+                    When(product=product_id,
+                         then=Value(snapshot_stock + stock_change))
+                    for product_id, _, snapshot_stock, _, stock_change, _
+                    in updated
+                ], output_field=IntegerField()),
+                reserved=Case(*[
+                    When(product=product_id,
+                         then=Value(snapshot_reserved + reserved_change))
+                    for product_id, _, _, snapshot_reserved, _,
+                    reserved_change in updated
+                ], output_field=IntegerField()),
+            ) != len(updated):
+                transaction.set_rollback(True)
+                return 0
+    except IntegrityError:
+        # Another compaction created some of the snapshots
+        return 0
+
+    return len(changes)
+
+
+def check(product_ids=None):
+    """
+    Check the ledger matches the stock of the products (less the units sold
+    and not flushed yet, see the stock module) and the lines of the pending
+    orders, and that no product was oversold. Returns the list of problems
+    found
+    """
+    products = Product.objects.all()
+    if product_ids is not None:
+        products = products.filter(pk__in=product_ids)
+    products = dict(products.values_list('id', 'stock'))
+
+    levels = get_levels(list(products))
+    pending = stock.get_quantities(Order.objects.filter(complete=False))
+    unflushed = stock.get_quantities(Order.objects.filter(stock_pending=True))
+
+    problems = []
+    for product_id, product_stock in sorted(products.items()):
+        ledger_stock, ledger_reserved = levels[product_id]
+        product_stock -= unflushed.get(product_id, 0)
+
+        if ledger_stock < 0:
+            problems.append('Product {} was oversold, its ledger stock is {}'
+                            .format(product_id, ledger_stock))
+        if ledger_stock != product_stock:
+            problems.append(
+                'Product {} stock ({}) does not match its ledger ({})'
+                .format(product_id, product_stock, ledger_stock)
+            )
+        if ledger_reserved != pending.get(product_id, 0):
+            problems.append(
+                'Product {} pending orders ({}) do not match its ledger '
+                'reservation ({})'.format(product_id,
+                                          pending.get(product_id, 0),
+                                          ledger_reserved)
+            )
+
+    return problems
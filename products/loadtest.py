@@ -0,0 +1,223 @@
+"""
+Load test of the order workflow.
+
+Concurrent clients go over and over through the whole purchase: load the
+index, POST an order for a few random products and PATCH it as complete. The
+latency of every request is recorded to report the throughput and latency
+percentiles of each step, and once every client is done the stock and
+reservations are checked: nothing can have been oversold, nor any
+reservation leaked.
+
+Clients run in threads of this very process using django's test client, so
+the whole stack but the HTTP server is exercised against the configured
+database and cache. See the load_test command to run it.
+"""
+import json
+import random
+import threading
+import time
+from collections import Counter
+from django.db import connection
+from django.db.models import Sum
+from django.test.client import Client
+
+from . import reservations, stock
+from .models import OrderProduct, Product
+
+
+STEPS = ('index', 'order', 'complete')
+
+
+class Stats(object):
+    """ Latencies and outcomes of each step, shared by every client """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {step: [] for step in STEPS}
+        self.rejected = {step: 0 for step in STEPS}
+        self.errors = {step: 0 for step in STEPS}
+        self.exceptions = Counter()
+
+    def record(self, step, latency, rejected=False, error=False):
+        """
+        Record a request of the step, error can be the exception raised by it
+        """
+        with self.lock:
+            self.latencies[step].append(latency)
+            if rejected:
+                self.rejected[step] += 1
+            if error:
+                self.errors[step] += 1
+            if isinstance(error, Exception):
+                self.exceptions['{}: {}'.format(type(error).__name__,
+                                                error)] += 1
+
+
+def percentile(values, percent):
+    """ Get the percentile of the values, using the nearest rank """
+    if not values:
+        return 0
+
+    values = sorted(values)
+    rank = max(int(round(percent / 100 * len(values))), 1)
+
+    return values[rank - 1]
+
+
+def run(product_ids, clients=8, purchases=200, max_lines=3, max_quantity=3,
+        seed=None):
+    """
+    Run the given number of purchases split among the concurrent clients,
+    each order made of up to max_lines of the given products. Returns the
+    stats and the elapsed time
+    """
+    stats = Stats()
+    remaining = [purchases]
+    remaining_lock = threading.Lock()
+
+    def next_purchase():
+        with remaining_lock:
+            if remaining[0] <= 0:
+                return False
+            remaining[0] -= 1
+            return True
+
+    def client_loop(number):
+        rand = random.Random(None if seed is None else seed + number)
+        client = Client()
+
+        try:
+            while next_purchase():
+                purchase(client, rand, product_ids, stats, max_lines,
+                         max_quantity)
+        finally:
+            connection.close()
+
+    threads = [
+        threading.Thread(target=client_loop, args=(number, ))
+        for number in range(clients)
+    ]
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return stats, time.perf_counter() - start
+
+
+def purchase(client, rand, product_ids, stats, max_lines, max_quantity):
+    """ Go through the whole purchase of a random order """
+    def request(step, method, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = getattr(client, method)(*args, **kwargs)
+        except Exception as e:
+            stats.record(step, time.perf_counter() - start, error=e)
+            return None
+
+        latency = time.perf_counter() - start
+        stats.record(step, latency,
+                     rejected=400 <= response.status_code < 500,
+                     error=response.status_code >= 500)
+        return response
+
+    request('index', 'get', '/')
+
+    lines = rand.sample(product_ids,
+                        rand.randint(1, min(max_lines, len(product_ids))))
+    response = request('order', 'post', '/api/v1/order/', json.dumps({
+        'products': [
+            {'product': product_id, 'quantity': rand.randint(1, max_quantity)}
+            for product_id in lines
+        ],
+    }), content_type='application/json')
+
+    if response is None or response.status_code != 201:
+        return
+
+    order_id = json.loads(response.content.decode('utf-8'))['id']
+    request('complete', 'patch', '/api/v1/order/{}/'.format(order_id),
+            json.dumps({'complete': True}), content_type='application/json')
+
+
+def check(product_ids, initial_stock):
+    """
+    Check the stock and reservations left by the load test, returns the list
+    of problems found:
+        - No stock nor reservation can be negative
+        - The stock sold must match the completed orders
+        - The reservations must match the pending orders
+    The stock sold but not flushed yet is flushed first
+    """
+    stock.flush_all()
+    problems = []
+
+    products = Product.objects.in_bulk(product_ids)
+    reserved = reservations.get_reserved(product_ids)
+    sold = dict(OrderProduct.objects.filter(
+        product__in=product_ids, order__complete=True
+    ).values_list('product').annotate(Sum('quantity')))
+    pending = dict(OrderProduct.objects.filter(
+        product__in=product_ids, order__complete=False
+    ).values_list('product').annotate(Sum('quantity')))
+
+    for product_id in product_ids:
+        product = products[product_id]
+
+        if product.stock < 0:
+            problems.append('Product {} has a negative stock ({})'.format(
+                product_id, product.stock
+            ))
+        if reserved[product_id] < 0:
+            problems.append('Product {} has a negative reservation ({})'
+                            .format(product_id, reserved[product_id]))
+        if product.stock != initial_stock - sold.get(product_id, 0):
+            problems.append(
+                'Product {} stock ({}) does not match its sales ({} of {})'
+                .format(product_id, product.stock, sold.get(product_id, 0),
+                        initial_stock)
+            )
+        if reserved[product_id] != pending.get(product_id, 0):
+            problems.append(
+                'Product {} reservation ({}) does not match its pending '
+                'orders ({})'.format(product_id, reserved[product_id],
+                                     pending.get(product_id, 0))
+            )
+
+    return problems
+
+
+def report(stats, elapsed):
+    """ Get the lines reporting the throughput and latencies of each step """
+    lines = [
+        '{:<10}{:>8}{:>10}{:>8}{:>10}{:>10}{:>10}{:>10}'.format(
+            'step', 'count', 'rejected', 'errors', 'req/s', 'p50 ms',
+            'p95 ms', 'p99 ms'
+        )
+    ]
+
+    for step in STEPS:
+        latencies = stats.latencies[step]
+        lines.append(
+            '{:<10}{:>8}{:>10}{:>8}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.1f}'
+            .format(
+                step, len(latencies), stats.rejected[step],
+                stats.errors[step], len(latencies) / elapsed,
+                percentile(latencies, 50) * 1000,
+                percentile(latencies, 95) * 1000,
+                percentile(latencies, 99) * 1000,
+            )
+        )
+
+    for exception, count in stats.exceptions.most_common():
+        lines.append('{} x {}'.format(count, exception))
+
+    completed = len(stats.latencies['complete']) - \
+        stats.rejected['complete'] - stats.errors['complete']
+    lines.append('{} orders completed in {:.2f}s ({:.1f} orders/s)'.format(
+        completed, elapsed, completed / elapsed
+    ))
+
+    return lines
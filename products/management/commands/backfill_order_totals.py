@@ -0,0 +1,71 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Case, CharField, FloatField, IntegerField, \
+    Prefetch, Value, When
+
+from products.models import Order, OrderProduct
+
+
+class Command(BaseCommand):
+    help = (
+        'Fill in the total, number of lines and applied discounts of the '
+        'orders created before they were kept with the order. As the prices '
+        'of that time are not known, the current ones are used'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            action='store',
+            dest='chunk_size',
+            default=500,
+            help='Orders updated by each query',
+        )
+
+    def handle(self, *args, **options):
+
+        orders = Order.objects.filter(total__isnull=True).order_by('id') \
+            .prefetch_related(Prefetch(
+                'orderproduct_set',
+                queryset=OrderProduct.objects.select_related('product')
+            ))
+
+        updated = 0
+        last_id = 0
+
+        while True:
+            chunk = list(orders.filter(id__gt=last_id)[:options['chunk_size']])
+            if not chunk:
+                break
+
+            updated += self.backfill(chunk)
+            last_id = chunk[-1].id
+
+        self.stdout.write('{} orders backfilled'.format(updated))
+
+    def backfill(self, orders):
+        """ Price the orders and store their totals with a single UPDATE """
+        quotes = Order.pricing_engine.quote_many([
+            [
+                (order_product.product, order_product.quantity)
+                for order_product in order.orderproduct_set.all()
+            ]
+            for order in orders
+        ])
+
+        def by_order(values, output_field):
+            return Case(
+                *[When(pk=order.pk, then=Value(value))
+                  for order, value in zip(orders, values)],
+                output_field=output_field
+            )
+
+        return Order.objects.filter(
+            pk__in=[order.pk for order in orders], total__isnull=True
+        ).update(
+            total=by_order([quote.total for quote in quotes], FloatField()),
+            line_count=by_order([quote.lines for quote in quotes],
+                                IntegerField()),
+            discounts=by_order([','.join(quote.discounts) for quote in quotes],
+                               CharField()),
+        )
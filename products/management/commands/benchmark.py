@@ -0,0 +1,89 @@
+import os
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from products import benchmarks
+from products.management.environment import throwaway_environment
+
+
+class Command(BaseCommand):
+    help = (
+        'Time the hot paths (pricing, validation, reservations, index and '
+        'product list) at several sizes and compare them with the baseline, '
+        'failing when any of them is slower beyond the threshold'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'names',
+            nargs='*',
+            help='Benchmarks to run, all of them by default: {}'.format(
+                ', '.join(benchmarks.BENCHMARKS)
+            ),
+        )
+        parser.add_argument(
+            '-t',
+            '--threshold',
+            type=float,
+            action='store',
+            dest='threshold',
+            default=settings.BENCHMARK_THRESHOLD,
+            help='Slowdown allowed over the baseline, 0.5 for 50%%',
+        )
+        parser.add_argument(
+            '--baseline',
+            action='store',
+            dest='baseline',
+            default=settings.BENCHMARK_BASELINE,
+            help='File with the baseline results',
+        )
+        parser.add_argument(
+            '--save',
+            action='store_true',
+            dest='save',
+            default=False,
+            help='Save the results as the new baseline',
+        )
+
+    def handle(self, *args, **options):
+
+        unknown = set(options['names']) - set(benchmarks.BENCHMARKS)
+        if unknown:
+            raise CommandError('Unknown benchmarks: {}'.format(
+                ', '.join(sorted(unknown))
+            ))
+
+        with throwaway_environment('benchmark'):
+            results = benchmarks.run(options['names'])
+
+        baseline = benchmarks.load_baseline(options['baseline'])
+        if benchmarks.REFERENCE not in baseline and not options['save']:
+            raise CommandError(
+                'No baseline to compare with in {}, save one first (--save)'
+                .format(os.path.relpath(options['baseline']))
+            )
+        comparison, regressions = benchmarks.compare(
+            results, baseline, options['threshold']
+        )
+
+        self.stdout.write('{:<28}{:>14}{:>14}{:>10}'.format(
+            'benchmark', 'baseline us', 'current us', 'change'
+        ))
+        for key, result, base, change in comparison:
+            self.stdout.write('{:<28}{:>14}{:>14.1f}{:>10}'.format(
+                key,
+                '-' if base is None else '{:.1f}'.format(base * 1e6),
+                result * 1e6,
+                '-' if change is None else '{:+.0%}'.format(change),
+            ))
+
+        if options['save']:
+            baseline.update(benchmarks.rescale(results, baseline))
+            benchmarks.save_baseline(options['baseline'], baseline)
+            self.stdout.write('Baseline saved to {}'.format(
+                os.path.relpath(options['baseline'])
+            ))
+        elif regressions:
+            raise CommandError('Slower than the baseline beyond {:.0%}: {}'
+                               .format(options['threshold'],
+                                       ', '.join(regressions)))
@@ -0,0 +1,94 @@
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+
+from products import benchmarks
+from products.loadtest import percentile
+from products.management.environment import throwaway_environment
+
+
+BACKENDS = (
+    'products.reservations.RedisBackend',
+    'products.reservations.RedisRingBackend',
+    'products.reservations.DatabaseBackend',
+    'products.reservations.LocalBackend',
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare the throughput and latency of the reservation backends under '
+        'contention: concurrent threads reserving and releasing the same few '
+        'products. It runs on a throwaway test database and its own cache '
+        'keys, use the settings of the database and cache to test (e.g. '
+        'postgres and redis). Backends that can not run with them are skipped'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'backends',
+            nargs='*',
+            help='Backends to compare, all of them by default: {}'.format(
+                ', '.join(BACKENDS)
+            ),
+        )
+        parser.add_argument('-t', '--threads', type=int, dest='threads',
+                            default=8, help='Concurrent threads')
+        parser.add_argument('-n', '--operations', type=int,
+                            dest='operations', default=2000,
+                            help='Reservations among all threads')
+        parser.add_argument('-p', '--products', type=int, dest='products',
+                            default=1, help='Products to reserve from')
+        parser.add_argument('--seed', type=int, dest='seed', default=None,
+                            help='Seed of the products picked')
+
+    def handle(self, *args, **options):
+
+        self.stdout.write('{:<40}{:>10}{:>10}{:>10}{:>10}{:>8}'.format(
+            'backend', 'ops/s', 'p50 us', 'p99 us', 'rejected', 'errors'
+        ))
+
+        errors = []
+        for path in options['backends'] or BACKENDS:
+            with throwaway_environment('benchmark_reservations',
+                                       threads=True):
+                try:
+                    backend = import_string(path)()
+                except ImportError:
+                    raise CommandError('Unknown backend: {}'.format(path))
+                except ImproperlyConfigured as e:
+                    self.stdout.write('{:<40}skipped, {}'.format(path, e))
+                    continue
+
+                products = benchmarks.make_products(options['products'])
+                latencies, rejected, exceptions, elapsed = \
+                    benchmarks.run_contention(
+                        backend, products, threads=options['threads'],
+                        operations=options['operations'],
+                        seed=options['seed'],
+                    )
+
+                leaked = {
+                    product_id: reserved for product_id, reserved in
+                    backend.get_reserved([p.id for p in products]).items()
+                    if reserved
+                }
+                backend.clear()
+
+            self.stdout.write(
+                '{:<40}{:>10.0f}{:>10.0f}{:>10.0f}{:>10}{:>8}'.format(
+                    path, len(latencies) / elapsed,
+                    percentile(latencies, 50) * 1e6,
+                    percentile(latencies, 99) * 1e6,
+                    rejected, sum(exceptions.values()),
+                )
+            )
+            for exception, count in exceptions.most_common():
+                self.stdout.write('    {} x {}'.format(count, exception))
+            if leaked:
+                errors.append('{} leaked reservations: {}'.format(
+                    path, leaked
+                ))
+
+        if errors:
+            raise CommandError('\n'.join(errors))
@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from products import ledger
+
+
+class Command(BaseCommand):
+    help = (
+        'Fold the stock movements into the snapshots of their products, or '
+        'check the ledger matches the stock of the products and the pending '
+        'orders and nothing was oversold'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--lag',
+            type=int,
+            action='store',
+            dest='lag',
+            default=None,
+            help='Age of the movements folded, in seconds, STOCK_LEDGER_LAG '
+                 'by default',
+        )
+        parser.add_argument(
+            '--check',
+            action='store_true',
+            dest='check',
+            default=False,
+            help='Only check the ledger, failing if it does not match',
+        )
+
+    def handle(self, *args, **options):
+
+        if not ledger.is_enabled():
+            raise CommandError('The ledger is not kept, see STOCK_LEDGER')
+
+        if options['check']:
+            problems = ledger.check()
+            if problems:
+                raise CommandError('\n'.join(problems))
+            self.stdout.write('The ledger matches the stock and orders')
+            return
+
+        self.stdout.write('{} snapshots compacted'.format(
+            ledger.compact(options['lag'])
+        ))
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from products import stock
+
+
+class Command(BaseCommand):
+    help = (
+        'Decrement the stock sold by the orders completed with '
+        'STOCK_WRITE_BEHIND and not flushed yet, or check the amounts '
+        'reserved and sold kept by the reservation backend match the orders'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check',
+            action='store_true',
+            dest='check',
+            default=False,
+            help='Only check the reserved and sold amounts, failing if they '
+                 'do not match the orders',
+        )
+
+    def handle(self, *args, **options):
+
+        if options['check']:
+            problems = stock.check()
+            if problems:
+                raise CommandError('\n'.join(problems))
+            self.stdout.write('Reserved and sold amounts match the orders')
+            return
+
+        self.stdout.write('{} orders flushed'.format(stock.flush_all()))
@@ -0,0 +1,66 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from products import ledger, loadtest
+from products.management.environment import throwaway_environment
+from products.models import Product
+
+
+class Command(BaseCommand):
+    help = (
+        'Run concurrent clients through the index, new orders and payments, '
+        'reporting the throughput and latencies of each step and checking '
+        'nothing is oversold. It runs on a throwaway test database and its '
+        'own cache keys, use the settings of the database and cache to test '
+        '(e.g. mums.settings.test for sqlite and the local memory cache)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('-c', '--clients', type=int, dest='clients',
+                            default=8, help='Concurrent clients')
+        parser.add_argument('-n', '--purchases', type=int, dest='purchases',
+                            default=200, help='Purchases among all clients')
+        parser.add_argument('-p', '--products', type=int, dest='products',
+                            default=10, help='Products to buy from')
+        parser.add_argument('-s', '--stock', type=int, dest='stock',
+                            default=100, help='Initial stock of each product')
+        parser.add_argument('--seed', type=int, dest='seed', default=None,
+                            help='Seed of the random orders')
+
+    def handle(self, *args, **options):
+
+        with throwaway_environment('load_test', threads=True):
+            product_ids = self.create_products(options)
+
+            stats, elapsed = loadtest.run(
+                product_ids,
+                clients=options['clients'],
+                purchases=options['purchases'],
+                seed=options['seed'],
+            )
+
+            for line in loadtest.report(stats, elapsed):
+                self.stdout.write(line)
+
+            problems = loadtest.check(product_ids, options['stock'])
+            if ledger.is_enabled():
+                problems += ledger.check(product_ids)
+
+        if problems:
+            raise CommandError('\n'.join(problems))
+
+        self.stdout.write('No stock oversold nor reservation leaked')
+
+    def create_products(self, options):
+        """ Create the products to buy from, returns their ids """
+        categories = [choice[0] for choice in Product.CATEGORY_CHOICES]
+
+        return [
+            Product.objects.create(
+                name='Load test {}'.format(i),
+                price=1,
+                category=categories[i % len(categories)],
+                unitary=True,
+                stock=options['stock'],
+            ).id
+            for i in range(options['products'])
+        ]
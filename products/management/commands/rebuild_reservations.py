@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from products import reservations, stock
+
+
+class Command(BaseCommand):
+    help = (
+        'Rebuild the amounts reserved and sold of every product, kept by the '
+        'reservation backend, out of the pending orders and the ones whose '
+        'stock is pending, with a single query and a single write, and track '
+        'the pending orders again so they expire. '
+        'Reservations made meanwhile are lost, run it while no orders are '
+        'placed unless only the lost ones are rebuilt (--if-lost)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check',
+            action='store_true',
+            dest='check',
+            default=False,
+            help='Only report the amounts that do not match the orders, '
+                 'failing if any',
+        )
+        parser.add_argument(
+            '--if-lost',
+            action='store_true',
+            dest='if_lost',
+            default=False,
+            help='Only rebuild them if the backend has lost them, as done on '
+                 'the start of every process',
+        )
+
+    def handle(self, *args, **options):
+
+        if options['check']:
+            problems = stock.check()
+            if problems:
+                raise CommandError('\n'.join(problems))
+            self.stdout.write('Reserved and sold amounts match the orders')
+            return
+
+        if options['if_lost']:
+            if reservations.warm_start(stock.get_state):
+                self.stdout.write('Lost reservations rebuilt')
+            else:
+                self.stdout.write('No reservations lost')
+            return
+
+        self.stdout.write('Reservations of {} products rebuilt'.format(
+            stock.rebuild()
+        ))
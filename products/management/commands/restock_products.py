@@ -1,10 +1,22 @@
-from django.core.management.base import BaseCommand
+import csv
+import json
+import sys
+from itertools import islice
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Case, IntegerField, Value, When
 
-from products.models import Product
+from products import catalog, ledger, reservations, stock
+from products.models import Product, StockMovement
 
 
 class Command(BaseCommand):
-    help = 'Restock all products with the given quantity'
+    help = (
+        'Restock all products with the given quantity, or each product with '
+        'its own quantity read from a CSV (with a "product,quantity" header) '
+        'or JSONL ({"product": 1, "quantity": 10} per line) file. Quantities '
+        'are units, or portions of 100 gr for products not sold by units'
+    )
 
     def add_arguments(self, parser):
         parser.add_argument(
@@ -16,12 +28,157 @@ class Command(BaseCommand):
             default=10,
             help='Quantity to stock',
         )
+        parser.add_argument(
+            '-f',
+            '--file',
+            action='store',
+            dest='file',
+            default=None,
+            help='CSV or JSONL file with the quantity of each product, - for '
+                 'the standard input',
+        )
+        parser.add_argument(
+            '--format',
+            action='store',
+            dest='format',
+            choices=['csv', 'jsonl'],
+            default=None,
+            help='Format of the file, guessed from its extension by default',
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            action='store',
+            dest='chunk_size',
+            default=1000,
+            help='Products updated by each query',
+        )
 
     def handle(self, *args, **options):
 
-        for product in Product.objects.all():
-            if product.unitary:
-                product.stock = options['quantity']
+        if stock.is_write_behind():
+            # Units sold but not flushed yet would be taken off the new stock
+            stock.flush_all()
+
+        with transaction.atomic():
+            if options['file']:
+                updated = self.restock_from_file(options)
             else:
-                product.stock = options['quantity'] * 100
-            product.save()
+                updated = self.restock_all(options['quantity'])
+
+            # Products are updated in bulk, no signal tells the catalog
+            catalog.bump_version_on_commit()
+
+        self.stdout.write('{} products restocked'.format(updated))
+
+    def restock_all(self, quantity):
+        """ Set the same quantity for every product """
+        products = list(Product.objects.select_for_update()
+                        .values_list('id', 'stock', 'unitary'))
+
+        updated = Product.objects.update(stock=self.stock_expression(
+            Value(quantity, output_field=IntegerField())
+        ))
+
+        self.record_movements(products, {
+            product_id: quantity for product_id, _, _ in products
+        })
+        return updated
+
+    def restock_from_file(self, options):
+        """
+        Set the quantity of each product in the file, streaming it in chunks
+        of chunk_size products, each one applied with a single UPDATE
+        """
+        path = options['file']
+        file_format = options['format'] or \
+            ('jsonl' if path.endswith(('.jsonl', '.json')) else 'csv')
+
+        if path == '-':
+            return self.restock_rows(self.read_rows(sys.stdin, file_format),
+                                     options['chunk_size'])
+
+        with open(path) as stream:
+            return self.restock_rows(self.read_rows(stream, file_format),
+                                     options['chunk_size'])
+
+    def read_rows(self, stream, file_format):
+        """ Lazily yield the (product id, quantity) rows of the stream """
+        if file_format == 'csv':
+            rows = csv.DictReader(stream)
+        else:
+            rows = (line for line in stream if line.strip())
+
+        for line, row in enumerate(rows, start=1):
+            try:
+                if file_format == 'jsonl':
+                    row = json.loads(row)
+                yield int(row['product']), int(row['quantity'])
+            except (KeyError, TypeError, ValueError):
+                raise CommandError('Invalid row {}: {}'.format(line, row))
+
+    def restock_rows(self, rows, chunk_size):
+        """
+        Apply the rows in chunks, each one with a single UPDATE (and its
+        movements), returns the number of products updated
+        """
+        updated = 0
+        missing = 0
+
+        while True:
+            chunk = dict(islice(rows, chunk_size))
+            if not chunk:
+                break
+
+            products = list(
+                Product.objects.select_for_update().filter(pk__in=chunk)
+                .values_list('id', 'stock', 'unitary')
+            )
+
+            chunk_updated = Product.objects.filter(pk__in=chunk).update(
+                stock=self.stock_expression(Case(
+                    *[When(pk=product_id, then=Value(quantity))
+                      for product_id, quantity in chunk.items()],
+                    output_field=IntegerField()
+                ))
+            )
+            self.record_movements(products, chunk)
+            updated += chunk_updated
+            missing += len(chunk) - chunk_updated
+
+        if missing:
+            self.stderr.write('{} products not found'.format(missing))
+
+        return updated
+
+    def record_movements(self, products, quantities):
+        """
+        Record the restock of each of the (id, stock, unitary) products to its
+        quantity in the ledger, with a single query, and add it to the stock
+        kept along with the reservations once committed
+        """
+        changes = [
+            (product_id,
+             quantities[product_id] * (1 if unitary else 100) - stock)
+            for product_id, stock, unitary in products
+        ]
+
+        ledger.record([
+            (StockMovement.KIND_RESTOCK, None, product_id, change)
+            for product_id, change in changes
+        ])
+
+        lines = [(Product(pk=product_id), change)
+                 for product_id, change in changes]
+        transaction.on_commit(lambda: reservations.restock(lines))
+
+    def stock_expression(self, quantity):
+        """
+        Stock for the quantity, products not sold by units are stocked in
+        grams
+        """
+        return quantity * Case(
+            When(unitary=True, then=Value(1)),
+            default=Value(100),
+            output_field=IntegerField()
+        )
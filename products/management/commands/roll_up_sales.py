@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from products import rollups
+
+
+class Command(BaseCommand):
+    help = (
+        'Add the sales made since the last run to the hourly and daily sales '
+        'rollups'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--lag',
+            type=int,
+            action='store',
+            dest='lag',
+            default=None,
+            help='Age of the sales rolled up, in seconds, STOCK_LEDGER_LAG by '
+                 'default',
+        )
+
+    def handle(self, *args, **options):
+
+        self.stdout.write('{} sales rolled up'.format(
+            rollups.roll_up_all(options['lag'])
+        ))
@@ -0,0 +1,55 @@
+"""
+Helpers of the management commands.
+
+They pull in django's test utilities, so they are kept apart from the modules
+imported when serving requests.
+"""
+import os
+import tempfile
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import connection
+from django.test.utils import override_settings, setup_test_environment, \
+    teardown_test_environment
+
+
+@contextmanager
+def throwaway_environment(name, threads=False):
+    """
+    Run the app on a throwaway test database and with its own cache keys, as
+    the commands measuring it do not want to touch the data in use. The
+    debug toolbar is left out, so it is not measured along with the app.
+    An in memory sqlite database can not take the writes of many threads, so
+    with threads it is kept in a temporary file instead
+    """
+    setup_test_environment()
+
+    old_name = connection.settings_dict['NAME']
+    test_settings = connection.settings_dict.setdefault('TEST', {})
+    old_test_name = test_settings.get('NAME')
+    if threads and connection.vendor == 'sqlite':
+        if not old_test_name or old_test_name == ':memory:':
+            fd, test_settings['NAME'] = tempfile.mkstemp(suffix='.sqlite3')
+            os.close(fd)
+
+    connection.creation.create_test_db(verbosity=0, autoclobber=True,
+                                       serialize=False)
+
+    caches = {
+        alias: dict(cache_settings,
+                    KEY_PREFIX='{}_{}'.format(name, os.getpid()))
+        for alias, cache_settings in settings.CACHES.items()
+    }
+    middleware = [
+        middleware for middleware in settings.MIDDLEWARE
+        if not middleware.startswith('debug_toolbar.')
+    ]
+
+    try:
+        with override_settings(DEBUG=False, CACHES=caches,
+                               MIDDLEWARE=middleware):
+            yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        test_settings['NAME'] = old_test_name
+        teardown_test_environment()
@@ -0,0 +1,315 @@
+"""
+Request metrics in the Prometheus format.
+
+The MetricsMiddleware measures every request: its latency, the number and
+time of its database queries, the number and time of its cache calls (either
+through django's cache or the raw redis client) and the number of celery
+tasks it publishes. They are kept as histograms by endpoint (view or API
+resource) and method in this very process, and served in the Prometheus text
+format by the metrics view.
+
+Methods other than the standard ones are labelled as "other", and endpoints
+are the names of the views, so clients can not make up new series. The
+metrics are only served to the METRICS_ALLOWED_NETWORKS and to the staff.
+
+The database cursor, the cache and the redis client are wrapped only once,
+and the wrappers just add to the counters of the request being handled in
+the current thread, if any, so the overhead is a couple of clock reads per
+call.
+"""
+import functools
+import ipaddress
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from celery.signals import after_task_publish
+from django.conf import settings
+from django.core.cache import caches
+from django.db.backends.utils import CursorWrapper
+
+
+TIME_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+                10)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+# Name, help, buckets and the value observed for each request out of its
+# collector
+METRICS = (
+    ('mums_request_duration_seconds', 'Latency of the requests',
+     TIME_BUCKETS, lambda collector: collector.duration),
+    ('mums_db_queries', 'Database queries by request',
+     COUNT_BUCKETS, lambda collector: collector.counts['db']),
+    ('mums_db_duration_seconds', 'Time spent in database queries by request',
+     TIME_BUCKETS, lambda collector: collector.times['db']),
+    ('mums_cache_calls', 'Cache calls by request',
+     COUNT_BUCKETS, lambda collector: collector.counts['cache']),
+    ('mums_cache_duration_seconds', 'Time spent in cache calls by request',
+     TIME_BUCKETS, lambda collector: collector.times['cache']),
+    ('mums_celery_publishes', 'Celery tasks published by request',
+     COUNT_BUCKETS, lambda collector: collector.counts['celery']),
+)
+
+# Methods labelled as they are, any other one is labelled as other
+METHODS = ('GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS')
+
+CACHE_METHODS = ('add', 'get', 'set', 'delete', 'get_many', 'has_key',
+                 'incr', 'decr', 'set_many', 'delete_many', 'clear')
+
+_local = threading.local()
+_lock = threading.Lock()
+_installed = False
+
+# Histograms by metric name and (endpoint, method) labels, each one holding
+# the count of every bucket, the sum and the count of the values observed
+_histograms = {}
+
+
+class Collector(object):
+    """ Counters of the request being handled """
+
+    def __init__(self):
+        self.counts = {'db': 0, 'cache': 0, 'celery': 0}
+        self.times = {'db': 0, 'cache': 0}
+        self.busy = set()
+        self.duration = 0
+
+
+def timed(func, kind):
+    """
+    Wrap the function to count its calls and time for the request being
+    handled. Calls made from within another call of the same kind (e.g. the
+    redis client behind the cache) are not counted twice
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        collector = getattr(_local, 'collector', None)
+        if collector is None or kind in collector.busy:
+            return func(*args, **kwargs)
+
+        collector.busy.add(kind)
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            collector.times[kind] += time.perf_counter() - start
+            collector.counts[kind] += 1
+            collector.busy.discard(kind)
+
+    wrapper.metrics_timed = True
+    return wrapper
+
+
+def wrap_methods(cls, names, kind):
+    """ Time the given methods of the class, unless they already are """
+    for name in names:
+        method = cls.__dict__.get(name)
+        if method is not None and not getattr(method, 'metrics_timed', False):
+            setattr(cls, name, timed(method, kind))
+
+
+def get_redis_classes():
+    """
+    Get the class of the redis client defining execute_command and the one of
+    the pipelines defining execute, or None without redis-py. They are looked
+    up as they changed with redis-py 3: StrictRedis and BasePipeline before,
+    Redis and Pipeline since
+    """
+    try:
+        from redis.client import Pipeline, Redis
+    except ImportError:
+        return None
+
+    return tuple(
+        next(owner for owner in cls.__mro__ if name in owner.__dict__)
+        for cls, name in ((Redis, 'execute_command'), (Pipeline, 'execute'))
+    )
+
+
+def install():
+    """ Wrap the database cursor, the caches and the redis client, once """
+    global _installed
+
+    with _lock:
+        if _installed:
+            return
+
+        wrap_methods(CursorWrapper, ('execute', 'executemany', 'callproc'),
+                     'db')
+
+        for alias in settings.CACHES:
+            for cls in type(caches[alias]).__mro__:
+                wrap_methods(cls, CACHE_METHODS, 'cache')
+
+        redis_classes = get_redis_classes()
+        if redis_classes is not None:
+            client, pipeline = redis_classes
+            wrap_methods(client, ('execute_command', ), 'cache')
+            wrap_methods(pipeline, ('execute', ), 'cache')
+
+        after_task_publish.connect(count_publish, weak=False)
+
+        _installed = True
+
+
+def count_publish(**kwargs):
+    """ Count the tasks published by the request being handled """
+    collector = getattr(_local, 'collector', None)
+    if collector is not None:
+        collector.counts['celery'] += 1
+
+
+def start():
+    """ Start collecting the metrics of a request in the current thread """
+    _local.collector = Collector()
+    return _local.collector
+
+
+def stop():
+    """ Stop collecting the metrics of the request in the current thread """
+    _local.collector = None
+
+
+@contextmanager
+def collecting():
+    """
+    Collect the metrics of a block on its own, still adding them to the ones
+    of the request being handled, if any
+    """
+    install()
+
+    outer = getattr(_local, 'collector', None)
+    collector = start()
+    try:
+        yield collector
+    finally:
+        _local.collector = outer
+        if outer is not None:
+            for kind, count in collector.counts.items():
+                outer.counts[kind] += count
+            for kind, spent in collector.times.items():
+                outer.times[kind] += spent
+
+
+def observe(endpoint, method, collector):
+    """ Add the metrics of a request to the histograms """
+    labels = (endpoint, method)
+
+    with _lock:
+        for name, _, buckets, value in METRICS:
+            histogram = _histograms.setdefault(name, {}).get(labels)
+            if histogram is None:
+                histogram = _histograms[name][labels] = \
+                    [[0] * len(buckets), 0, 0]
+
+            observed = value(collector)
+            index = bisect_left(buckets, observed)
+            if index < len(buckets):
+                histogram[0][index] += 1
+            histogram[1] += observed
+            histogram[2] += 1
+
+
+def reset():
+    """ Forget every metric observed """
+    with _lock:
+        _histograms.clear()
+
+
+def get_endpoint(request):
+    """
+    Get the name of the view or API resource handling the request, e.g.
+    index or api:order:list
+    """
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unknown'
+
+    resource = match.kwargs.get('resource_name')
+    if resource is not None:
+        return 'api:{}:{}'.format(
+            resource,
+            match.url_name.replace('api_', '').replace('dispatch_', '')
+        )
+
+    return match.url_name or match.view_name or 'unknown'
+
+
+def get_method(request):
+    """ Get the method of the request as labelled, see METHODS """
+    return request.method if request.method in METHODS else 'other'
+
+
+def can_read(request):
+    """
+    Check whether the request may read the metrics: it comes from one of the
+    METRICS_ALLOWED_NETWORKS or from a staff user
+    """
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_staff:
+        return True
+
+    try:
+        address = ipaddress.ip_address(request.META.get('REMOTE_ADDR', ''))
+    except ValueError:
+        return False
+
+    return any(
+        address in ipaddress.ip_network(network)
+        for network in settings.METRICS_ALLOWED_NETWORKS
+    )
+
+
+def render():
+    """ Render every histogram in the Prometheus text format """
+    lines = []
+
+    with _lock:
+        for name, help_text, buckets, _ in METRICS:
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} histogram'.format(name))
+
+            for (endpoint, method), (counts, total, count) in sorted(
+                    _histograms.get(name, {}).items()):
+                labels = 'endpoint="{}",method="{}"'.format(
+                    escape(endpoint), escape(method)
+                )
+
+                cumulative = 0
+                for bucket, bucket_count in zip(buckets, counts):
+                    cumulative += bucket_count
+                    lines.append('{}_bucket{{{},le="{}"}} {}'.format(
+                        name, labels, bucket, cumulative
+                    ))
+                lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(
+                    name, labels, count
+                ))
+                lines.append('{}_sum{{{}}} {}'.format(name, labels, total))
+                lines.append('{}_count{{{}}} {}'.format(name, labels, count))
+
+    return '\n'.join(lines) + '\n'
+
+
+def escape(value):
+    """ Escape a label value """
+    return value.replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+class MetricsMiddleware(object):
+    """ Measure every request, see the metrics module """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        install()
+
+    def __call__(self, request):
+        with collecting() as collector:
+            begin = time.perf_counter()
+
+            try:
+                return self.get_response(request)
+            finally:
+                collector.duration = time.perf_counter() - begin
+                observe(get_endpoint(request), get_method(request),
+                        collector)
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-18 09:36
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0009_auto_20161027_1112'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='discounts',
+            field=models.CharField(blank=True, default='', max_length=256, verbose_name='Applied discounts'),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='line_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='Number of lines'),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='total',
+            field=models.FloatField(blank=True, db_index=True, null=True, verbose_name='Total'),
+        ),
+    ]
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-18 10:14
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def open_ledger(apps, schema_editor):
+    """
+    Start the ledger of every product with its current stock (a restock),
+    the lines of the pending orders (reservations) and the ones of the orders
+    whose stock is not flushed yet (sales)
+    """
+    Product = apps.get_model('products', 'Product')
+    OrderProduct = apps.get_model('products', 'OrderProduct')
+    StockMovement = apps.get_model('products', 'StockMovement')
+
+    StockMovement.objects.bulk_create([
+        StockMovement(product_id=product_id, kind=0, quantity=stock)
+        for product_id, stock in Product.objects.exclude(stock=0)
+        .values_list('id', 'stock')
+    ] + [
+        StockMovement(product_id=product_id, order_id=order_id, kind=1,
+                      quantity=quantity)
+        for order_id, product_id, quantity in OrderProduct.objects.filter(
+            order__complete=False
+        ).values_list('order_id', 'product_id', 'quantity')
+    ] + [
+        StockMovement(product_id=product_id, order_id=order_id, kind=2,
+                      quantity=-quantity)
+        for order_id, product_id, quantity in OrderProduct.objects.filter(
+            order__stock_pending=True
+        ).values_list('order_id', 'product_id', 'quantity')
+    ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0013_order_stock_pending'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockMovement',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('order_id', models.PositiveIntegerField(blank=True, db_index=True, null=True, verbose_name='Order')),
+                ('kind', models.PositiveSmallIntegerField(choices=[(0, 'Restock'), (1, 'Reserve'), (2, 'Sell'), (3, 'Release'), (4, 'Expire')], verbose_name='Kind')),
+                ('quantity', models.IntegerField(verbose_name='Quantity')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='Creation date')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='StockSnapshot',
+            fields=[
+                ('product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='snapshot', serialize=False, to='products.Product')),
+                ('last_movement', models.PositiveIntegerField(default=0, verbose_name='Last movement')),
+                ('stock', models.IntegerField(default=0, verbose_name='Stock')),
+                ('reserved', models.IntegerField(default=0, verbose_name='Reserved')),
+                ('updated', models.DateTimeField(auto_now=True, verbose_name='Update date')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='stockmovement',
+            name='product',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='movements', to='products.Product'),
+        ),
+        migrations.AlterIndexTogether(
+            name='stockmovement',
+            index_together=set([('product', 'id')]),
+        ),
+        migrations.RunPython(open_ledger, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-18 10:24
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0014_stock_ledger'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailySales',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('category', models.PositiveSmallIntegerField(choices=[(0, 'Pricipal'), (1, 'Beverage'), (2, 'Dessert')], verbose_name='Category')),
+                ('quantity', models.IntegerField(default=0, verbose_name='Quantity')),
+                ('revenue', models.FloatField(default=0, verbose_name='Revenue')),
+                ('period', models.DateField(verbose_name='Day')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='products.Product')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='HourlySales',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('category', models.PositiveSmallIntegerField(choices=[(0, 'Pricipal'), (1, 'Beverage'), (2, 'Dessert')], verbose_name='Category')),
+                ('quantity', models.IntegerField(default=0, verbose_name='Quantity')),
+                ('revenue', models.FloatField(default=0, verbose_name='Revenue')),
+                ('period', models.DateTimeField(verbose_name='Hour')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='products.Product')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Watermark',
+            fields=[
+                ('name', models.CharField(max_length=64, primary_key=True, serialize=False, verbose_name='Name')),
+                ('last_movement', models.PositiveIntegerField(default=0, verbose_name='Last movement')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='hourlysales',
+            unique_together=set([('period', 'product')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='dailysales',
+            unique_together=set([('period', 'product')]),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-18 10:55
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0015_sales_rollups'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='order',
+            index_together=set([('created', 'id')]),
+        ),
+    ]
@@ -1,7 +1,7 @@
-from django.core.cache import cache
 from django.db import models
 from django.utils.translation import ugettext as _
-from math import floor
+
+from . import pricing, reservations
 
 
 class Product(models.Model):
@@ -27,10 +27,21 @@ class Product(models.Model):
 
     stock = models.IntegerField(_(u'Stock'), default=0)
 
+    # Reserved amount read along with the rest of the catalog, see
+    # reservations.with_reserved
+    reserved_snapshot = None
+
+    # Units added to (or taken from) the stock by the last save, for the
+    # receivers of its post_save, see save
+    stock_change = 0
+
     @property
     def reserved(self):
         """ Check the amount reserved but not yet paid using redis """
-        return cache.get(self._get_redis_key()) or 0
+        if self.reserved_snapshot is not None:
+            return self.reserved_snapshot
+
+        return reservations.get_reserved([self.id])[self.id]
 
     @property
     def real_stock(self):
@@ -43,24 +54,33 @@ class Product(models.Model):
 
     def reserve_stock(self, quantity):
         """ Mark quantity as reserved but not yet paid """
-        if not isinstance(quantity, int) or not self.enough_stock(quantity):
-            raise ValueError('Not enough stock')
+        self.reserved_snapshot = None
+        reservations.reserve([(self, quantity)])
 
-        try:
-            cache.incr(self._get_redis_key(), quantity)
-        except ValueError:
-            cache.set(self._get_redis_key(), quantity)
+    def save(self, *args, **kwargs):
+        """
+        Save the product, keeping how much its stock changed, as read right
+        before, in stock_change
+        """
+        update_fields = kwargs.get('update_fields')
+        if self._state.adding:
+            self.stock_change = self.stock
+        elif update_fields is None or 'stock' in update_fields:
+            saved = Product.objects.filter(pk=self.pk) \
+                .values_list('stock', flat=True).first()
+            self.stock_change = self.stock - (saved or 0)
+        else:
+            self.stock_change = 0
+
+        super(Product, self).save(*args, **kwargs)
 
     def release_stock(self, quantity):
         """ Mark quantity as no longed reserved """
+        self.reserved_snapshot = None
         if not isinstance(quantity, int) or quantity > self.reserved:
             raise ValueError('Not that much stock is reserved')
 
-        cache.decr(self._get_redis_key(), quantity)
-
-    def _get_redis_key(self):
-        """ Get redis unique product token """
-        return 'product_#{}'.format(self.id)
+        reservations.release([(self, quantity)])
 
 
 class Order(models.Model):
@@ -70,45 +90,180 @@ class Order(models.Model):
 
     complete = models.BooleanField(_(u'Is complete'), default=False)
 
+    # Complete but its stock not decremented yet, see the stock module
+    stock_pending = models.BooleanField(_(u'Is stock pending'), default=False,
+                                        db_index=True)
+
     products = models.ManyToManyField(Product, through='OrderProduct',
                                       related_name='order_products')
 
+    # Price of the order, fixed when it is created, see set_quote
+    total = models.FloatField(_(u'Total'), null=True, blank=True,
+                              db_index=True)
+
+    line_count = models.PositiveIntegerField(_(u'Number of lines'), default=0)
+
+    discounts = models.CharField(_(u'Applied discounts'), max_length=256,
+                                 blank=True, default='')
+
+    # Promotions applied to every order:
+    #   - 3x2 offer: Get 3 pay 2 (only on unitary products)
+    #   - Full menu: Get 20% off when buying products from every category
+    pricing_engine = pricing.PricingEngine(
+        line_rules=[pricing.ThreeForTwo()],
+        cart_rules=[pricing.FullMenu(
+            [choice[0] for choice in Product.CATEGORY_CHOICES], 0.8
+        )],
+    )
+
+    def get_lines(self):
+        """ Get the (product, quantity) lines of the order with one query """
+        return [
+            (order_product.product, order_product.quantity)
+            for order_product in self.orderproduct_set.select_related(
+                'product'
+            )
+        ]
+
+    def set_quote(self, quote):
+        """ Keep the price of the order, as quoted by the pricing engine """
+        self.total = quote.total
+        self.line_count = quote.lines
+        self.discounts = ','.join(quote.discounts)
+
     def price(self):
         """
         Gets the total price of an order taking into consideration the price
         scheme of each product (unitary or not) as well as applying the
-        appropiate discounts:
-            - 3x2 offer: Get 3 pay 2 (only on unitary products)
-            - Full menu: Get 20% off when buying products from every category
+        appropiate discounts, see pricing_engine
         """
-        total_price = 0
+        return self.pricing_engine.quote(self.get_lines()).total
+
+    class Meta:
+        # The orders after (or before) a cursor, see OrderCursorPaginator
+        index_together = [('created', 'id')]
 
-        order_categories = set()
 
-        for order_product in self.orderproduct_set.all():
-            price = order_product.product.price
-            quantity = order_product.quantity
+class OrderProduct(models.Model):
+    order = models.ForeignKey(Order)
 
-            order_categories.add(order_product.product.category)
+    product = models.ForeignKey(Product)
 
-            if not order_product.product.unitary:
-                quantity /= 100  # Price scheme is by €/100gr
-            else:
-                # Apply discount for 3x2 promotion on unitary products
-                quantity -= floor(quantity / 3)
+    quantity = models.PositiveIntegerField(_(u'Quantity'))
 
-            total_price += price * quantity
 
-        # Apply discount for full_menu (20%)
-        if len(order_categories) == len(Product.CATEGORY_CHOICES):
-            total_price *= 0.8
+class Reservation(models.Model):
+    """ Amount reserved of a product, see reservations.DatabaseBackend """
 
-        return total_price
+    product = models.OneToOneField(Product, primary_key=True,
+                                   related_name='reservation')
 
+    quantity = models.IntegerField(_(u'Quantity'), default=0)
 
-class OrderProduct(models.Model):
-    order = models.ForeignKey(Order)
 
-    product = models.ForeignKey(Product)
+class StockMovement(models.Model):
+    """
+    Change of the stock or of the amount reserved of a product, movements are
+    only ever inserted, see the ledger module
+    """
 
-    quantity = models.PositiveIntegerField(_(u'Quantity'))
+    KIND_RESTOCK = 0
+    KIND_RESERVE = 1
+    KIND_SELL = 2
+    KIND_RELEASE = 3
+    KIND_EXPIRE = 4
+
+    KIND_CHOICES = (
+        (KIND_RESTOCK, _('Restock')),
+        (KIND_RESERVE, _('Reserve')),
+        (KIND_SELL, _('Sell')),
+        (KIND_RELEASE, _('Release')),
+        (KIND_EXPIRE, _('Expire')),
+    )
+
+    product = models.ForeignKey(Product, related_name='movements')
+
+    # Not a foreign key, the movements of the orders expired (and deleted)
+    # are kept
+    order_id = models.PositiveIntegerField(_(u'Order'), null=True,
+                                           blank=True, db_index=True)
+
+    kind = models.PositiveSmallIntegerField(_(u'Kind'), choices=KIND_CHOICES)
+
+    # Units added to (or taken from, if negative) the stock, for restocks and
+    # sales, or to the amount reserved otherwise
+    quantity = models.IntegerField(_(u'Quantity'))
+
+    created = models.DateTimeField(_(u'Creation date'), auto_now_add=True)
+
+    class Meta:
+        # The movements of a product after its snapshot
+        index_together = [('product', 'id')]
+
+
+class StockSnapshot(models.Model):
+    """
+    Stock and amount reserved of a product as of one of its movements, see
+    ledger.compact
+    """
+
+    product = models.OneToOneField(Product, primary_key=True,
+                                   related_name='snapshot')
+
+    # Id of the last movement folded into the snapshot
+    last_movement = models.PositiveIntegerField(_(u'Last movement'),
+                                                default=0)
+
+    stock = models.IntegerField(_(u'Stock'), default=0)
+
+    reserved = models.IntegerField(_(u'Reserved'), default=0)
+
+    updated = models.DateTimeField(_(u'Update date'), auto_now=True)
+
+
+class SalesRollup(models.Model):
+    """
+    Units sold of a product and their revenue within a period, see the
+    rollups module
+    """
+
+    product = models.ForeignKey(Product, related_name='+')
+
+    # Category of the product, to sum the revenue by category without joining
+    # the products
+    category = models.PositiveSmallIntegerField(
+        _(u'Category'), choices=Product.CATEGORY_CHOICES
+    )
+
+    quantity = models.IntegerField(_(u'Quantity'), default=0)
+
+    revenue = models.FloatField(_(u'Revenue'), default=0)
+
+    class Meta:
+        abstract = True
+
+
+class HourlySales(SalesRollup):
+
+    # Start of the hour
+    period = models.DateTimeField(_(u'Hour'))
+
+    class Meta:
+        unique_together = [('period', 'product')]
+
+
+class DailySales(SalesRollup):
+
+    period = models.DateField(_(u'Day'))
+
+    class Meta:
+        unique_together = [('period', 'product')]
+
+
+class Watermark(models.Model):
+    """ Last stock movement taken by a batch job, see rollups.roll_up """
+
+    name = models.CharField(_(u'Name'), max_length=64, primary_key=True)
+
+    last_movement = models.PositiveIntegerField(_(u'Last movement'),
+                                                default=0)
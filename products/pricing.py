@@ -0,0 +1,139 @@
+"""
+Pricing of orders and carts.
+
+The promotions are plain rules handed to a PricingEngine, which compiles them
+once into the few numbers needed to price a line or a cart, so pricing is
+just arithmetic over the (product, quantity) lines already in memory: no
+query is made and many carts can be priced in a single pass.
+
+Line rules change the quantity charged for a line (e.g. 3x2) while cart rules
+change the total of the whole cart (e.g. the full menu discount).
+"""
+from collections import namedtuple
+
+
+# Total price of a cart, its number of lines and the names of the promotions
+# applied to it
+Quote = namedtuple('Quote', ['total', 'lines', 'discounts'])
+
+
+class ThreeForTwo(object):
+    """ Get 3 pay 2, only on unitary products """
+
+    name = '3x2'
+
+    def applies(self, product):
+        return product.unitary
+
+    def chargeable(self, quantity):
+        return quantity - quantity // 3
+
+
+class FullMenu(object):
+    """ Discount on carts with products from every one of the categories """
+
+    name = 'full_menu'
+
+    def __init__(self, categories, factor):
+        self.categories = categories
+        self.factor = factor
+
+
+class PricingEngine(object):
+
+    def __init__(self, line_rules=(), cart_rules=()):
+        self.line_rules = list(line_rules)
+
+        # Categories are compiled into bit masks, a cart rule applies when the
+        # mask of the categories in the cart covers the one of the rule
+        self.cart_rules = [
+            (self.get_category_mask(rule.categories), rule.factor, rule.name)
+            for rule in cart_rules
+        ]
+
+    def get_category_mask(self, categories):
+        """ Get the bit mask of a group of categories """
+        mask = 0
+        for category in categories:
+            mask |= 1 << category
+
+        return mask
+
+    def compile_product(self, product):
+        """
+        Get everything needed to price the lines of the product: its price per
+        unit, the unit size (products not sold by units are priced by 100 gr),
+        its category bit and the line rules applying to it
+        """
+        return (
+            product.price,
+            1 if product.unitary else 100,
+            1 << product.category,
+            [rule for rule in self.line_rules if rule.applies(product)],
+        )
+
+    def quote(self, lines):
+        """ Price a single cart made of (product, quantity) lines """
+        return self.quote_many([lines])[0]
+
+    def quote_many(self, carts):
+        """
+        Price many carts, each one made of (product, quantity) lines, in a
+        single pass. Every product is compiled once no matter how many carts
+        or lines it is in
+        """
+        compiled = {}
+        quotes = []
+
+        for lines in carts:
+            total = 0
+            count = 0
+            mask = 0
+            discounts = []
+
+            for product, quantity in lines:
+                if product.pk not in compiled:
+                    compiled[product.pk] = self.compile_product(product)
+                price, unit, category, rules = compiled[product.pk]
+
+                charged = quantity
+                for rule in rules:
+                    discounted = rule.chargeable(charged)
+                    if discounted < charged and rule.name not in discounts:
+                        discounts.append(rule.name)
+                    charged = discounted
+
+                if unit != 1:
+                    charged /= unit
+
+                total += price * charged
+                count += 1
+                mask |= category
+
+            for rule_mask, factor, name in self.cart_rules:
+                if mask & rule_mask == rule_mask:
+                    total *= factor
+                    discounts.append(name)
+
+            quotes.append(Quote(total, count, discounts))
+
+        return quotes
+
+    def price_lines(self, lines):
+        """
+        Price each one of the (product, quantity) lines of a cart on its own,
+        without the cart rules. Those change every line by the same factor, so
+        each line is still the same share of the cart total
+        """
+        prices = []
+
+        for product, quantity in lines:
+            price, unit, _, rules = self.compile_product(product)
+
+            charged = quantity
+            for rule in rules:
+                charged = rule.chargeable(charged)
+
+            prices.append(price * charged / unit)
+
+        return prices
@@ -0,0 +1,1148 @@
+"""
+Stock reservations for pending orders.
+
+Reserving the lines of an order (or of a batch of orders) is done in a single
+step: for each order either every line is reserved or none of them is, and no
+other buyer can sneak in between the check and the increment.
+
+The units sold whose stock has not been decremented yet (see the stock
+module) are kept along with the reservations, and they are not available
+either: the amount "reserved" of a product includes them.
+
+Both can be rebuilt out of the orders (see the stock module), which every
+process does on its start if the backend has lost them, see warm_start. The
+redis backends claim the rebuild of a node before reading the orders, and
+until the node is rebuilt its reservations wait for it, while the rest of its
+changes are dropped: they follow changes of the orders already committed,
+which the rebuild reads, or to be committed soon, and those are never left
+available (see MOVE_SCRIPT).
+
+The redis backends keep the stock of every product too, so reservations are
+checked against the stock as of the very same moment as the amounts reserved
+and sold, not against the one of the product given, which may have been read
+before an order was paid or flushed. Every change of the stock is applied to
+the one kept along with the counts it moves, in the same step: the sales
+along with the reservations they consume or the units sold they forget (see
+consume and forget_sold), and restocks once committed (see restock). The
+stock of the products kept by none (e.g. created while the counts were
+rebuilt) is taken from the product given until the next rebuild.
+
+Where and how the reservations are kept is up to the RESERVATION_BACKEND:
+
+    - RedisBackend: in redis, so every web process and worker share the same
+      view of them. All of them live in a single hash, keyed by product id, so
+      the reservations of the whole catalog can be read in one round trip,
+      and they are checked and reserved by a server side script.
+    - RedisRingBackend: the same, spread over several redis nodes by
+      consistent hashing of the products, so neither the throughput nor the
+      failures of a single node limit the reservations of the whole catalog.
+    - DatabaseBackend: in a table of the database, for the sites not running
+      redis. The rows of the products reserved are locked while checking and
+      reserving them.
+    - LocalBackend: in the local memory cache of this very process, guarded by
+      a process wide lock. Only for a single process, e.g. tests.
+"""
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.db import connection, transaction
+from django.db.models import Case, F, IntegerField, When
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from .utils import HashRing, get_redis_client
+
+
+# Hashes with the amount reserved, the amount sold (not yet taken out of the
+# stock, see the stock module) and the stock of every product. They share a
+# hash tag, so a redis cluster keeps them in the same slot and a script can
+# use all of them
+RESERVED_KEY = '{products}_reserved'
+SOLD_KEY = '{products}_sold'
+STOCK_KEY = '{products}_stock'
+
+# Set along with the counts rebuilt from the orders, a node without it has
+# lost them (or never had them rebuilt), see warm_start. While they are
+# rebuilt it holds REBUILDING followed by the token of the process rebuilding
+# them, see claim_rebuild_on
+BUILT_KEY = '{products}_reserved_built'
+BUILT = 'built'
+REBUILDING = 'rebuilding'
+
+# Longest a rebuild of the counts of a node is expected to take, others wait
+# for it that long before taking over
+REBUILD_TIMEOUT = 60
+
+# Seconds between the checks of a reservation waiting for a rebuild
+REBUILD_POLL = 0.05
+
+# Reserves the lines of one or more orders. For each order every one of its
+# lines is checked against the units reserved and sold of its product and,
+# only if all of them fit in the stock kept (or the one given, if none is
+# kept), they are reserved. Orders are handled one after the other, so the
+# ones coming later see the stock reserved by the previous ones. Returns a
+# list with 1 for each order reserved and 0 for each one without enough stock,
+# or -1 without reserving anything while the counts are rebuilt.
+#   KEYS: hashes with the reserved amount, the sold amount and the stock of
+#       every product, BUILT_KEY
+#   ARGV: lines_1, product_1, stock_1, quantity_1, product_2, ..., lines_2, ...
+RESERVE_SCRIPT = """
+local built = redis.call('GET', KEYS[4])
+if built and string.sub(built, 1, 10) == 'rebuilding' then
+    return -1
+end
+local results = {}
+local i = 1
+while i <= #ARGV do
+    local first = i + 1
+    local last = i + tonumber(ARGV[i]) * 3
+    local fits = 1
+    for j = first, last, 3 do
+        local taken = tonumber(redis.call('HGET', KEYS[1], ARGV[j]) or '0') +
+            tonumber(redis.call('HGET', KEYS[2], ARGV[j]) or '0')
+        local stock = redis.call('HGET', KEYS[3], ARGV[j]) or ARGV[j + 1]
+        if taken + tonumber(ARGV[j + 2]) > tonumber(stock) then
+            fits = 0
+            break
+        end
+    end
+    if fits == 1 then
+        for j = first, last, 3 do
+            redis.call('HINCRBY', KEYS[1], ARGV[j], ARGV[j + 2])
+        end
+    end
+    results[#results + 1] = fits
+    i = last + 1
+end
+return results
+"""
+
+# Moves the amounts reserved and sold and the stock of one or more products at
+# once, so no reservation can see some of them moved and not the rest. The
+# stock is only moved for the products whose stock is kept. Nothing is moved
+# while the counts are rebuilt: moves follow changes of the orders (or of the
+# stock) already committed, either read by the rebuild or committed after it,
+# which only leaves units taken until the next rebuild (e.g. an order released
+# in the meanwhile). Returns whether they were moved.
+#   KEYS: same as RESERVE_SCRIPT
+#   ARGV: product_1, reserved_1, sold_1, stock_1, product_2, ...
+MOVE_SCRIPT = """
+local built = redis.call('GET', KEYS[4])
+if built and string.sub(built, 1, 10) == 'rebuilding' then
+    return 0
+end
+for i = 1, #ARGV, 4 do
+    if ARGV[i + 1] ~= '0' then
+        redis.call('HINCRBY', KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+    if ARGV[i + 2] ~= '0' then
+        redis.call('HINCRBY', KEYS[2], ARGV[i], ARGV[i + 2])
+    end
+    if ARGV[i + 3] ~= '0' and redis.call('HEXISTS', KEYS[3], ARGV[i]) == 1 then
+        redis.call('HINCRBY', KEYS[3], ARGV[i], ARGV[i + 3])
+    end
+end
+return 1
+"""
+
+# Claims the rebuild of the counts, unless another process is rebuilding them.
+# Returns whether they were claimed.
+#   KEYS: BUILT_KEY
+#   ARGV: token of the process rebuilding them, seconds the claim lasts
+CLAIM_SCRIPT = """
+local built = redis.call('GET', KEYS[1])
+if built and string.sub(built, 1, 10) == 'rebuilding' then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+return 1
+"""
+
+# Replaces the counts with the ones rebuilt, only if the rebuild is still
+# claimed by the process rebuilding them. Returns whether they were replaced.
+#   KEYS: same as RESERVE_SCRIPT
+#   ARGV: token of the process rebuilding them, product_1, reserved_1, sold_1,
+#       stock_1, product_2, ...
+REBUILD_SCRIPT = """
+if redis.call('GET', KEYS[4]) ~= ARGV[1] then
+    return 0
+end
+redis.call('DEL', KEYS[1], KEYS[2], KEYS[3])
+for i = 2, #ARGV, 4 do
+    if ARGV[i + 1] ~= '0' then
+        redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+    if ARGV[i + 2] ~= '0' then
+        redis.call('HSET', KEYS[2], ARGV[i], ARGV[i + 2])
+    end
+    redis.call('HSET', KEYS[3], ARGV[i], ARGV[i + 3])
+end
+redis.call('SET', KEYS[4], 'built')
+return 1
+"""
+
+_backend = None
+
+
+def get_backend():
+    """
+    Get the RESERVATION_BACKEND in use. With STOCK_WRITE_BEHIND it must keep
+    the units sold, otherwise orders would be completed without ever moving
+    their reservations to them
+    """
+    global _backend
+
+    if _backend is None:
+        backend = import_string(settings.RESERVATION_BACKEND)()
+        if getattr(settings, 'STOCK_WRITE_BEHIND', False) and \
+                not backend.keeps_sold:
+            raise ImproperlyConfigured(
+                '{} can not keep the stock sold, it can not be used with '
+                'STOCK_WRITE_BEHIND'.format(type(backend).__name__)
+            )
+        _backend = backend
+
+    return _backend
+
+
+@receiver(setting_changed)
+def reset_backend(setting, **kwargs):
+    """ Use the new backend when the settings are overridden (e.g. tests) """
+    global _backend
+
+    if setting in ('RESERVATION_BACKEND', 'RESERVATION_REDIS_NODES',
+                   'CACHES', 'STOCK_WRITE_BEHIND'):
+        _backend = None
+
+
+@receiver(post_save, sender='products.Product')
+def product_saved(sender, instance, created, raw=False, **kwargs):
+    """
+    Keep the stock of the product saved along with the reservations, once
+    committed: the one of a new product, or the change of the rest
+    """
+    if raw:
+        return
+
+    if created:
+        lines = [(instance, instance.stock)]
+        transaction.on_commit(lambda: keep_stock(lines))
+    elif instance.stock_change:
+        lines = [(instance, instance.stock_change)]
+        transaction.on_commit(lambda: restock(lines))
+
+
+def get_reserved(product_ids):
+    """
+    Get the amount reserved for each one of the given products (by id), in a
+    single call to the backend
+    """
+    product_ids = list(product_ids)
+    if not product_ids:
+        return {}
+
+    return get_backend().get_reserved(product_ids)
+
+
+def with_reserved(products):
+    """
+    Evaluate the products and attach to each one of them its reserved amount,
+    read for all of them at once, so their reserved and real stock can be
+    used without hitting the cache again
+    """
+    products = list(products)
+    reserved = get_reserved([product.id for product in products])
+
+    for product in products:
+        product.reserved_snapshot = reserved[product.id]
+
+    return products
+
+
+def reserve(lines):
+    """
+    Reserve the stock for all the given (product, quantity) lines at once.
+    If any of the products does not have enough stock nothing is reserved and
+    a ValueError is raised
+    """
+    if not reserve_many([lines])[0]:
+        raise ValueError('Not enough stock')
+
+
+def reserve_many(orders):
+    """
+    Reserve the stock for the (product, quantity) lines of many orders with a
+    single step. Each order is reserved all or nothing, in the given order.
+    Returns whether each one of the orders has been reserved
+    """
+    orders = [_group_lines(lines) for lines in orders]
+    if not orders:
+        return []
+
+    return get_backend().reserve_many(orders)
+
+
+def release(lines):
+    """
+    Release the stock reserved for all the given (product, quantity) lines
+    """
+    quantities = _group_lines(lines)
+    if not quantities:
+        return
+
+    get_backend().release(quantities)
+
+
+def consume(lines):
+    """
+    Release the reservations of the given (product, quantity) lines once
+    their units are sold and taken out of the stock, taking them out of the
+    stock kept too
+    """
+    quantities = _group_lines(lines)
+    if quantities:
+        get_backend().consume(quantities)
+
+
+def sell(lines):
+    """
+    Move the reservations of the given (product, quantity) lines to the units
+    sold whose stock has not been decremented yet, see the stock module
+    """
+    quantities = _group_lines(lines)
+    if quantities:
+        get_backend().sell(quantities)
+
+
+def forget_sold(lines):
+    """
+    Forget the units sold of the given (product, quantity) lines, once their
+    stock has been decremented, taking them out of the stock kept too
+    """
+    quantities = _group_lines(lines)
+    if quantities:
+        get_backend().forget_sold(quantities)
+
+
+def restock(lines):
+    """
+    Add the given (product, quantity) lines, negative to take them out, to
+    the stock kept by the backend, once they are added to the stock of the
+    products
+    """
+    changes = {}
+    products = {}
+    for product, quantity in lines:
+        products[product.id] = product
+        changes[product.id] = changes.get(product.id, 0) + quantity
+
+    quantities = [
+        (products[product_id], quantity)
+        for product_id, quantity in sorted(changes.items()) if quantity
+    ]
+    if quantities:
+        get_backend().restock(quantities)
+
+
+def keep_stock(lines):
+    """
+    Start keeping the given (product, stock) lines as the stock of their
+    products, unless it is kept already (e.g. new products)
+    """
+    stocks = sorted(lines, key=get_line_id)
+    if stocks:
+        get_backend().keep_stock(stocks)
+
+
+def get_counts(product_ids):
+    """
+    Get the amount reserved and the amount sold (not yet taken out of the
+    stock) of each one of the given products (by id)
+    """
+    product_ids = list(product_ids)
+    if not product_ids:
+        return {}
+
+    return get_backend().get_counts(product_ids)
+
+
+def rebuild(compute):
+    """
+    Replace the amounts reserved and sold, and the stock, of every product
+    with the (reserved, sold, stock) ones, by product id, computed by the
+    given callable, in a single step. They are computed once the rebuild is
+    claimed, so the reservations made in the meanwhile wait for it (see the
+    module documentation), but the ones made right before it whose orders are
+    not committed yet are lost: run it while no orders are placed. Returns
+    the counts computed
+    """
+    return get_backend().rebuild(compute)
+
+
+def warm_start(compute):
+    """
+    Rebuild the amounts reserved and sold with the ones computed by the given
+    callable (see rebuild), only if the backend has lost them (e.g. a redis
+    node restarted without persistence), so it is safe to run on the start of
+    every process: the counts are either kept or already lost. Returns
+    whether anything was rebuilt
+    """
+    return get_backend().warm_start(compute)
+
+
+def _group_lines(lines):
+    """
+    Validate the quantities and merge the lines referring to the same product
+    so each product is checked against its stock only once
+    """
+    products = {}
+    quantities = {}
+
+    for product, quantity in lines:
+        if not isinstance(quantity, int) or quantity < 0:
+            raise ValueError('Invalid quantity')
+
+        products[product.id] = product
+        quantities[product.id] = quantities.get(product.id, 0) + quantity
+
+    return [
+        (products[product_id], quantity)
+        for product_id, quantity in sorted(quantities.items())
+    ]
+
+
+class ReservationBackend(object):
+    """
+    Keeps the amount reserved of every product, and the amount sold whose
+    stock has not been decremented yet. Lines reach the backend already
+    validated and grouped by product, sorted by product id
+    """
+
+    # Whether the units sold can be kept, see sell
+    keeps_sold = True
+
+    def get_reserved(self, product_ids):
+        """
+        Get the amount not available of each one of the products (by id),
+        reserved or sold
+        """
+        raise NotImplementedError
+
+    def get_counts(self, product_ids):
+        """ Get the (reserved, sold) amounts of each one of the products """
+        raise NotImplementedError
+
+    def reserve_many(self, orders):
+        """
+        Reserve the (product, quantity) lines of each order, all or nothing
+        and one order after the other. Returns whether each one of the orders
+        has been reserved
+        """
+        raise NotImplementedError
+
+    def release(self, quantities):
+        """ Release the given (product, quantity) reservations """
+        raise NotImplementedError
+
+    def consume(self, quantities):
+        """
+        Release the given (product, quantity) reservations, taking them out of
+        the stock kept. Nothing is kept by default, so they are just released
+        """
+        self.release(quantities)
+
+    def sell(self, quantities):
+        """ Move the given (product, quantity) reservations to the sold """
+        raise NotImplementedError(
+            '{} can not keep the stock sold'.format(type(self).__name__)
+        )
+
+    def forget_sold(self, quantities):
+        """
+        Forget the given (product, quantity) units sold, taking them out of
+        the stock kept
+        """
+        raise NotImplementedError(
+            '{} can not keep the stock sold'.format(type(self).__name__)
+        )
+
+    def restock(self, quantities):
+        """
+        Add the given (product, quantity) units to the stock kept. Nothing is
+        kept by default, the stock of the products is used instead
+        """
+
+    def keep_stock(self, quantities):
+        """
+        Start keeping the given (product, stock) stocks, if not kept already
+        """
+
+    def rebuild(self, compute):
+        """
+        Replace every count with the (reserved, sold, stock) ones computed by
+        the callable, the stock is only kept by some backends. Returns the
+        counts computed
+        """
+        raise NotImplementedError
+
+    def warm_start(self, compute):
+        """
+        Rebuild the counts with the ones computed by the callable if they have
+        been lost, returns whether they were. Nothing is lost by default
+        """
+        return False
+
+    def clear(self):
+        """ Forget every reservation """
+        raise NotImplementedError
+
+
+class RedisBackend(ReservationBackend):
+    """ Reservations kept in redis, see the module documentation """
+
+    def __init__(self):
+        if get_redis_client() is None:
+            raise ImproperlyConfigured(
+                'The redis reservation backend needs a redis cache'
+            )
+
+    def get_keys(self):
+        """ Get the keys of the reserved, sold and stock hashes """
+        return [cache.make_key(RESERVED_KEY), cache.make_key(SOLD_KEY),
+                cache.make_key(STOCK_KEY)]
+
+    def get_script_keys(self):
+        """ Get the keys of the hashes and BUILT_KEY, for the scripts """
+        return self.get_keys() + [cache.make_key(BUILT_KEY)]
+
+    def get_reserved(self, product_ids):
+        return self.get_reserved_on(get_redis_client(), product_ids)
+
+    def reserve_many(self, orders):
+        return self.reserve_on(get_redis_client(), orders)
+
+    def release(self, quantities):
+        self.release_on(get_redis_client(), quantities)
+
+    def get_counts(self, product_ids):
+        return self.get_counts_on(get_redis_client(), product_ids)
+
+    def consume(self, quantities):
+        self.consume_on(get_redis_client(), quantities)
+
+    def sell(self, quantities):
+        self.sell_on(get_redis_client(), quantities)
+
+    def forget_sold(self, quantities):
+        self.forget_sold_on(get_redis_client(), quantities)
+
+    def restock(self, quantities):
+        self.restock_on(get_redis_client(), quantities)
+
+    def keep_stock(self, quantities):
+        self.keep_stock_on(get_redis_client(), quantities)
+
+    def rebuild(self, compute):
+        client = get_redis_client()
+        token = self.wait_rebuild_on(client)
+
+        counts = compute()
+        self.rebuild_on(client, token, counts)
+        return counts
+
+    def warm_start(self, compute):
+        client = get_redis_client()
+        token = self.claim_rebuild_on(client, lost=True)
+        if token is None:
+            return False
+
+        return self.rebuild_on(client, token, compute())
+
+    def clear(self):
+        self.clear_on(get_redis_client())
+
+    def get_reserved_on(self, client, product_ids):
+        """ Get the amount not available of the products kept in a node """
+        return {
+            product_id: reserved + sold for product_id, (reserved, sold)
+            in self.get_counts_on(client, product_ids).items()
+        }
+
+    def get_counts_on(self, client, product_ids):
+        """
+        Get the amounts reserved and sold of the products kept in a redis
+        node, in a single round trip
+        """
+        pipe = client.pipeline(transaction=True)
+        pipe.hmget(cache.make_key(RESERVED_KEY), product_ids)
+        pipe.hmget(cache.make_key(SOLD_KEY), product_ids)
+        reserved, sold = pipe.execute()
+
+        return {
+            product_id: (int(product_reserved or 0), int(product_sold or 0))
+            for product_id, product_reserved, product_sold
+            in zip(product_ids, reserved, sold)
+        }
+
+    def reserve_on(self, client, orders):
+        """
+        Reserve the lines of the orders kept in a redis node, once it is not
+        being rebuilt
+        """
+        args = []
+        for quantities in orders:
+            args.append(len(quantities))
+            for product, quantity in quantities:
+                args.extend([product.id, product.stock, quantity])
+
+        script = client.register_script(RESERVE_SCRIPT)
+        while True:
+            results = script(keys=self.get_script_keys(), args=args)
+            if results != -1:
+                return [bool(fits) for fits in results]
+
+            # The claim of a rebuild expires, even if its process dies
+            time.sleep(REBUILD_POLL)
+
+    def move_on(self, client, moves):
+        """
+        Move the counts kept in a redis node by the given (product, reserved,
+        sold, stock) amounts, in a single step, see MOVE_SCRIPT
+        """
+        args = []
+        for move in moves:
+            args.extend([move[0].id] + list(move[1:]))
+
+        script = client.register_script(MOVE_SCRIPT)
+        return bool(script(keys=self.get_script_keys(), args=args))
+
+    def release_on(self, client, quantities):
+        """ Release the reservations kept in a redis node """
+        self.move_on(client, [
+            (product, -quantity, 0, 0) for product, quantity in quantities
+        ])
+
+    def consume_on(self, client, quantities):
+        """
+        Release the reservations kept in a redis node, taking them out of its
+        stock in the same step
+        """
+        self.move_on(client, [
+            (product, -quantity, 0, -quantity)
+            for product, quantity in quantities
+        ])
+
+    def sell_on(self, client, quantities):
+        """
+        Move the reservations kept in a redis node to the sold, in a single
+        step so they are taken out of the available stock all the time
+        """
+        self.move_on(client, [
+            (product, -quantity, quantity, 0)
+            for product, quantity in quantities
+        ])
+
+    def forget_sold_on(self, client, quantities):
+        """
+        Forget the units sold kept in a redis node, taking them out of its
+        stock in the same step
+        """
+        self.move_on(client, [
+            (product, 0, -quantity, -quantity)
+            for product, quantity in quantities
+        ])
+
+    def restock_on(self, client, quantities):
+        """ Add the units to the stock kept in a redis node """
+        self.move_on(client, [
+            (product, 0, 0, quantity) for product, quantity in quantities
+        ])
+
+    def keep_stock_on(self, client, quantities):
+        """ Start keeping the stock of the products in a redis node """
+        pipe = client.pipeline(transaction=False)
+        for product, stock in quantities:
+            pipe.hsetnx(cache.make_key(STOCK_KEY), product.id, stock)
+        pipe.execute()
+
+    def rebuild_on(self, client, token, counts):
+        """
+        Replace the counts kept in a redis node with the given ones, in a
+        single step, if the rebuild claimed with the token is still ours.
+        Returns whether they were replaced
+        """
+        args = [token]
+        for product_id, (reserved, sold, stock) in sorted(counts.items()):
+            args.extend([product_id, reserved, sold, stock])
+
+        script = client.register_script(REBUILD_SCRIPT)
+        return bool(script(keys=self.get_script_keys(), args=args))
+
+    def claim_rebuild_on(self, client, lost=False):
+        """
+        Claim the rebuild of the counts of a redis node, unless another
+        process is rebuilding them, or only if the node lost them. Returns
+        the token of the claim, none if not claimed
+        """
+        token = '{}:{}'.format(REBUILDING, uuid.uuid4().hex)
+        built_key = cache.make_key(BUILT_KEY)
+
+        if lost:
+            claimed = client.set(built_key, token, nx=True,
+                                 ex=REBUILD_TIMEOUT)
+        else:
+            script = client.register_script(CLAIM_SCRIPT)
+            claimed = script(keys=[built_key], args=[token, REBUILD_TIMEOUT])
+
+        return token if claimed else None
+
+    def wait_rebuild_on(self, client):
+        """
+        Claim the rebuild of the counts of a redis node, once no other
+        process is rebuilding them, returns the token of the claim
+        """
+        while True:
+            token = self.claim_rebuild_on(client)
+            if token is not None:
+                return token
+
+            time.sleep(REBUILD_POLL)
+
+    def clear_on(self, client):
+        """ Forget every reservation kept in a redis node """
+        client.delete(cache.make_key(BUILT_KEY), *self.get_keys())
+
+
+class RedisRingBackend(RedisBackend):
+    """
+    Reservations spread over several redis nodes (RESERVATION_REDIS_NODES) by
+    consistent hashing of the product ids. Each node checks and reserves the
+    lines of its products with the very same script, so no node can oversell
+    its products.
+    The lines of an order spanning several nodes are reserved node by node
+    and, if any of the nodes has not enough stock, released from the nodes
+    where they were reserved, so orders are still reserved all or nothing.
+    While that happens other orders may see the units held for a moment and
+    be rejected, but nothing is ever oversold (the orders of the same batch
+    rejected that way are tried again). If a node fails the order is released
+    from the other ones and the error raised, only the orders of the products
+    in that node fail
+    """
+
+    def __init__(self):
+        nodes = getattr(settings, 'RESERVATION_REDIS_NODES', None)
+        if not nodes:
+            raise ImproperlyConfigured(
+                'The redis ring reservation backend needs '
+                'RESERVATION_REDIS_NODES'
+            )
+
+        import redis
+
+        self.clients = {url: redis.StrictRedis.from_url(url) for url in nodes}
+        self.ring = HashRing(nodes)
+
+    def get_node(self, product_id):
+        """ Get the node keeping the reservations of a product """
+        return self.ring.get_node(product_id)
+
+    def get_reserved(self, product_ids):
+        reserved = {}
+        for node, node_product_ids in self.by_node(product_ids, lambda x: x):
+            reserved.update(self.get_reserved_on(self.clients[node],
+                                                 node_product_ids))
+
+        return reserved
+
+    def get_counts(self, product_ids):
+        counts = {}
+        for node, node_product_ids in self.by_node(product_ids, lambda x: x):
+            counts.update(self.get_counts_on(self.clients[node],
+                                             node_product_ids))
+
+        return counts
+
+    def by_node(self, items, get_product_id):
+        """ Split the items (e.g. lines) by the node of their products """
+        by_node = {}
+        for item in items:
+            by_node.setdefault(self.get_node(get_product_id(item)), []) \
+                .append(item)
+
+        return sorted(by_node.items())
+
+    def reserve_many(self, orders):
+        results = [False] * len(orders)
+        pending = list(range(len(orders)))
+
+        while pending:
+            reserved, undone = self.reserve_across_nodes(
+                [orders[index] for index in pending]
+            )
+            for index, fits in zip(pending, reserved):
+                results[index] = fits
+
+            # Orders rejected by a node may have only lacked the units held
+            # for a moment by a previous order of the batch, rejected by
+            # another node, so the rejected orders after it are tried again
+            if not undone:
+                break
+            first = pending[min(undone)]
+            pending = [
+                index for index, fits in zip(pending, reserved)
+                if not fits and index > first
+            ]
+
+        return results
+
+    def reserve_across_nodes(self, orders):
+        """
+        Reserve the lines of the orders in each node, releasing the ones of
+        the orders not reserved in every node. Returns whether each order has
+        been reserved and the positions of the ones released from some node
+        """
+        # The lines of each order kept in each node, an empty list for the
+        # orders without products in the node
+        by_node = {}
+        for index, quantities in enumerate(orders):
+            for product, quantity in quantities:
+                node = by_node.setdefault(self.get_node(product.id),
+                                          [[] for _ in orders])
+                node[index].append((product, quantity))
+
+        reserved = {}
+        try:
+            for node, node_orders in sorted(by_node.items()):
+                reserved[node] = self.reserve_on(self.clients[node],
+                                                 node_orders)
+        except Exception:
+            self.undo(by_node, reserved, [False] * len(orders))
+            raise
+
+        results = [
+            all(fits[index] for fits in reserved.values())
+            for index in range(len(orders))
+        ]
+
+        return results, self.undo(by_node, reserved, results)
+
+    def undo(self, by_node, reserved, results):
+        """
+        Release the lines reserved in each node of the orders that have not
+        been reserved as a whole, returns the positions of those orders
+        """
+        undone = set()
+
+        for node, fits in sorted(reserved.items()):
+            lines = []
+            for index, quantities in enumerate(by_node[node]):
+                if fits[index] and quantities and not results[index]:
+                    lines.extend(quantities)
+                    undone.add(index)
+            if lines:
+                self.release_on(self.clients[node], _group_lines(lines))
+
+        return undone
+
+    def release(self, quantities):
+        for node, node_quantities in self.by_node(quantities, get_line_id):
+            self.release_on(self.clients[node], node_quantities)
+
+    def consume(self, quantities):
+        for node, node_quantities in self.by_node(quantities, get_line_id):
+            self.consume_on(self.clients[node], node_quantities)
+
+    def sell(self, quantities):
+        for node, node_quantities in self.by_node(quantities, get_line_id):
+            self.sell_on(self.clients[node], node_quantities)
+
+    def forget_sold(self, quantities):
+        for node, node_quantities in self.by_node(quantities, get_line_id):
+            self.forget_sold_on(self.clients[node], node_quantities)
+
+    def restock(self, quantities):
+        for node, node_quantities in self.by_node(quantities, get_line_id):
+            self.restock_on(self.clients[node], node_quantities)
+
+    def keep_stock(self, quantities):
+        for node, node_quantities in self.by_node(quantities, get_line_id):
+            self.keep_stock_on(self.clients[node], node_quantities)
+
+    def rebuild(self, compute):
+        tokens = {
+            node: self.wait_rebuild_on(client)
+            for node, client in sorted(self.clients.items())
+        }
+
+        counts = compute()
+        self.rebuild_nodes(tokens, counts)
+        return counts
+
+    def warm_start(self, compute):
+        # Only the nodes that lost their counts are rebuilt, computing them
+        # once for all of them
+        tokens = {}
+        for node, client in sorted(self.clients.items()):
+            token = self.claim_rebuild_on(client, lost=True)
+            if token is not None:
+                tokens[node] = token
+        if not tokens:
+            return False
+
+        return any(self.rebuild_nodes(tokens, compute()))
+
+    def rebuild_nodes(self, tokens, counts):
+        """
+        Rebuild the nodes claimed with the given tokens, by node, with their
+        share of the counts. Returns whether each one was rebuilt
+        """
+        by_node = dict(self.by_node(counts.items(), lambda item: item[0]))
+
+        return [
+            self.rebuild_on(self.clients[node], token,
+                            dict(by_node.get(node, [])))
+            for node, token in sorted(tokens.items())
+        ]
+
+    def clear(self):
+        for node, client in sorted(self.clients.items()):
+            self.clear_on(client)
+
+
+def get_line_id(line):
+    """ Get the product id of a (product, quantity) line """
+    return line[0].id
+
+
+class DatabaseBackend(ReservationBackend):
+    """
+    Reservations kept in the Reservation table, a row by product. Reserving
+    locks the rows of the products (SELECT ... FOR UPDATE, in the order of
+    their ids so two orders can not deadlock) to check and update them in
+    a transaction of its own, so concurrent orders of the same products wait
+    for each other while the rest go on
+    """
+
+    # The stock sold is decremented right away, see ReservationBackend.sell
+    keeps_sold = False
+
+    def get_reserved(self, product_ids):
+        from .models import Reservation
+
+        reserved = dict(Reservation.objects.filter(
+            product_id__in=product_ids
+        ).values_list('product_id', 'quantity'))
+
+        return {
+            product_id: reserved.get(product_id, 0)
+            for product_id in product_ids
+        }
+
+    def get_counts(self, product_ids):
+        return {
+            product_id: (reserved, 0)
+            for product_id, reserved in self.get_reserved(product_ids).items()
+        }
+
+    def reserve_many(self, orders):
+        from .models import Product, Reservation
+
+        product_ids = sorted({
+            product.id for quantities in orders for product, _ in quantities
+        })
+        results = []
+
+        with transaction.atomic():
+            # The products are locked rather than their reservations, as the
+            # rows of the products not reserved yet do not exist. Databases
+            # without row locks (sqlite) lock the whole database on the first
+            # write instead, so it is taken before reading anything. The
+            # orders are checked against the stock read under the lock, the
+            # one of the products given may be stale
+            products = Product.objects.filter(id__in=product_ids)
+            if connection.features.has_select_for_update:
+                products = products.select_for_update().order_by('id')
+            else:
+                products.update(stock=F('stock'))
+            stock = dict(products.values_list('id', 'stock'))
+
+            existing = dict(Reservation.objects.filter(
+                product_id__in=product_ids
+            ).values_list('product_id', 'quantity'))
+            reserved = dict(existing)
+
+            for quantities in orders:
+                fits = all(
+                    stock.get(product.id, 0) - reserved.get(product.id, 0) >=
+                    quantity for product, quantity in quantities
+                )
+                if fits:
+                    for product, quantity in quantities:
+                        reserved[product.id] = \
+                            reserved.get(product.id, 0) + quantity
+                results.append(fits)
+
+            Reservation.objects.bulk_create([
+                Reservation(product_id=product_id, quantity=quantity)
+                for product_id, quantity in reserved.items()
+                if product_id not in existing
+            ])
+            changed = {
+                product_id: quantity
+                for product_id, quantity in reserved.items()
+                if product_id in existing and quantity != existing[product_id]
+            }
+            if changed:
+                Reservation.objects.filter(product_id__in=changed).update(
+                    quantity=Case(
+                        *[When(product_id=product_id, then=quantity)
+                          for product_id, quantity in changed.items()],
+                        default=F('quantity'),
+                        output_field=IntegerField()
+                    )
+                )
+
+        return results
+
+    def release(self, quantities):
+        from .models import Reservation
+
+        # A single UPDATE, the rows it takes are locked until it is done
+        Reservation.objects.filter(
+            product_id__in=[product.id for product, _ in quantities]
+        ).update(quantity=Case(
+            *[When(product_id=product.id, then=F('quantity') - quantity)
+              for product, quantity in quantities],
+            default=F('quantity'),
+            output_field=IntegerField()
+        ))
+
+    def rebuild(self, compute):
+        from .models import Reservation
+
+        # Units sold are not kept, see ReservationBackend.sell. The rows
+        # deleted stay locked until they are replaced
+        with transaction.atomic():
+            Reservation.objects.all().delete()
+            counts = compute()
+            Reservation.objects.bulk_create([
+                Reservation(product_id=product_id, quantity=reserved)
+                for product_id, (reserved, _, _) in sorted(counts.items())
+                if reserved
+            ])
+
+        return counts
+
+    def clear(self):
+        from .models import Reservation
+
+        Reservation.objects.all().delete()
+
+
+class LocalBackend(ReservationBackend):
+    """
+    Reservations kept in the cache of this very process (e.g. the local memory
+    cache used by tests) in a single dict, by product id, along with the
+    amount sold by ('sold', product id)
+    """
+
+    # Makes the check and reserve atomic, within this process
+    lock = threading.Lock()
+
+    def get_reserved(self, product_ids):
+        reserved = cache.get(RESERVED_KEY) or {}
+        return {
+            product_id: reserved.get(product_id, 0) +
+            reserved.get(('sold', product_id), 0)
+            for product_id in product_ids
+        }
+
+    def get_counts(self, product_ids):
+        reserved = cache.get(RESERVED_KEY) or {}
+        return {
+            product_id: (reserved.get(product_id, 0),
+                         reserved.get(('sold', product_id), 0))
+            for product_id in product_ids
+        }
+
+    def reserve_many(self, orders):
+        results = []
+
+        with self.lock:
+            reserved = cache.get(RESERVED_KEY) or {}
+
+            for quantities in orders:
+                fits = all(
+                    product.stock - reserved.get(product.id, 0) -
+                    reserved.get(('sold', product.id), 0) >= quantity
+                    for product, quantity in quantities
+                )
+                if fits:
+                    for product, quantity in quantities:
+                        reserved[product.id] = \
+                            reserved.get(product.id, 0) + quantity
+                results.append(fits)
+
+            cache.set(RESERVED_KEY, reserved, None)
+
+        return results
+
+    def release(self, quantities):
+        with self.lock:
+            reserved = cache.get(RESERVED_KEY) or {}
+            for product, quantity in quantities:
+                reserved[product.id] = reserved.get(product.id, 0) - quantity
+            cache.set(RESERVED_KEY, reserved, None)
+
+    def sell(self, quantities):
+        with self.lock:
+            reserved = cache.get(RESERVED_KEY) or {}
+            for product, quantity in quantities:
+                reserved[product.id] = reserved.get(product.id, 0) - quantity
+                reserved[('sold', product.id)] = \
+                    reserved.get(('sold', product.id), 0) + quantity
+            cache.set(RESERVED_KEY, reserved, None)
+
+    def forget_sold(self, quantities):
+        with self.lock:
+            reserved = cache.get(RESERVED_KEY) or {}
+            for product, quantity in quantities:
+                reserved[('sold', product.id)] = \
+                    reserved.get(('sold', product.id), 0) - quantity
+            cache.set(RESERVED_KEY, reserved, None)
+
+    def rebuild(self, compute):
+        # Reservations wait for the lock while the counts are computed
+        with self.lock:
+            counts = compute()
+            self.set_counts(counts)
+
+        return counts
+
+    def warm_start(self, compute):
+        with self.lock:
+            if cache.get(RESERVED_KEY) is not None:
+                return False
+
+            self.set_counts(compute())
+            return True
+
+    def set_counts(self, counts):
+        """ Replace every count with the given ones, holding the lock """
+        reserved = {}
+        for product_id, (product_reserved, sold, _) in counts.items():
+            if product_reserved:
+                reserved[product_id] = product_reserved
+            if sold:
+                reserved[('sold', product_id)] = sold
+
+        cache.set(RESERVED_KEY, reserved, None)
+
+    def clear(self):
+        cache.delete(RESERVED_KEY)
@@ -0,0 +1,183 @@
+"""
+Rollups of the sales.
+
+Questions like the units sold of a product per hour or the revenue of a
+category per day used to take scanning the order lines along with their
+orders and products, and pricing them. The HourlySales and DailySales tables
+keep the units sold of each product and their revenue per period instead, so
+they are answered reading a few rows.
+
+The rollups are not updated when an order completes, that would make every
+payment of a popular product update the very same rows. A periodic job rolls
+up the sale movements of the ledger (see the ledger module) after a
+watermark, the last movement rolled up, which is moved in the same
+transaction that updates the rollups: an interrupted job is just replayed by
+the next one without counting any sale twice. As with the compaction of the
+ledger only the movements older than STOCK_LEDGER_LAG are taken.
+
+The revenue of an order is its total, fixed when it was created, split among
+its lines by their prices (see PricingEngine.price_lines). Sales fall in the
+hour and day they were made in the current time zone. Orders completed before
+the ledger was started have no sale movement and are not rolled up.
+"""
+from collections import defaultdict
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, FloatField, IntegerField, Value, When
+from django.utils import timezone
+
+from .models import DailySales, HourlySales, Order, OrderProduct, \
+    StockMovement, Watermark
+
+
+WATERMARK = 'sales_rollups'
+
+
+def get_unit_revenues(order_ids):
+    """
+    Get the revenue of each unit of every product in the given orders, by
+    (order id, product id), with a single query
+    """
+    orders = defaultdict(list)
+    for order_product in OrderProduct.objects.filter(
+        order__in=order_ids
+    ).select_related('order', 'product'):
+        orders[order_product.order_id].append(order_product)
+
+    revenues = {}
+    for order_id, order_products in orders.items():
+        lines = [(order_product.product, order_product.quantity)
+                 for order_product in order_products]
+        prices = Order.pricing_engine.price_lines(lines)
+        subtotal = sum(prices)
+
+        total = order_products[0].order.total
+        if total is None:
+            total = Order.pricing_engine.quote(lines).total
+
+        products = defaultdict(lambda: [0, 0])
+        for (product, quantity), price in zip(lines, prices):
+            products[product.pk][0] += quantity
+            products[product.pk][1] += total * price / subtotal \
+                if subtotal else 0
+
+        for product_id, (quantity, revenue) in products.items():
+            if quantity:
+                revenues[order_id, product_id] = revenue / quantity
+
+    return revenues
+
+
+def add_sales(model, sales):
+    """
+    Add the (category, quantity, revenue) sold of each (period, product id)
+    to the rollups of the model, reading, creating and updating them with a
+    query each
+    """
+    existing = {
+        (period, product_id): pk
+        for pk, period, product_id in model.objects.filter(
+            period__in={period for period, _ in sales},
+            product__in={product_id for _, product_id in sales},
+        ).values_list('pk', 'period', 'product')
+    }
+
+    model.objects.bulk_create([
+        model(period=period, product_id=product_id, category=category,
+              quantity=quantity, revenue=revenue)
+        for (period, product_id), (category, quantity, revenue)
+        in sales.items() if (period, product_id) not in existing
+    ])
+
+    updated = [(existing[key], quantity, revenue)
+               for key, (_, quantity, revenue) in sales.items()
+               if key in existing]
+    if updated:
+        model.objects.filter(pk__in=[pk for pk, _, _ in updated]).update(
+            quantity=F('quantity') + Case(
+                *[When(pk=pk, then=Value(quantity))
+                  for pk, quantity, _ in updated],
+                default=Value(0), output_field=IntegerField()
+            ),
+            revenue=F('revenue') + Case(
+                *[When(pk=pk, then=Value(revenue))
+                  for pk, _, revenue in updated],
+                default=Value(0), output_field=FloatField()
+            ),
+        )
+
+
+def roll_up(lag=None, limit=None):
+    """
+    Roll up up to limit (SALES_ROLLUP_BATCH by default) sale movements older
+    than lag seconds (STOCK_LEDGER_LAG by default) into the hourly and daily
+    rollups. Jobs running at once wait for each other on the watermark.
+    Returns the number of movements rolled up
+    """
+    if lag is None:
+        lag = settings.STOCK_LEDGER_LAG
+    if limit is None:
+        limit = settings.SALES_ROLLUP_BATCH
+
+    with transaction.atomic():
+        watermark, _ = Watermark.objects.select_for_update().get_or_create(
+            name=WATERMARK
+        )
+
+        last = StockMovement.objects.filter(
+            created__lte=timezone.now() - timedelta(seconds=lag)
+        ).order_by('-id').values_list('id', flat=True).first()
+        if last is None or last <= watermark.last_movement:
+            return 0
+
+        movements = list(StockMovement.objects.filter(
+            kind=StockMovement.KIND_SELL, id__gt=watermark.last_movement,
+            id__lte=last,
+        ).order_by('id').values_list(
+            'id', 'order_id', 'product', 'product__category', 'quantity',
+            'created'
+        )[:limit])
+
+        revenues = get_unit_revenues(
+            {order_id for _, order_id, _, _, _, _ in movements if order_id}
+        )
+
+        hourly = defaultdict(lambda: [None, 0, 0])
+        daily = defaultdict(lambda: [None, 0, 0])
+        for _, order_id, product_id, category, quantity, created in \
+                movements:
+            created = timezone.localtime(created)
+            hour = created.replace(minute=0, second=0, microsecond=0)
+            revenue = -quantity * revenues.get((order_id, product_id), 0)
+
+            for sales in (hourly[hour, product_id],
+                          daily[created.date(), product_id]):
+                sales[0] = category
+                sales[1] -= quantity
+                sales[2] += revenue
+
+        if movements:
+            add_sales(HourlySales, hourly)
+            add_sales(DailySales, daily)
+
+        # Up to the last movement looked at unless the batch is full, the
+        # ones skipped are not sales
+        if len(movements) < limit:
+            watermark.last_movement = last
+        else:
+            watermark.last_movement = movements[-1][0]
+        watermark.save(update_fields=['last_movement'])
+
+    return len(movements)
+
+
+def roll_up_all(lag=None):
+    """ Roll up every sale movement older than lag, returns how many """
+    rolled_up = 0
+
+    while True:
+        count = roll_up(lag)
+        rolled_up += count
+        if count < settings.SALES_ROLLUP_BATCH:
+            return rolled_up
@@ -0,0 +1,181 @@
+"""
+Write-behind of the stock sold.
+
+By default completing an order decrements the stock of its products right
+away, with a conditional UPDATE of their rows in the very same transaction,
+so payments of the popular products wait for each other on the locks of
+their rows.
+
+With STOCK_WRITE_BEHIND the completion only marks the order as complete (and
+its stock as pending) and moves its units from reserved to sold in the
+reservation backend, in a single step, so they are never available in the
+meanwhile. A periodic flush then takes the orders whose stock is pending and
+decrements the stock of all their products with a single UPDATE.
+
+The database is the source of truth: the orders whose stock is pending are
+flagged and the flush decrements the stock and clears the flags in the same
+transaction, so a flush interrupted at any point is just replayed by the next
+one without decrementing any order twice. The units sold kept by the backend
+are only forgotten after that, a flush dying in between leaves them taken
+(never oversold) until check finds and reports them.
+"""
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Q, Sum, Value, When
+
+from . import catalog, expiry, reservations
+from .models import Order, OrderProduct, Product
+
+
+def is_write_behind():
+    return getattr(settings, 'STOCK_WRITE_BEHIND', False)
+
+
+def get_quantities(orders):
+    """ Get the quantity of each product (by id) in the given orders """
+    return dict(
+        OrderProduct.objects.filter(order__in=orders)
+        .values_list('product').annotate(Sum('quantity'))
+    )
+
+
+def get_expected():
+    """
+    Get the (reserved, sold) amounts of each product (by id) according to the
+    orders, in a single query: the lines of the pending orders and the ones of
+    the orders whose stock is pending. Products without any are left out
+    """
+    return {
+        product_id: (reserved, sold)
+        for product_id, reserved, sold in OrderProduct.objects.filter(
+            Q(order__complete=False) | Q(order__stock_pending=True)
+        ).values('product').annotate(
+            reserved=Sum(Case(When(order__complete=False, then=F('quantity')),
+                              default=Value(0), output_field=IntegerField())),
+            sold=Sum(Case(When(order__stock_pending=True, then=F('quantity')),
+                          default=Value(0), output_field=IntegerField())),
+        ).values_list('product', 'reserved', 'sold')
+    }
+
+
+def get_state():
+    """
+    Get the (reserved, sold, stock) of every product (by id), for the
+    reservation backend to rebuild, see reservations.rebuild. The orders are
+    read before the stock: an order paid or flushed in between is taken out
+    of the stock and still counted, so its units are never available twice
+    """
+    expected = get_expected()
+
+    return {
+        product_id: expected.get(product_id, (0, 0)) + (product_stock, )
+        for product_id, product_stock
+        in Product.objects.values_list('id', 'stock')
+    }
+
+
+def rebuild():
+    """
+    Rebuild the amounts reserved and sold, and the stock, kept by the
+    reservation backend out of the orders and products, see
+    reservations.rebuild, and track the pending orders again so they expire.
+    Returns the number of products with any reserved or sold
+    """
+    state = reservations.rebuild(get_state)
+    expiry.track_pending()
+    return sum(1 for reserved, sold, _ in state.values() if reserved or sold)
+
+
+def warm_start():
+    """
+    Rebuild the amounts reserved and sold out of the orders if the reservation
+    backend has lost them, and track the pending orders again if their
+    deadlines have been lost (see expiry.warm_start), unless
+    RESERVATION_WARM_START is off. Run on the start of the web processes and
+    workers. Returns whether anything was rebuilt
+    """
+    if getattr(settings, 'RESERVATION_WARM_START', False):
+        tracked = expiry.warm_start()
+        return reservations.warm_start(get_state) or tracked
+
+    return False
+
+
+def flush(limit=None):
+    """
+    Decrement the stock of up to limit (STOCK_FLUSH_BATCH by default) orders
+    whose stock is pending, with a single UPDATE. Must not be run within a
+    transaction, see the module documentation. Returns the number of orders
+    flushed
+    """
+    if limit is None:
+        limit = settings.STOCK_FLUSH_BATCH
+
+    with transaction.atomic():
+        order_ids = list(
+            Order.objects.select_for_update().filter(stock_pending=True)
+            .order_by('id').values_list('id', flat=True)[:limit]
+        )
+        if not order_ids:
+            return 0
+
+        quantities = get_quantities(order_ids)
+        if quantities:
+            Product.objects.filter(pk__in=quantities).update(stock=Case(
+                *[When(pk=product_id, then=F('stock') - quantity)
+                  for product_id, quantity in quantities.items()],
+                default=F('stock'),
+                output_field=IntegerField()
+            ))
+            catalog.bump_version_on_commit()
+
+        Order.objects.filter(id__in=order_ids).update(stock_pending=False)
+
+    reservations.forget_sold([
+        (Product(pk=product_id), quantity)
+        for product_id, quantity in quantities.items()
+    ])
+
+    return len(order_ids)
+
+
+def flush_all():
+    """ Flush every order whose stock is pending, returns how many """
+    flushed = 0
+
+    while True:
+        count = flush()
+        flushed += count
+        if count < settings.STOCK_FLUSH_BATCH:
+            return flushed
+
+
+def check():
+    """
+    Check the amounts kept by the reservation backend match the orders: the
+    reserved ones with the lines of the pending orders and the sold ones with
+    the lines of the orders whose stock is pending. Orders being placed, paid
+    or flushed while checking may show up as problems, check again before
+    acting on them. Returns the list of problems found
+    """
+    product_ids = list(Product.objects.values_list('id', flat=True))
+    counts = reservations.get_counts(product_ids)
+    expected = get_expected()
+
+    problems = []
+    for product_id in product_ids:
+        reserved, sold = counts[product_id]
+        pending, unflushed = expected.get(product_id, (0, 0))
+
+        if reserved != pending:
+            problems.append(
+                'Product {} reservation ({}) does not match its pending '
+                'orders ({})'.format(product_id, reserved, pending)
+            )
+        if sold != unflushed:
+            problems.append(
+                'Product {} sold ({}) does not match its orders not flushed '
+                '({})'.format(product_id, sold, unflushed)
+            )
+
+    return problems
@@ -1,18 +1,52 @@
 from celery import shared_task
 
-from .models import Order
+from . import expiry, ledger, rollups, stock
 
 
 @shared_task
-def check_order(order_id):
+def release_expired_orders():
     """
-    Check if an order has been paid, otherwise release the reserved stock and
-    delete the order
+    Periodically release the stock of every order that has not been paid
+    within the ORDER_TIMEOUT and delete them
+    """
+    return expiry.release_expired_orders()
+
+
+@shared_task
+def flush_stock():
+    """
+    Periodically decrement the stock sold by the orders completed since the
+    last flush, if STOCK_WRITE_BEHIND
+    """
+    if stock.is_write_behind():
+        return stock.flush_all()
+
+
+@shared_task
+def compact_ledger():
     """
-    order = Order.objects.get(id=order_id)
+    Periodically fold the stock movements into the snapshots of their
+    products
+    """
+    return ledger.compact()
+
+
+@shared_task
+def roll_up_sales():
+    """
+    Periodically add the sales made since the last run to the hourly and
+    daily rollups
+    """
+    return rollups.roll_up_all()
 
-    if not order.complete:  # Delete the order and release stock if timed out
-        for order_product in order.orderproduct_set.all():
-            order_product.product.release_stock(order_product.quantity)
 
-        order.delete()
+@shared_task
+def check_order(order_id):
+    """
+    Check if an order has been paid, otherwise release the reserved stock and
+    delete the order.
+    Orders are now expired in batches by release_expired_orders, this is kept
+    for the tasks that were already queued.
+    """
+    expiry.release_orders([order_id])
+    expiry.forget([order_id])
@@ -1,13 +1,33 @@
+import base64
 import json
+from contextlib import contextmanager, ExitStack
 from django.core.cache import cache
-from django.conf import settings
-from django.test import TestCase
+from django.db import DatabaseError
+from django.test import TestCase, TransactionTestCase
 from django.test.client import Client
-from mock import patch
+from mock import patch, ANY
 from model_mommy import mommy
+from tastypie.resources import ModelResource
 from tastypie.test import ResourceTestCaseMixin
 
-from products.models import Product
+from products import catalog, reservations
+from products.api.resources_v1 import OrderProductResource, \
+    OrderResource, OrderValidation, ProductResource
+from products.models import Product, Order
+
+
+@contextmanager
+def tastypie_dehydrate(*resources):
+    """
+    Make the given resources go through tastypie's default dehydration instead
+    of their fast path
+    """
+    with ExitStack() as stack:
+        for resource in resources:
+            stack.enter_context(patch.object(
+                resource, 'full_dehydrate', ModelResource.full_dehydrate
+            ))
+        yield
 
 
 class ProductResourceTests(ResourceTestCaseMixin, TestCase):
@@ -17,6 +37,11 @@ class ProductResourceTests(ResourceTestCaseMixin, TestCase):
 
         self.default_products = Product.objects.all().count()
 
+    def tearDown(self):
+        """ Make sure cache and reservations are empty before every test """
+        reservations.get_backend().clear()
+        cache.clear()
+
     def test_get_list(self):
         """ Test getting a list of products """
         mommy.make('Product', _quantity=10)
@@ -57,6 +82,110 @@ class ProductResourceTests(ResourceTestCaseMixin, TestCase):
         response = self.c.get('/api/v1/product/{}/'.format(product.id))
         self.assertHttpOK(response)
 
+    def test_get_same_as_tastypie(self):
+        """ Test the fast path gives the same output as tastypie's """
+        product = Product.objects.first()
+        product.reserve_stock(1)
+
+        urls = ['/api/v1/product/', '/api/v1/product/{}/'.format(product.id)]
+        responses = [self.c.get(url).content for url in urls]
+
+        catalog.bump_version()  # Do not reuse the cached responses
+        with tastypie_dehydrate(ProductResource):
+            self.assertEquals(responses,
+                              [self.c.get(url).content for url in urls])
+
+    def test_get_list_real_stock(self):
+        """ Test the list includes the stock not reserved by other orders """
+        product = Product.objects.order_by('id').first()
+        product.reserve_stock(1)
+
+        with patch('products.reservations.get_reserved',
+                   wraps=reservations.get_reserved) as reserved_mock:
+            response = self.c.get('/api/v1/product/?limit=0')
+        self.assertHttpOK(response)
+        reserved_mock.assert_called_once_with(ANY)
+
+        body = json.loads(response.content.decode())
+        real_stocks = {obj['id']: obj['real_stock'] for obj in body['objects']}
+        self.assertEquals(real_stocks[product.id], product.stock - 1)
+
+    def test_get_detail_real_stock(self):
+        """ Test the detail includes the stock not reserved """
+        product = Product.objects.first()
+        product.reserve_stock(1)
+
+        response = self.c.get('/api/v1/product/{}/'.format(product.id))
+        self.assertHttpOK(response)
+
+        body = json.loads(response.content.decode())
+        self.assertEquals(body['real_stock'], product.stock - 1)
+
+    def test_get_detail_not_found(self):
+        """ Test getting a product that does not exist """
+        product = mommy.make('Product')
+        product_id = product.id
+        product.delete()
+
+        response = self.c.get('/api/v1/product/{}/'.format(product_id))
+        self.assertHttpNotFound(response)
+
+    def test_get_cached(self):
+        """ Test the catalog is cached, both the list and the detail """
+        product = Product.objects.first()
+
+        for url in ['/api/v1/product/',
+                    '/api/v1/product/{}/'.format(product.id)]:
+            response = self.c.get(url)
+
+            with self.assertNumQueries(0):
+                cached_response = self.c.get(url)
+            self.assertHttpOK(cached_response)
+            self.assertEquals(response.content, cached_response.content)
+            self.assertEquals(response['ETag'], cached_response['ETag'])
+
+    def test_get_not_modified(self):
+        """ Test a client that already has the catalog gets a 304 """
+        product = Product.objects.first()
+
+        for url in ['/api/v1/product/',
+                    '/api/v1/product/{}/'.format(product.id)]:
+            response = self.c.get(url)
+
+            with self.assertNumQueries(0):
+                response = self.c.get(url,
+                                      HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEquals(response.status_code, 304)
+            self.assertFalse(response.content)
+
+    def test_get_reserved_changes_etag(self):
+        """
+        Test the real stock is up to date even if the catalog is cached
+        """
+        product = Product.objects.first()
+        url = '/api/v1/product/{}/'.format(product.id)
+        response = self.c.get(url)
+
+        product.reserve_stock(1)
+
+        with self.assertNumQueries(0):
+            response = self.c.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertHttpOK(response)
+
+        body = json.loads(response.content.decode())
+        self.assertEquals(body['real_stock'], product.stock - 1)
+
+    def test_catalog_version_changes(self):
+        """ Test the cached catalog is not used once the catalog changes """
+        response = self.c.get('/api/v1/product/')
+
+        catalog.bump_version()
+
+        with self.assertNumQueries(2):
+            response = self.c.get('/api/v1/product/',
+                                  HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertHttpOK(response)
+
     def test_post_not_allowed(self):
         """ Test POST method is not allowed """
         product = Product.objects.first()
@@ -85,7 +214,8 @@ class OrderResourceTests(ResourceTestCaseMixin, TestCase):
         self.c = Client()
 
     def tearDown(self):
-        """ Make sure cache is empty before every test """
+        """ Make sure cache and reservations are empty before every test """
+        reservations.get_backend().clear()
         cache.clear()
 
     def test_get_list(self):
@@ -123,6 +253,88 @@ class OrderResourceTests(ResourceTestCaseMixin, TestCase):
 
         self.assertEquals(len(ids), 6)
 
+    def test_get_same_as_tastypie(self):
+        """ Test the fast path gives the same output as tastypie's """
+        products = mommy.make('Product', _quantity=3)
+        for order in mommy.make('Order', _quantity=3):
+            for product in products:
+                mommy.make('OrderProduct', order=order, product=product)
+
+        urls = ['/api/v1/order/', '/api/v1/order/{}/'.format(order.id),
+                '/api/v1/order_product/']
+        responses = [self.c.get(url).content for url in urls]
+
+        with tastypie_dehydrate(OrderResource, OrderProductResource):
+            self.assertEquals(responses,
+                              [self.c.get(url).content for url in urls])
+
+    def test_get_list_cursor_pagination(self):
+        """
+        Test walking the orders with cursors, forward and backwards, without
+        missing nor duplicating any of them
+        """
+        orders = mommy.make('Order', _quantity=7)
+        # Orders created at the very same time are sorted by id
+        Order.objects.filter(id__in=[orders[1].id, orders[2].id]).update(
+            created=orders[0].created
+        )
+        expected = [
+            order.id for order in Order.objects.order_by('created', 'id')
+        ]
+
+        ids = []
+        url = '/api/v1/order/?limit=3&cursor='
+        while url:
+            response = self.c.get(url)
+            self.assertHttpOK(response)
+
+            body = json.loads(response.content.decode())
+            self.assertNotIn('total_count', body['meta'])
+            ids.extend([obj['id'] for obj in body['objects']])
+            url = body['meta']['next']
+        self.assertEquals(ids, expected)
+
+        previous_ids = []
+        url = body['meta']['previous']
+        while url:
+            body = json.loads(self.c.get(url).content.decode())
+            previous_ids[:0] = [obj['id'] for obj in body['objects']]
+            url = body['meta']['previous']
+        self.assertEquals(previous_ids, expected[:6])
+
+    def test_get_list_cursor_number_of_queries(self):
+        """ Test cursor pages do not count the orders """
+        mommy.make('Order', _quantity=10)
+
+        response = self.c.get('/api/v1/order/?limit=3&cursor=')
+        body = json.loads(response.content.decode())
+
+        with self.assertNumQueries(2):
+            self.assertHttpOK(self.c.get(body['meta']['next']))
+
+    def test_get_list_invalid_cursor(self):
+        """ Test an invalid cursor is a bad request """
+        cursors = ['foo', 'é'] + [
+            base64.urlsafe_b64encode(cursor).decode('ascii')
+            for cursor in [b'foo', b'\xe9', b'[1]', b'["next", ["foo", 1]]']
+        ]
+        for cursor in cursors:
+            response = self.c.get('/api/v1/order/', {'cursor': cursor})
+            self.assertHttpBadRequest(response)
+
+    def test_get_order_product_list_cursor_pagination(self):
+        """ Test walking the order lines with cursors """
+        mommy.make('OrderProduct', _quantity=5)
+
+        ids = []
+        url = '/api/v1/order_product/?limit=2&cursor='
+        while url:
+            body = json.loads(self.c.get(url).content.decode())
+            ids.extend([obj['id'] for obj in body['objects']])
+            url = body['meta']['next']
+        self.assertEquals(ids, sorted(ids))
+        self.assertEquals(len(ids), 5)
+
     def test_get_detail(self):
         """ Test getting a order detail """
         order = mommy.make('Order')
@@ -141,13 +353,13 @@ class OrderResourceTests(ResourceTestCaseMixin, TestCase):
         )
         self.assertHttpAccepted(response)
 
-    @patch.object(Product, 'release_stock')
-    def test_patch_stock_is_released(self, release_mock):
-        """ Test the reserved stock is released when an order is completed """
+    @patch('products.reservations.consume')
+    def test_patch_stock_is_consumed(self, consume_mock):
+        """ Test the reserved stock is consumed when an order is completed """
         order = mommy.make('Order', complete=False)
-        product = mommy.make('Product')
+        product = mommy.make('Product', stock=10)
         order_product = mommy.make('OrderProduct', order=order,
-                                   product=product)
+                                   product=product, quantity=5)
 
         response = self.c.patch(
             '/api/v1/order/{}/'.format(order.id),
@@ -155,7 +367,9 @@ class OrderResourceTests(ResourceTestCaseMixin, TestCase):
             content_type='application/json'
         )
         self.assertHttpAccepted(response)
-        release_mock.assert_called_once_with(order_product.quantity)
+        consume_mock.assert_called_once_with(
+            [(product, order_product.quantity)]
+        )
 
     def test_patch_stock_is_consolidated(self):
         """
@@ -174,6 +388,70 @@ class OrderResourceTests(ResourceTestCaseMixin, TestCase):
         )
         self.assertHttpAccepted(response)
         self.assertEquals(Product.objects.get(id=product.id).stock, 5)
+        self.assertEquals(product.reserved, 0)
+
+    def test_patch_stock_is_consolidated_once(self):
+        """
+        Test completing an order twice only consolidates its stock once
+        """
+        order = mommy.make('Order', complete=False)
+        product = mommy.make('Product', stock=10)
+
+        mommy.make('OrderProduct', order=order, product=product, quantity=5)
+        product.reserve_stock(5)
+
+        for _ in range(2):
+            response = self.c.patch(
+                '/api/v1/order/{}/'.format(order.id),
+                json.dumps({'complete': True}),
+                content_type='application/json'
+            )
+            self.assertHttpAccepted(response)
+        self.assertEquals(Product.objects.get(id=product.id).stock, 5)
+        self.assertEquals(product.reserved, 0)
+
+    def test_patch_stock_below_zero(self):
+        """
+        Test completing an order fails, leaving everything untouched, when
+        the stock of any of its products would go below zero
+        """
+        order = mommy.make('Order', complete=False)
+        product_1 = mommy.make('Product', stock=10)
+        product_2 = mommy.make('Product', stock=10)
+
+        mommy.make('OrderProduct', order=order, product=product_1, quantity=5)
+        mommy.make('OrderProduct', order=order, product=product_2, quantity=5)
+        reservations.reserve([(product_1, 5), (product_2, 5)])
+        Product.objects.filter(id=product_2.id).update(stock=2)
+
+        response = self.c.patch(
+            '/api/v1/order/{}/'.format(order.id),
+            json.dumps({'complete': True}),
+            content_type='application/json'
+        )
+        self.assertHttpBadRequest(response)
+        self.assertFalse(Order.objects.get(id=order.id).complete)
+        self.assertEquals(Product.objects.get(id=product_1.id).stock, 10)
+        self.assertEquals(product_1.reserved, 5)
+
+    def test_patch_number_of_queries(self):
+        """
+        Test completing an order needs the same number of queries no matter
+        how many products it has
+        """
+        for quantity in (1, 10):
+            order = mommy.make('Order', complete=False)
+            for product in mommy.make('Product', stock=10, _quantity=quantity):
+                mommy.make('OrderProduct', order=order, product=product,
+                           quantity=1)
+
+            with self.assertNumQueries(9):
+                response = self.c.patch(
+                    '/api/v1/order/{}/'.format(order.id),
+                    json.dumps({'complete': True}),
+                    content_type='application/json'
+                )
+            self.assertHttpAccepted(response)
 
     def test_post(self):
         """ Test POST a new order """
@@ -186,6 +464,48 @@ class OrderResourceTests(ResourceTestCaseMixin, TestCase):
         )
         self.assertHttpCreated(response)
 
+    def test_post_order_is_priced(self):
+        """ Test POST keeps the price of the order with it """
+        product_1 = mommy.make('Product', price=1, unitary=True, stock=10)
+        product_2 = mommy.make('Product', price=2, unitary=True, stock=10)
+
+        response = self.c.post(
+            '/api/v1/order/',
+            json.dumps({
+                'products': [
+                    {'product': product_1.id, 'quantity': 3},
+                    {'product': product_2.id, 'quantity': 1},
+                ],
+                'total': 0,
+            }),
+            content_type='application/json'
+        )
+        self.assertHttpCreated(response)
+
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertEquals(data['total'], 4)
+        self.assertEquals(data['line_count'], 2)
+        self.assertEquals(data['discounts'], '3x2')
+
+        order = Order.objects.get()
+        self.assertEquals(order.total, 4)
+        self.assertEquals(order.total, order.price())
+
+    def test_get_list_filter_by_total(self):
+        """ Test orders can be filtered and sorted by their total """
+        mommy.make('Order', total=5)
+        mommy.make('Order', total=20)
+        mommy.make('Order', total=10)
+
+        response = self.c.get('/api/v1/order/',
+                              {'total__gte': 10, 'order_by': '-total'})
+        self.assertHttpOK(response)
+        self.assertEquals(
+            [order['total'] for order in
+             json.loads(response.content.decode('utf-8'))['objects']],
+            [20, 10]
+        )
+
     def test_post_not_enough_stock(self):
         """ Test POST fails when not enough stock of the product """
         product = mommy.make('Product', stock=0)
@@ -222,7 +542,7 @@ class OrderResourceTests(ResourceTestCaseMixin, TestCase):
         )
         self.assertHttpBadRequest(response)
 
-    @patch.object(Product, 'reserve_stock')
+    @patch('products.reservations.reserve')
     def test_post_stock_is_reserved(self, reserve_mock):
         """ Test POST reserve the requested product stock """
         product = mommy.make('Product', stock=10)
@@ -233,25 +553,254 @@ class OrderResourceTests(ResourceTestCaseMixin, TestCase):
             content_type='application/json'
         )
         self.assertHttpCreated(response)
-        reserve_mock.assert_called_once_with(1)
+        reserve_mock.assert_called_once_with([(product, 1)])
 
-    @patch('products.tasks.check_order.apply_async')
-    def test_post_task_is_scheduled(self, task_mock):
-        """ Test POST schedule the task to check if the order has been paid """
+    def test_post_stock_is_reserved_all_or_nothing(self):
+        """
+        Test POST does not reserve nor create anything when one of the
+        products runs out of stock between the validation and the reservation
+        """
+        product_1 = mommy.make('Product', stock=10)
+        product_2 = mommy.make('Product', stock=10)
+
+        product_2.reserve_stock(10)
+
+        with patch.object(OrderValidation, 'is_valid', return_value={}):
+            response = self.c.post(
+                '/api/v1/order/',
+                json.dumps({'products': [
+                    {'product': product_1.id, 'quantity': 1},
+                    {'product': product_2.id, 'quantity': 1},
+                ]}),
+                content_type='application/json'
+            )
+        self.assertHttpBadRequest(response)
+        self.assertEquals(product_1.reserved, 0)
+        self.assertEquals(product_2.reserved, 10)
+        self.assertFalse(Order.objects.exists())
+
+    def test_post_stock_is_released_on_error(self):
+        """ Test POST releases the reserved stock if the order is not saved """
         product = mommy.make('Product', stock=10)
 
+        with patch('products.models.OrderProduct.objects.bulk_create',
+                   side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                self.c.post(
+                    '/api/v1/order/',
+                    json.dumps(
+                        {'products': [{'product': product.id, 'quantity': 1}]}
+                    ),
+                    content_type='application/json'
+                )
+        self.assertEquals(product.reserved, 0)
+        self.assertFalse(Order.objects.exists())
+
+    def test_post_number_of_queries(self):
+        """
+        Test creating an order needs the same number of queries no matter how
+        many products it has
+        """
+        for quantity in (1, 10):
+            products = mommy.make('Product', stock=10, _quantity=quantity)
+
+            with self.assertNumQueries(7):
+                response = self.c.post(
+                    '/api/v1/order/',
+                    json.dumps({'products': [
+                        {'product': product.id, 'quantity': 1}
+                        for product in products
+                    ]}),
+                    content_type='application/json'
+                )
+            self.assertHttpCreated(response)
+
+    def test_quote(self):
+        """ Test quoting a cart prices it without creating an order """
+        product_1 = mommy.make('Product', price=1, unitary=True, stock=10)
+        product_2 = mommy.make('Product', price=2, unitary=False, stock=1000)
+
+        with self.assertNumQueries(1):
+            response = self.c.post(
+                '/api/v1/order/quote/',
+                json.dumps({'products': [
+                    {'product': product_1.id, 'quantity': 3},
+                    {'product': product_2.id, 'quantity': 200},
+                ]}),
+                content_type='application/json'
+            )
+        self.assertHttpOK(response)
+        self.assertEquals(json.loads(response.content.decode('utf-8')), {
+            'total': 2 * 1 + 2 * 2,
+            'lines': 2,
+            'discounts': ['3x2'],
+        })
+        self.assertFalse(Order.objects.exists())
+        self.assertEquals(product_1.reserved, 0)
+
+    def test_quote_many(self):
+        """ Test quoting many carts with a single query """
+        product = mommy.make('Product', price=1, unitary=True)
+
+        with self.assertNumQueries(1):
+            response = self.c.post(
+                '/api/v1/order/quote/',
+                json.dumps({'carts': [
+                    {'products': [{'product': product.id, 'quantity': 1}]},
+                    {'products': [{'product': product.id, 'quantity': 6}]},
+                ]}),
+                content_type='application/json'
+            )
+        self.assertHttpOK(response)
+        self.assertEquals(
+            [quote['total'] for quote in
+             json.loads(response.content.decode('utf-8'))['quotes']],
+            [1, 4]
+        )
+
+    def test_quote_ignores_stock(self):
+        """ Test a cart can be quoted even without enough stock """
+        product = mommy.make('Product', stock=0)
+
         response = self.c.post(
-            '/api/v1/order/',
+            '/api/v1/order/quote/',
             json.dumps({'products': [{'product': product.id, 'quantity': 1}]}),
             content_type='application/json'
         )
-        self.assertHttpCreated(response)
-        body = json.loads(response.content.decode())
+        self.assertHttpOK(response)
+
+    def test_quote_invalid_product(self):
+        """ Test quoting fails with 404 when a product does not exist """
+        product = mommy.make('Product')
+        product.delete()
 
-        order_id = body['id']
-        task_mock.assert_called_once_with(
-            args=[order_id, ], countdown=settings.ORDER_TIMEOUT
+        response = self.c.post(
+            '/api/v1/order/quote/',
+            json.dumps({'products': [{'product': product.id, 'quantity': 1}]}),
+            content_type='application/json'
+        )
+        self.assertHttpNotFound(response)
+
+    def test_quote_invalid_data(self):
+        """ Test quoting fails when the data is incorrectly formed """
+        product = mommy.make('Product')
+
+        for data in ({'foo': 'bar'}, {'products': []}, {'carts': [{}]},
+                     {'products': [{'product': product.id, 'quantity': -1}]},
+                     {'products': [{'product': product.id,
+                                    'quantity': 'foo'}]}):
+            response = self.c.post('/api/v1/order/quote/', json.dumps(data),
+                                   content_type='application/json')
+            self.assertHttpBadRequest(response)
+
+    def test_quote_get_not_allowed(self):
+        """ Test quotes can only be requested with POST """
+        self.assertHttpMethodNotAllowed(self.c.get('/api/v1/order/quote/'))
+
+    def post_batch(self, orders):
+        """ POST a batch of orders, returning the response and its data """
+        response = self.c.post('/api/v1/order/batch/',
+                               json.dumps({'orders': orders}),
+                               content_type='application/json')
+        return response, json.loads(response.content.decode('utf-8'))
+
+    def test_post_batch(self):
+        """ Test POST many orders at once """
+        product_1 = mommy.make('Product', price=1, unitary=True, stock=10)
+        product_2 = mommy.make('Product', price=2, unitary=True, stock=10)
+
+        response, data = self.post_batch([
+            {'products': [{'product': product_1.id, 'quantity': 3}]},
+            {'products': [{'product': product_1.id, 'quantity': 1},
+                          {'product': product_2.id, 'quantity': 2}]},
+        ])
+        self.assertHttpOK(response)
+
+        self.assertEquals([result['created'] for result in data['orders']],
+                          [True, True])
+        self.assertEquals(
+            [result['order']['total'] for result in data['orders']], [2, 5]
+        )
+        self.assertEquals(
+            [len(result['order']['products']) for result in data['orders']],
+            [1, 2]
+        )
+        self.assertEquals(Order.objects.count(), 2)
+        self.assertEquals(product_1.reserved, 4)
+        self.assertEquals(product_2.reserved, 2)
+
+    def test_post_batch_partial(self):
+        """
+        Test orders of a batch failing do not prevent the rest from being
+        created, and the result of each order is reported
+        """
+        product_1 = mommy.make('Product', stock=5)
+        product_2 = mommy.make('Product', stock=5)
+        missing = mommy.make('Product')
+        missing_id = missing.id
+        missing.delete()
+
+        response, data = self.post_batch([
+            {'products': [{'product': product_1.id, 'quantity': 4}]},
+            {'products': [{'product': product_1.id, 'quantity': 4}]},
+            {'products': [{'product': missing_id, 'quantity': 1}]},
+            {'products': [{'product': product_2.id, 'quantity': 'foo'}]},
+            {'products': [{'product': product_2.id, 'quantity': -1}]},
+            {'products': []},
+            {'products': [{'product': product_2.id, 'quantity': 5}]},
+        ])
+        self.assertHttpOK(response)
+
+        self.assertEquals([result['created'] for result in data['orders']],
+                          [True, False, False, False, False, False, True])
+        self.assertEquals(
+            [list(result.get('errors', {})) for result in data['orders']],
+            [[], ['quantity'], ['product'], ['products'], ['quantity'],
+             ['products'], []]
         )
+        self.assertEquals(Order.objects.count(), 2)
+        self.assertEquals(product_1.reserved, 4)
+        self.assertEquals(product_2.reserved, 5)
+
+    def test_post_batch_invalid_data(self):
+        """ Test POST a batch fails when it is not a list of orders """
+        for orders in ([], 'foo', [{}] * 101):
+            response = self.c.post('/api/v1/order/batch/',
+                                   json.dumps({'orders': orders}),
+                                   content_type='application/json')
+            self.assertHttpBadRequest(response)
+
+    def test_post_batch_stock_is_released_on_error(self):
+        """ Test POST a batch releases the reserved stock on errors """
+        product = mommy.make('Product', stock=10)
+
+        with patch('products.models.OrderProduct.objects.bulk_create',
+                   side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                self.post_batch([
+                    {'products': [{'product': product.id, 'quantity': 1}]},
+                    {'products': [{'product': product.id, 'quantity': 2}]},
+                ])
+        self.assertEquals(product.reserved, 0)
+        self.assertFalse(Order.objects.exists())
+
+    def test_post_batch_number_of_queries(self):
+        """
+        Test creating a batch of orders needs a single query for all of the
+        products and another one for all of the lines. Without returning the
+        ids of bulk inserts (sqlite) each order is inserted on its own
+        """
+        for size in (1, 10):
+            products = mommy.make('Product', stock=10, _quantity=3)
+
+            # Products, savepoint, orders, lines, their movements, savepoint
+            # release and the created orders along with their lines
+            with self.assertNumQueries(size + 7):
+                response, _ = self.post_batch([
+                    {'products': [{'product': product.id, 'quantity': 1}
+                                  for product in products]}
+                ] * size)
+            self.assertHttpOK(response)
 
     def test_get_list_number_of_queries(self):
         """
@@ -272,3 +821,98 @@ class OrderResourceTests(ResourceTestCaseMixin, TestCase):
 
         with self.assertNumQueries(3):
             self.assertHttpOK(self.c.get('/api/v1/order/'))
+
+
+class OrderResourceTransactionTests(ResourceTestCaseMixin,
+                                    TransactionTestCase):
+    """ Tests relying on the transactions being actually committed """
+
+    def setUp(self):
+        self.c = Client()
+
+    def tearDown(self):
+        """ Make sure cache and reservations are empty before every test """
+        reservations.get_backend().clear()
+        cache.clear()
+
+    @patch('products.expiry.schedule')
+    def test_post_expiry_is_scheduled(self, schedule_mock):
+        """ Test POST tracks the order to release it if it is not paid """
+        product = mommy.make('Product', stock=10)
+
+        response = self.c.post(
+            '/api/v1/order/',
+            json.dumps({'products': [{'product': product.id, 'quantity': 1}]}),
+            content_type='application/json'
+        )
+        self.assertHttpCreated(response)
+        body = json.loads(response.content.decode())
+
+        schedule_mock.assert_called_once_with([body['id']], traceparent=None)
+
+    @patch('products.expiry.schedule')
+    def test_post_batch_expiry_is_scheduled_once(self, schedule_mock):
+        """ Test the expiry of every order of a batch is scheduled at once """
+        product = mommy.make('Product', stock=10)
+
+        response = self.c.post(
+            '/api/v1/order/batch/',
+            json.dumps({'orders': [
+                {'products': [{'product': product.id, 'quantity': 1}]},
+            ] * 3}),
+            content_type='application/json'
+        )
+        self.assertHttpOK(response)
+
+        schedule_mock.assert_called_once_with(
+            list(Order.objects.order_by('id').values_list('id', flat=True)),
+            traceparent=None
+        )
+
+
+class ProductResourceTransactionTests(ResourceTestCaseMixin,
+                                      TransactionTestCase):
+    """ Tests relying on the transactions being actually committed """
+
+    def setUp(self):
+        self.c = Client()
+
+    def tearDown(self):
+        """ Make sure cache and reservations are empty before every test """
+        reservations.get_backend().clear()
+        cache.clear()
+
+    def test_product_change_invalidates_cache(self):
+        """ Test saving a product changes the cached catalog """
+        product = mommy.make('Product', name='name')
+        url = '/api/v1/product/{}/'.format(product.id)
+        response = self.c.get(url)
+
+        product.name = 'changed name'
+        product.save()
+
+        response = self.c.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertHttpOK(response)
+
+        body = json.loads(response.content.decode())
+        self.assertEquals(body['name'], 'changed name')
+
+    def test_payment_invalidates_cache(self):
+        """ Test completing an order changes the cached catalog """
+        order = mommy.make('Order', complete=False)
+        product = mommy.make('Product', stock=10)
+        mommy.make('OrderProduct', order=order, product=product, quantity=5)
+        product.reserve_stock(5)
+
+        url = '/api/v1/product/{}/'.format(product.id)
+        self.c.get(url)
+
+        self.c.patch(
+            '/api/v1/order/{}/'.format(order.id),
+            json.dumps({'complete': True}),
+            content_type='application/json'
+        )
+
+        body = json.loads(self.c.get(url).content.decode())
+        self.assertEquals(body['stock'], 5)
+        self.assertEquals(body['real_stock'], 5)
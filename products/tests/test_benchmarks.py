@@ -0,0 +1,95 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.test import TestCase
+
+from products import benchmarks, reservations
+from products.reservations import LocalBackend
+
+
+class BenchmarksTests(TestCase):
+
+    def tearDown(self):
+        """ Make sure cache and reservations are empty before every test """
+        reservations.get_backend().clear()
+        cache.clear()
+
+    def test_benchmarks(self):
+        """ Test every benchmark can be set up and run at its smallest size """
+        for name, (setup, sizes) in benchmarks.BENCHMARKS.items():
+            func = setup(min(sizes))
+            func()
+
+    def test_baseline_covers_benchmarks(self):
+        """ Test every benchmark has a baseline to be compared with """
+        baseline = benchmarks.load_baseline(settings.BENCHMARK_BASELINE)
+        self.assertIn(benchmarks.REFERENCE, baseline)
+
+        for name, (setup, sizes) in benchmarks.BENCHMARKS.items():
+            for size in sizes:
+                self.assertIn(benchmarks.get_key(name, size), baseline)
+
+    def test_compare(self):
+        """ Test only results slower than the threshold are regressions """
+        comparison, regressions = benchmarks.compare(
+            {'reference': 1, 'a[1]': 1.2, 'b[1]': 1.3, 'c[1]': 0.5, 'd[1]': 1},
+            {'reference': 1, 'a[1]': 1, 'b[1]': 1, 'c[1]': 1},
+            0.25
+        )
+
+        self.assertEquals(regressions, ['b[1]'])
+        changes = [change for _, _, _, change in comparison]
+        self.assertEquals(changes[0], None)
+        for change, expected in zip(changes[1:], [0.2, 0.3, -0.5, None]):
+            if expected is None:
+                self.assertEquals(change, None)
+            else:
+                self.assertAlmostEqual(change, expected)
+
+    def test_compare_relative(self):
+        """
+        Test the results are compared relative to the reference, a slower
+        machine is not a regression
+        """
+        comparison, regressions = benchmarks.compare(
+            {'reference': 2, 'a[1]': 2.2, 'b[1]': 3},
+            {'reference': 1, 'a[1]': 1, 'b[1]': 1},
+            0.25
+        )
+
+        self.assertEquals(regressions, ['b[1]'])
+        self.assertAlmostEqual(comparison[1][3], 0.1)
+
+        comparison, regressions = benchmarks.compare(
+            {'reference': 2, 'a[1]': 3}, {'a[1]': 1}, 0.25
+        )
+        self.assertEquals(regressions, [])
+        self.assertEquals(comparison[1][3], None)
+
+    def test_rescale(self):
+        """ Test results are saved in the scale of the baseline """
+        self.assertEquals(
+            benchmarks.rescale({'reference': 2, 'a[1]': 3},
+                               {'reference': 1, 'b[1]': 1}),
+            {'a[1]': 1.5}
+        )
+        self.assertEquals(
+            benchmarks.rescale({'reference': 2, 'a[1]': 3}, {}),
+            {'reference': 2, 'a[1]': 3}
+        )
+
+    def test_run_contention(self):
+        """ Test every reservation made by the threads is released """
+        backend = LocalBackend()
+        products = benchmarks.make_products(2)
+
+        latencies, rejected, exceptions, elapsed = benchmarks.run_contention(
+            backend, products, threads=3, operations=10, seed=1
+        )
+
+        self.assertEquals(len(latencies), 10)
+        self.assertEquals(rejected, 0)
+        self.assertFalse(exceptions)
+        self.assertEquals(
+            backend.get_reserved([product.id for product in products]),
+            {product.id: 0 for product in products}
+        )
@@ -0,0 +1,158 @@
+import json
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.test.client import Client
+from model_mommy import mommy
+from tastypie.test import ResourceTestCaseMixin
+
+from products import catalog, reservations
+from products.models import Order
+from products.tasks import check_order
+from products.tests.utils import BudgetTestCaseMixin, without_debug_toolbar
+
+
+SIZES = (1, 5, 20)
+
+
+@without_debug_toolbar
+@override_settings(RESERVATION_BACKEND='products.reservations.LocalBackend')
+class EndpointBudgetTests(BudgetTestCaseMixin, ResourceTestCaseMixin,
+                          TestCase):
+    """
+    Maximum SQL queries and cache calls of each endpoint. Every endpoint is
+    run at several sizes with the same budget, so anything growing with the
+    number of products or lines (e.g. a query per line) fails.
+    Cache calls are the ones made with the LocalBackend, where each
+    reservation step takes a get and a set, whatever backend the tests run
+    with
+    """
+
+    def setUp(self):
+        self.c = Client()
+
+    def tearDown(self):
+        """ Make sure cache and reservations are empty before every test """
+        reservations.get_backend().clear()
+        cache.clear()
+
+    def make_order(self, size, complete=False):
+        """ Create a pending order of size lines with its stock reserved """
+        order = mommy.make('Order', complete=complete)
+        for product in mommy.make('Product', stock=100, _quantity=size):
+            mommy.make('OrderProduct', order=order, product=product,
+                       quantity=1)
+            product.reserve_stock(1)
+
+        return order
+
+    def test_index(self):
+        """ Products and their reservations """
+        for size in SIZES:
+            mommy.make('Product', _quantity=size)
+
+            with self.assertBudget(queries=1, cache_calls=1):
+                self.assertEquals(self.c.get('/').status_code, 200)
+
+    def test_new_order(self):
+        """ The order and its lines along with their products """
+        for size in SIZES:
+            order = self.make_order(size)
+
+            with self.assertBudget(queries=2, cache_calls=0):
+                response = self.c.get('/new_order/', {'order': order.id})
+            self.assertEquals(response.status_code, 200)
+
+    def test_product_list(self):
+        """
+        The count and the products, plus the catalog version, the cached
+        response and the reservations. Only the cache once it is cached
+        """
+        for size in SIZES:
+            mommy.make('Product', _quantity=size)
+            catalog.bump_version()
+
+            with self.assertBudget(queries=2, cache_calls=4):
+                self.assertHttpOK(self.c.get('/api/v1/product/'))
+            with self.assertBudget(queries=0, cache_calls=3):
+                self.assertHttpOK(self.c.get('/api/v1/product/'))
+
+    def test_product_detail(self):
+        """ The product, plus the catalog version and the reservations """
+        for size in SIZES:
+            product = mommy.make('Product')
+            catalog.bump_version()
+
+            with self.assertBudget(queries=1, cache_calls=4):
+                self.assertHttpOK(
+                    self.c.get('/api/v1/product/{}/'.format(product.id))
+                )
+
+    def test_order_list(self):
+        """ The count, the orders and all of their lines """
+        for size in SIZES:
+            for _ in range(size):
+                self.make_order(size)
+
+            with self.assertBudget(queries=3, cache_calls=0):
+                self.assertHttpOK(self.c.get('/api/v1/order/'))
+            with self.assertBudget(queries=2, cache_calls=0):
+                self.assertHttpOK(
+                    self.c.get('/api/v1/order/', {'cursor': ''})
+                )
+
+    def test_order_detail(self):
+        """ The order and its lines """
+        for size in SIZES:
+            order = self.make_order(size)
+
+            with self.assertBudget(queries=2, cache_calls=0):
+                self.assertHttpOK(
+                    self.c.get('/api/v1/order/{}/'.format(order.id))
+                )
+
+    def test_order_create(self):
+        """
+        The products, the order, its lines, their movements and the order
+        read back, plus the reservations checked and made
+        """
+        for size in SIZES:
+            products = mommy.make('Product', stock=10, _quantity=size)
+
+            with self.assertBudget(queries=7, cache_calls=3):
+                response = self.c.post(
+                    '/api/v1/order/',
+                    json.dumps({'products': [
+                        {'product': product.id, 'quantity': 1}
+                        for product in products
+                    ]}),
+                    content_type='application/json'
+                )
+            self.assertHttpCreated(response)
+
+    def test_order_complete(self):
+        """
+        The order, its completion, its lines, their movements and the stock,
+        plus the reservations released and the order no longer pending
+        """
+        for size in SIZES:
+            order = self.make_order(size)
+
+            with self.assertBudget(queries=9, cache_calls=4):
+                response = self.c.patch(
+                    '/api/v1/order/{}/'.format(order.id),
+                    json.dumps({'complete': True}),
+                    content_type='application/json'
+                )
+            self.assertHttpAccepted(response)
+
+    def test_check_order(self):
+        """
+        The order, its lines, their movements and their deletion plus the
+        reservations
+        """
+        for size in SIZES:
+            order = self.make_order(size)
+
+            with self.assertBudget(queries=8, cache_calls=4):
+                check_order.delay(order.id)
+            self.assertFalse(Order.objects.filter(id=order.id).exists())
@@ -0,0 +1,215 @@
+import os
+import tempfile
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import TestCase
+from django.utils.six import StringIO
+from model_mommy import mommy
+from mock import patch
+
+from products import ledger, reservations
+from products.management.environment import throwaway_environment
+from products.models import Order, Product
+
+
+class RestockProductsTests(TestCase):
+
+    def restock(self, content=None, suffix='.csv', **options):
+        """ Run the command, with a file holding the content if given """
+        stdout = StringIO()
+
+        if content is None:
+            call_command('restock_products', stdout=stdout, **options)
+            return stdout.getvalue()
+
+        with tempfile.NamedTemporaryFile('w', suffix=suffix,
+                                         delete=False) as stream:
+            stream.write(content)
+        try:
+            call_command('restock_products', file=stream.name,
+                         stdout=stdout, stderr=StringIO(), **options)
+        finally:
+            os.remove(stream.name)
+
+        return stdout.getvalue()
+
+    def test_restock_all(self):
+        """ Test restocking every product with the same quantity """
+        unitary = mommy.make('Product', unitary=True, stock=0)
+        weighted = mommy.make('Product', unitary=False, stock=0)
+
+        # The products read, a single UPDATE and their movements, within the
+        # savepoint of the transaction
+        with self.assertNumQueries(5):
+            self.restock(quantity=5)
+
+        self.assertEquals(Product.objects.get(id=unitary.id).stock, 5)
+        self.assertEquals(Product.objects.get(id=weighted.id).stock, 500)
+        self.assertEquals(ledger.check(), [])
+
+    def test_restock_csv(self):
+        """ Test restocking each product with the quantity in a CSV file """
+        unitary = mommy.make('Product', unitary=True, stock=0)
+        weighted = mommy.make('Product', unitary=False, stock=0)
+        untouched = mommy.make('Product', stock=1)
+
+        output = self.restock('product,quantity\n{},3\n{},4\n'.format(
+            unitary.id, weighted.id
+        ))
+
+        self.assertIn('2 products restocked', output)
+        self.assertEquals(Product.objects.get(id=unitary.id).stock, 3)
+        self.assertEquals(Product.objects.get(id=weighted.id).stock, 400)
+        self.assertEquals(Product.objects.get(id=untouched.id).stock, 1)
+        self.assertEquals(ledger.check(), [])
+
+    def test_restock_jsonl(self):
+        """ Test restocking each product with the quantity in a JSONL file """
+        product = mommy.make('Product', unitary=True, stock=0)
+
+        self.restock('{{"product": {}, "quantity": 3}}\n'.format(product.id),
+                     suffix='.jsonl')
+
+        self.assertEquals(Product.objects.get(id=product.id).stock, 3)
+
+    def test_restock_in_chunks(self):
+        """ Test each chunk of products is updated with a single query """
+        products = mommy.make('Product', unitary=True, stock=0, _quantity=5)
+
+        # Three chunks read, updated and recorded in the ledger, within the
+        # savepoint of the transaction
+        with self.assertNumQueries(11):
+            self.restock(''.join(
+                ['product,quantity\n'] +
+                ['{},7\n'.format(product.id) for product in products]
+            ), chunk_size=2)
+
+        self.assertEquals(
+            list(Product.objects.filter(id__in=[p.id for p in products])
+                 .values_list('stock', flat=True)),
+            [7] * 5
+        )
+
+    def test_restock_invalid_row(self):
+        """ Test nothing is restocked when the file has an invalid row """
+        product = mommy.make('Product', unitary=True, stock=0)
+
+        with self.assertRaises(CommandError):
+            self.restock('product,quantity\n{},3\nfoo,bar\n'.format(
+                product.id
+            ), chunk_size=1)
+
+        self.assertEquals(Product.objects.get(id=product.id).stock, 0)
+
+    def test_restock_bumps_catalog_version_once(self):
+        """ Test the catalog version is bumped once, after the restock """
+        mommy.make('Product', _quantity=3)
+
+        with patch('products.catalog.bump_version_on_commit') as bump_mock:
+            self.restock(quantity=5)
+        bump_mock.assert_called_once_with()
+
+
+class BackfillOrderTotalsTests(TestCase):
+
+    def test_backfill(self):
+        """ Test orders without a total get the one of their lines """
+        product = mommy.make('Product', price=2, unitary=True)
+        order = mommy.make('Order')
+        mommy.make('OrderProduct', order=order, product=product, quantity=3)
+        priced = mommy.make('Order', total=10, line_count=1)
+
+        stdout = StringIO()
+        call_command('backfill_order_totals', stdout=stdout)
+
+        self.assertIn('1 orders backfilled', stdout.getvalue())
+        order = Order.objects.get(id=order.id)
+        self.assertEquals(order.total, 4)
+        self.assertEquals(order.line_count, 1)
+        self.assertEquals(order.discounts, '3x2')
+        self.assertEquals(Order.objects.get(id=priced.id).total, 10)
+
+    def test_backfill_in_chunks(self):
+        """ Test each chunk of orders needs the same number of queries """
+        products = mommy.make('Product', _quantity=3)
+        for order in mommy.make('Order', _quantity=5):
+            for product in products:
+                mommy.make('OrderProduct', order=order, product=product)
+
+        # Orders, lines and UPDATE for each one of the 3 chunks, plus the
+        # query finding there is nothing left
+        with self.assertNumQueries(3 * 3 + 1):
+            call_command('backfill_order_totals', chunk_size=2,
+                         stdout=StringIO())
+
+        self.assertFalse(Order.objects.filter(total__isnull=True).exists())
+        self.assertEquals(
+            set(Order.objects.values_list('line_count', flat=True)), {3}
+        )
+
+
+class RebuildReservationsTests(TestCase):
+
+    def tearDown(self):
+        """ Make sure cache and reservations are empty before every test """
+        reservations.get_backend().clear()
+        cache.clear()
+
+    def test_rebuild(self):
+        """ Test the reservations lost are reported and rebuilt """
+        product = mommy.make('Product', stock=10)
+        order = mommy.make('Order', complete=False)
+        mommy.make('OrderProduct', order=order, product=product, quantity=4)
+
+        with self.assertRaises(CommandError):
+            call_command('rebuild_reservations', check=True,
+                         stdout=StringIO())
+
+        stdout = StringIO()
+        call_command('rebuild_reservations', stdout=stdout)
+
+        self.assertIn('Reservations of 1 products rebuilt', stdout.getvalue())
+        self.assertEquals(product.reserved, 4)
+        call_command('rebuild_reservations', check=True, stdout=StringIO())
+
+    def test_rebuild_if_lost(self):
+        """ Test only the reservations lost are rebuilt """
+        product = mommy.make('Product', stock=10)
+        order = mommy.make('Order', complete=False)
+        mommy.make('OrderProduct', order=order, product=product, quantity=4)
+
+        stdout = StringIO()
+        call_command('rebuild_reservations', if_lost=True, stdout=stdout)
+        self.assertIn('Lost reservations rebuilt', stdout.getvalue())
+        self.assertEquals(product.reserved, 4)
+
+        product.reserve_stock(1)
+        stdout = StringIO()
+        call_command('rebuild_reservations', if_lost=True, stdout=stdout)
+        self.assertIn('No reservations lost', stdout.getvalue())
+        self.assertEquals(product.reserved, 5)
+
+
+class ThrowawayEnvironmentTests(TestCase):
+
+    def test_restores_test_name(self):
+        """
+        Test the name of the test database is restored once the throwaway
+        environment is left, the database itself is not created here
+        """
+        test_name = connection.settings_dict['TEST']['NAME']
+
+        with patch.object(connection.creation, 'create_test_db'), \
+                patch.object(connection.creation, 'destroy_test_db'), \
+                patch('products.management.environment.'
+                      'setup_test_environment'), \
+                patch('products.management.environment.'
+                      'teardown_test_environment'):
+            with throwaway_environment('test', threads=True):
+                path = connection.settings_dict['TEST']['NAME']
+            os.remove(path)
+
+        self.assertNotEqual(path, test_name)
+        self.assertEquals(connection.settings_dict['TEST']['NAME'], test_name)
@@ -0,0 +1,129 @@
+import time
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from model_mommy import mommy
+
+from products import expiry, reservations
+from products.models import Order, OrderProduct
+from products.tasks import check_order, release_expired_orders
+
+
+class ExpiryTests(TestCase):
+
+    def tearDown(self):
+        """ Make sure cache and reservations are empty before every test """
+        reservations.get_backend().clear()
+        cache.clear()
+
+    def make_order(self, quantity=2, complete=False):
+        """ Create a pending order with its stock reserved """
+        product = mommy.make('Product', stock=10)
+        order = mommy.make('Order', complete=complete)
+        mommy.make('OrderProduct', order=order, product=product,
+                   quantity=quantity)
+        product.reserve_stock(quantity)
+
+        return order, product
+
+    def test_get_expired(self):
+        """ Test only orders past their deadline are expired, oldest first """
+        expiry.schedule([1, 2], timeout=-10)
+        expiry.schedule([3], timeout=-20)
+        expiry.schedule([4], timeout=10)
+
+        self.assertEquals(expiry.get_expired(), [3, 1, 2])
+
+    def test_forget(self):
+        """ Test forgotten orders are no longer expired """
+        expiry.schedule([1, 2], timeout=-10)
+        expiry.forget([1])
+
+        self.assertEquals(expiry.get_expired(), [2])
+
+    @override_settings(ORDER_TIMEOUT=10)
+    def test_track_pending(self):
+        """
+        Test the pending orders are tracked to expire after their creation,
+        keeping the deadlines of the ones already tracked
+        """
+        pending, _ = self.make_order()
+        tracked, _ = self.make_order()
+        self.make_order(complete=True)
+        expiry.schedule([tracked.id], timeout=1000)
+        created = pending.created.timestamp()
+
+        with self.assertNumQueries(1):
+            self.assertEquals(expiry.track_pending(), 2)
+
+        self.assertEquals(expiry.get_expired(now=created + 9), [])
+        self.assertEquals(expiry.get_expired(now=created + 10), [pending.id])
+
+    def test_warm_start(self):
+        """ Test the pending orders are only tracked again once lost """
+        order, _ = self.make_order()
+
+        self.assertTrue(expiry.warm_start())
+        self.assertFalse(expiry.warm_start())
+        self.assertEquals(expiry.get_expired(now=time.time() + 60),
+                          [order.id])
+
+        cache.clear()
+        self.assertTrue(expiry.warm_start())
+        self.assertEquals(expiry.get_expired(now=time.time() + 60),
+                          [order.id])
+
+    def test_release_expired_orders(self):
+        """ Test expired orders are deleted and their stock released """
+        order, product = self.make_order(quantity=2)
+        expiry.schedule([order.id])
+
+        self.assertEquals(
+            expiry.release_expired_orders(now=time.time() + 60), 1
+        )
+        self.assertFalse(Order.objects.filter(id=order.id).exists())
+        self.assertFalse(OrderProduct.objects.exists())
+        self.assertEquals(product.reserved, 0)
+        self.assertEquals(expiry.get_expired(now=time.time() + 60), [])
+
+    def test_release_expired_orders_not_expired(self):
+        """ Test orders within their deadline are not released """
+        order, product = self.make_order(quantity=2)
+        expiry.schedule([order.id])
+
+        self.assertEquals(expiry.release_expired_orders(), 0)
+        self.assertTrue(Order.objects.filter(id=order.id).exists())
+        self.assertEquals(product.reserved, 2)
+
+    def test_release_expired_orders_complete(self):
+        """ Test paid orders are kept when their deadline passes """
+        order, product = self.make_order(quantity=2, complete=True)
+        expiry.schedule([order.id])
+
+        self.assertEquals(
+            expiry.release_expired_orders(now=time.time() + 60), 0
+        )
+        self.assertTrue(Order.objects.filter(id=order.id).exists())
+        self.assertEquals(expiry.get_expired(now=time.time() + 60), [])
+
+    @override_settings(ORDER_SWEEP_BATCH=2)
+    def test_release_expired_orders_in_batches(self):
+        """ Test every expired order is released even beyond a batch """
+        orders = [self.make_order(quantity=1)[0] for _ in range(5)]
+        expiry.schedule([order.id for order in orders], timeout=-1)
+
+        # Three batches, each one needing the same number of queries no
+        # matter how many orders or lines it has
+        with self.assertNumQueries(3 * 8):
+            self.assertEquals(release_expired_orders.delay().get(), 5)
+        self.assertFalse(Order.objects.exists())
+
+    def test_check_order(self):
+        """ Test the check_order task still releases a single order """
+        order, product = self.make_order(quantity=2)
+        expiry.schedule([order.id])
+
+        check_order.delay(order.id)
+
+        self.assertFalse(Order.objects.filter(id=order.id).exists())
+        self.assertEquals(product.reserved, 0)
+        self.assertEquals(expiry.get_expired(now=time.time() + 60), [])
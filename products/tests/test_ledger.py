@@ -0,0 +1,186 @@
+import json
+import time
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.test.client import Client
+from mock import patch
+from model_mommy import mommy
+
+from products import expiry, ledger, reservations
+from products.models import Product, StockMovement, StockSnapshot
+
+
+class LedgerTests(TestCase):
+
+    def setUp(self):
+        self.c = Client()
+
+    def tearDown(self):
+        """ Make sure cache and reservations are empty before every test """
+        reservations.get_backend().clear()
+        cache.clear()
+
+    def post_order(self, product, quantity):
+        """ Post an order of the product, returns its id """
+        response = self.c.post('/api/v1/order/', json.dumps({
+            'products': [{'product': product.id, 'quantity': quantity}],
+        }), content_type='application/json')
+        self.assertEquals(response.status_code, 201)
+
+        return json.loads(response.content.decode('utf-8'))['id']
+
+    def get_movements(self, product):
+        """ Get the (kind, order id, quantity) movements of the product """
+        return list(StockMovement.objects.filter(product=product)
+                    .order_by('id').values_list('kind', 'order_id',
+                                                'quantity'))
+
+    def test_order_workflow(self):
+        """
+        Test the movements of the whole life of the orders are recorded and
+        match the stock and the pending orders
+        """
+        product = mommy.make('Product', stock=10)
+        paid = self.post_order(product, 3)
+        expired = self.post_order(product, 2)
+        self.assertEquals(ledger.get_levels([product.id]),
+                          {product.id: (10, 5)})
+
+        self.c.patch('/api/v1/order/{}/'.format(paid),
+                     json.dumps({'complete': True}),
+                     content_type='application/json')
+        expiry.release_orders([expired])
+
+        self.assertEquals(self.get_movements(product), [
+            (StockMovement.KIND_RESTOCK, None, 10),
+            (StockMovement.KIND_RESERVE, paid, 3),
+            (StockMovement.KIND_RESERVE, expired, 2),
+            (StockMovement.KIND_RELEASE, paid, -3),
+            (StockMovement.KIND_SELL, paid, -3),
+            (StockMovement.KIND_EXPIRE, expired, -2),
+        ])
+        self.assertEquals(ledger.get_levels([product.id]),
+                          {product.id: (7, 0)})
+        self.assertEquals(ledger.check(), [])
+
+    def test_product_saved(self):
+        """ Test the changes of the stock of a product saved are recorded """
+        product = mommy.make('Product', stock=10)
+        product.stock = 4
+        product.save()
+        product.name = 'renamed'
+        product.save()
+
+        self.assertEquals(self.get_movements(product), [
+            (StockMovement.KIND_RESTOCK, None, 10),
+            (StockMovement.KIND_RESTOCK, None, -6),
+        ])
+        self.assertEquals(ledger.check(), [])
+
+    @override_settings(STOCK_LEDGER=False)
+    def test_disabled(self):
+        """ Test nothing is recorded when the ledger is not kept """
+        product = mommy.make('Product', stock=10)
+        self.post_order(product, 3)
+
+        self.assertEquals(self.get_movements(product), [])
+
+    def test_get_levels(self):
+        """ Test the levels of several products take a single query """
+        product_1 = mommy.make('Product', stock=10)
+        product_2 = mommy.make('Product', stock=4)
+        self.post_order(product_1, 3)
+
+        with self.assertNumQueries(1):
+            self.assertEquals(
+                ledger.get_levels([product_1.id, product_2.id]),
+                {product_1.id: (10, 3), product_2.id: (4, 0)}
+            )
+
+    def test_compact(self):
+        """
+        Test the movements are folded into snapshots and the levels are
+        the snapshots plus the movements after them
+        """
+        product_1 = mommy.make('Product', stock=10)
+        product_2 = mommy.make('Product', stock=4)
+        self.post_order(product_1, 3)
+
+        self.assertEquals(ledger.compact(lag=0), Product.objects.count())
+        self.assertEquals(
+            StockSnapshot.objects.get(product=product_1).stock, 10
+        )
+        self.assertEquals(
+            StockSnapshot.objects.get(product=product_1).reserved, 3
+        )
+
+        self.post_order(product_1, 2)
+        self.assertEquals(
+            ledger.get_levels([product_1.id, product_2.id]),
+            {product_1.id: (10, 5), product_2.id: (4, 0)}
+        )
+
+        self.assertEquals(ledger.compact(lag=0), 1)
+        self.assertEquals(ledger.compact(lag=0), 0)
+        self.assertEquals(
+            StockSnapshot.objects.get(product=product_1).reserved, 5
+        )
+        self.assertEquals(
+            ledger.get_levels([product_1.id, product_2.id]),
+            {product_1.id: (10, 5), product_2.id: (4, 0)}
+        )
+        self.assertEquals(ledger.check(), [])
+
+    def test_compact_lag(self):
+        """ Test the recent movements are left to a later compaction """
+        product = mommy.make('Product', stock=10)
+
+        self.assertEquals(ledger.compact(lag=60), 0)
+        self.assertFalse(StockSnapshot.objects.exists())
+
+        with patch('products.ledger.timezone.now',
+                   return_value=StockMovement.objects.get(
+                       product=product
+                   ).created):
+            ledger.compact(lag=0)
+        self.assertEquals(StockSnapshot.objects.get(product=product).stock,
+                          10)
+
+    def test_compact_conflict(self):
+        """ Test movements already folded by another compaction are not """
+        product = mommy.make('Product', stock=10)
+        ledger.compact(lag=0)
+        self.post_order(product, 3)
+        changes = list(ledger.get_changes(StockMovement.objects.all()))
+
+        ledger.compact(lag=0)
+        with patch('products.ledger.get_changes', return_value=changes):
+            self.assertEquals(ledger.compact(lag=0), 0)
+
+        snapshot = StockSnapshot.objects.get(product=product)
+        self.assertEquals((snapshot.stock, snapshot.reserved), (10, 3))
+
+    def test_check(self):
+        """ Test check finds stock changed behind the ledger and oversells """
+        product = mommy.make('Product', stock=2)
+        Product.objects.filter(pk=product.pk).update(stock=5)
+        ledger.record([(StockMovement.KIND_SELL, None, product.id, 3)])
+
+        self.assertEquals(ledger.check(), [
+            'Product {} was oversold, its ledger stock is -1'
+            .format(product.id),
+            'Product {} stock (5) does not match its ledger (-1)'
+            .format(product.id),
+        ])
+
+    def test_expired_orders_keep_movements(self):
+        """ Test the movements of the orders expired are kept """
+        product = mommy.make('Product', stock=10)
+        order_id = self.post_order(product, 3)
+        expiry.schedule([order_id])
+
+        expiry.release_expired_orders(time.time() + 60)
+
+        self.assertEquals(
+            StockMovement.objects.filter(order_id=order_id).count(), 2
+        )
@@ -0,0 +1,69 @@
+from django.core.cache import cache
+from django.test import TestCase, TransactionTestCase
+from model_mommy import mommy
+
+from products import loadtest, reservations
+from products.tests.utils import without_debug_toolbar
+
+
+class LoadTestTests(TestCase):
+
+    def tearDown(self):
+        """ Make sure cache and reservations are empty before every test """
+        reservations.get_backend().clear()
+        cache.clear()
+
+    def test_percentile(self):
+        """ Test percentiles use the nearest rank """
+        values = list(range(1, 101))
+
+        self.assertEquals(loadtest.percentile(values, 50), 50)
+        self.assertEquals(loadtest.percentile(values, 99), 99)
+        self.assertEquals(loadtest.percentile([3, 1, 2], 95), 3)
+        self.assertEquals(loadtest.percentile([], 50), 0)
+
+    def test_check(self):
+        """ Test the stock left is checked against the orders """
+        product = mommy.make('Product', stock=8)
+        order = mommy.make('Order', complete=True)
+        mommy.make('OrderProduct', order=order, product=product, quantity=2)
+
+        self.assertEquals(loadtest.check([product.id], 10), [])
+        self.assertEquals(len(loadtest.check([product.id], 12)), 1)
+
+    def test_check_oversold(self):
+        """ Test negative stocks and leaked reservations are found """
+        product = mommy.make('Product', stock=-1)
+        product.stock = 10
+        product.reserve_stock(1)
+
+        self.assertEquals(len(loadtest.check([product.id], -1)), 2)
+
+
+@without_debug_toolbar
+class LoadTestRunTests(TransactionTestCase):
+
+    def tearDown(self):
+        """ Make sure cache and reservations are empty before every test """
+        reservations.get_backend().clear()
+        cache.clear()
+
+    def test_run(self):
+        """
+        Test clients go through every step of the purchase. A single one, the
+        in memory database of the tests can not take concurrent writes
+        """
+        product_ids = [
+            product.id for product in
+            mommy.make('Product', stock=1000, unitary=True, _quantity=3)
+        ]
+
+        stats, elapsed = loadtest.run(product_ids, clients=1, purchases=6,
+                                      seed=1)
+
+        for step in loadtest.STEPS:
+            self.assertEquals(len(stats.latencies[step]), 6)
+            self.assertEquals(stats.errors[step], 0)
+        self.assertEquals(loadtest.check(product_ids, 1000), [])
+        self.assertIn('6 orders completed',
+                      loadtest.report(stats, elapsed)[-1])
@@ -0,0 +1,158 @@
+from celery.signals import after_task_publish
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.test.client import Client
+from model_mommy import mommy
+from redis.client import Pipeline, Redis
+from redis.exceptions import ConnectionError
+
+from products import metrics, reservations
+from products.tests.utils import without_debug_toolbar
+
+
+@without_debug_toolbar
+class MetricsTests(TestCase):
+
+    def setUp(self):
+        self.c = Client()
+        metrics.reset()
+
+    def tearDown(self):
+        """ Make sure cache and reservations are empty before every test """
+        reservations.get_backend().clear()
+        cache.clear()
+
+    def get_metric(self, name, endpoint, method='GET', suffix='count'):
+        """ Get the value of a metric out of the metrics endpoint """
+        prefix = '{}_{}{{endpoint="{}",method="{}"}} '.format(
+            name, suffix, endpoint, method
+        )
+        for line in self.c.get('/metrics/').content.decode().splitlines():
+            if line.startswith(prefix):
+                return float(line[len(prefix):])
+
+    @override_settings(
+        RESERVATION_BACKEND='products.reservations.LocalBackend'
+    )
+    def test_request_metrics(self):
+        """ Test the latency, queries and cache calls of views are recorded """
+        mommy.make('Product', _quantity=3)
+
+        self.c.get('/')
+        self.c.get('/')
+
+        self.assertEquals(
+            self.get_metric('mums_request_duration_seconds', 'index'), 2
+        )
+        self.assertGreater(
+            self.get_metric('mums_request_duration_seconds', 'index',
+                            suffix='sum'), 0
+        )
+        # The products and their reservations, for each request
+        self.assertEquals(
+            self.get_metric('mums_db_queries', 'index', suffix='sum'), 2
+        )
+        self.assertEquals(
+            self.get_metric('mums_cache_calls', 'index', suffix='sum'), 2
+        )
+
+    def test_api_metrics(self):
+        """ Test the API requests are recorded by resource """
+        self.c.get('/api/v1/product/')
+        self.c.get('/api/v1/order/')
+        self.c.post('/api/v1/order/quote/', '{}',
+                    content_type='application/json')
+
+        self.assertEquals(
+            self.get_metric('mums_db_queries', 'api:product:list'), 1
+        )
+        self.assertEquals(
+            self.get_metric('mums_db_queries', 'api:order:list'), 1
+        )
+        self.assertEquals(
+            self.get_metric('mums_db_queries', 'api:order:order_quote',
+                            method='POST'), 1
+        )
+
+    def test_unknown_method(self):
+        """ Test made up methods share a single label """
+        self.c.generic('FOO', '/')
+        self.c.generic('BAR', '/')
+
+        self.assertEquals(
+            self.get_metric('mums_request_duration_seconds', 'index',
+                            method='other'), 2
+        )
+        self.assertNotIn('FOO', self.c.get('/metrics/').content.decode())
+
+    def test_metrics_access(self):
+        """
+        Test the metrics are only served to the allowed networks and the
+        staff
+        """
+        self.assertEquals(self.c.get('/metrics/').status_code, 200)
+
+        outside = Client(REMOTE_ADDR='203.0.113.1')
+        self.assertEquals(outside.get('/metrics/').status_code, 403)
+
+        with self.settings(METRICS_ALLOWED_NETWORKS=['203.0.113.0/24']):
+            self.assertEquals(outside.get('/metrics/').status_code, 200)
+
+        outside.force_login(mommy.make('auth.User', is_staff=True))
+        self.assertEquals(outside.get('/metrics/').status_code, 200)
+
+    def test_histogram_buckets(self):
+        """ Test the buckets of the histograms are cumulative """
+        collector = metrics.Collector()
+        collector.counts['db'] = 3
+        metrics.observe('index', 'GET', collector)
+        collector.counts['db'] = 30
+        metrics.observe('index', 'GET', collector)
+
+        lines = metrics.render().splitlines()
+
+        self.assertIn('# TYPE mums_db_queries histogram', lines)
+        for bucket, count in (('2', 0), ('5', 1), ('20', 1), ('50', 2),
+                              ('+Inf', 2)):
+            self.assertIn(
+                'mums_db_queries_bucket{{endpoint="index",method="GET",'
+                'le="{}"}} {}'.format(bucket, count),
+                lines
+            )
+        self.assertIn(
+            'mums_db_queries_sum{endpoint="index",method="GET"} 33', lines
+        )
+
+    def test_celery_publishes(self):
+        """ Test the tasks published by a request are counted """
+        metrics.install()
+        collector = metrics.start()
+        try:
+            after_task_publish.send(sender='products.tasks.check_order')
+        finally:
+            metrics.stop()
+
+        self.assertEquals(collector.counts['celery'], 1)
+
+    def test_not_collecting(self):
+        """ Test nothing is counted out of a request """
+        metrics.install()
+        cache.get('foo')
+
+        self.assertEquals(metrics.render().count('_count{'), 0)
+
+    def test_redis_client(self):
+        """
+        Test the commands of the raw redis client and its pipelines are
+        counted, whatever the version of redis-py
+        """
+        metrics.install()
+        self.assertTrue(getattr(Redis.execute_command, 'metrics_timed', False))
+        self.assertTrue(getattr(Pipeline.execute, 'metrics_timed', False))
+
+        # Nothing listens on the port, the failed command is still counted
+        with metrics.collecting() as collector:
+            with self.assertRaises(ConnectionError):
+                Redis(port=1).get('foo')
+
+        self.assertEquals(collector.counts['cache'], 1)
@@ -1,15 +1,17 @@
 from django.core.cache import cache
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from model_mommy import mommy
-from mock import patch, ANY
+from mock import patch
 
+from products import reservations
 from products.models import Product, Order, OrderProduct
 
 
 class ProductTests(TestCase):
 
     def tearDown(self):
-        """ Make sure cache is empty before every test """
+        """ Make sure cache and reservations are empty before every test """
+        reservations.get_backend().clear()
         cache.clear()
 
     def test_save_product(self):
@@ -27,6 +29,19 @@ class ProductTests(TestCase):
             product.name, Product.objects.get(pk=product.pk).name
         )
 
+    def test_stock_change(self):
+        """ Test the change of the stock of the last save is kept """
+        product = mommy.make('Product', stock=10)
+        self.assertEquals(product.stock_change, 10)
+
+        Product.objects.filter(pk=product.pk).update(stock=8)
+        product.stock = 15
+        product.save()
+        self.assertEquals(product.stock_change, 7)
+
+        product.save(update_fields=['name'])
+        self.assertEquals(product.stock_change, 0)
+
     def test_delete_product(self):
         """ Test delete of a product """
         product = mommy.make('Product')
@@ -50,22 +65,36 @@ class ProductTests(TestCase):
         product = mommy.make('Product', stock=10)
         self.assertEquals(product.real_stock, 10)
 
-    def test_reserve_stock_sets_cache(self):
-        """ Test reserving stock for the first time calls cache.set """
-        product = mommy.make('Product', stock=10)
-
-        with patch('django.core.cache.cache.set') as cache_mock:
-            product.reserve_stock(5)
-            cache_mock.assert_called_once_with(ANY, 5)
-
-    def test_reserve_stock_increments_cache(self):
-        """ Test reserving stock for the second time calls cache.incr """
+    def test_reserved_uses_snapshot(self):
+        """ Test reserved does not hit the cache when read in a snapshot """
         product = mommy.make('Product', stock=10)
         product.reserve_stock(5)
+        product, = reservations.with_reserved([product])
+
+        with patch('products.reservations.get_reserved') as reserved_mock:
+            self.assertEquals(product.real_stock, 5)
+            self.assertFalse(reserved_mock.called)
+
+    @override_settings(
+        RESERVATION_BACKEND='products.reservations.LocalBackend'
+    )
+    def test_reserve_stock_stored_in_single_hash(self):
+        """ Test reservations of every product are stored under one key """
+        product_1 = mommy.make('Product', stock=10)
+        product_2 = mommy.make('Product', stock=10)
+        product_1.reserve_stock(5)
+        product_2.reserve_stock(3)
+
+        self.assertEquals(cache.get(reservations.RESERVED_KEY),
+                          {product_1.id: 5, product_2.id: 3})
+
+    def test_reserve_stock_discards_snapshot(self):
+        """ Test reserving stock discards the snapshot of the reservations """
+        product = mommy.make('Product', stock=10)
+        product, = reservations.with_reserved([product])
+        product.reserve_stock(3)
 
-        with patch('django.core.cache.cache.incr') as cache_mock:
-            product.reserve_stock(3)
-            cache_mock.assert_called_once_with(ANY, 3)
+        self.assertEquals(product.real_stock, 7)
 
     def test_reserve_stock(self):
         """ Test real stock is updated after reserving items """
@@ -104,15 +133,6 @@ class ProductTests(TestCase):
 
         self.assertEquals(product.real_stock, 7)
 
-    def test_release_stock_decrements_cache(self):
-        """ Test releasing stock calls cache.decr """
-        product = mommy.make('Product', stock=10)
-        product.reserve_stock(5)
-
-        with patch('django.core.cache.cache.decr') as cache_mock:
-            product.release_stock(3)
-            cache_mock.assert_called_once_with(ANY, 3)
-
     def test_release_stock_too_much(self):
         """
         Test exception is raised when trying to release more than reserved
@@ -258,3 +278,12 @@ class OrderProductTests(TestCase):
 
         total_price *= 0.8  # Full menu discount should have been applied
         self.assertEquals(order.price(), total_price)
+
+    def test_price_number_of_queries(self):
+        """ Test pricing an order needs a single query for all of its lines """
+        order = mommy.make('Order')
+        for product in mommy.make('Product', _quantity=5):
+            mommy.make('OrderProduct', order=order, product=product)
+
+        with self.assertNumQueries(1):
+            order.price()
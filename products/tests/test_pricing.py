@@ -0,0 +1,90 @@
+from django.test import TestCase
+from model_mommy import mommy
+
+from products.models import Product, Order
+from products.pricing import FullMenu, PricingEngine, ThreeForTwo
+
+
+class PricingEngineTests(TestCase):
+
+    def test_quote(self):
+        """ Test unitary products are priced by unit and the rest by 100 gr """
+        product_1 = mommy.make('Product', price=1, unitary=True)
+        product_2 = mommy.make('Product', price=2, unitary=False)
+
+        quote = PricingEngine().quote([(product_1, 2), (product_2, 150)])
+
+        self.assertEquals(quote.total, 2 * 1 + 1.5 * 2)
+        self.assertEquals(quote.lines, 2)
+        self.assertEquals(quote.discounts, [])
+
+    def test_quote_three_for_two(self):
+        """ Test 3x2 is only applied on unitary products """
+        product_1 = mommy.make('Product', price=1, unitary=True)
+        product_2 = mommy.make('Product', price=1, unitary=False)
+        engine = PricingEngine(line_rules=[ThreeForTwo()])
+
+        self.assertEquals(engine.quote([(product_1, 7)]).total, 5)
+        self.assertEquals(engine.quote([(product_1, 7)]).discounts, ['3x2'])
+        self.assertEquals(engine.quote([(product_1, 2)]).discounts, [])
+        self.assertEquals(engine.quote([(product_2, 300)]).total, 3)
+        self.assertEquals(engine.quote([(product_2, 300)]).discounts, [])
+
+    def test_quote_full_menu(self):
+        """ Test full menu is only applied with every category in the cart """
+        engine = PricingEngine(cart_rules=[FullMenu([0, 1, 2], 0.5)])
+        products = [
+            mommy.make('Product', price=10, unitary=True, category=category)
+            for category in (0, 1, 2)
+        ]
+
+        quote = engine.quote([(product, 1) for product in products])
+        self.assertEquals(quote.total, 15)
+        self.assertEquals(quote.discounts, ['full_menu'])
+
+        quote = engine.quote([(product, 1) for product in products[:2]])
+        self.assertEquals(quote.total, 20)
+        self.assertEquals(quote.discounts, [])
+
+    def test_quote_many(self):
+        """ Test many carts are priced independently in a single call """
+        product_1 = mommy.make('Product', price=1, unitary=True)
+        product_2 = mommy.make('Product', price=3, unitary=True)
+
+        with self.assertNumQueries(0):
+            quotes = Order.pricing_engine.quote_many([
+                [(product_1, 3)],
+                [(product_1, 1), (product_2, 1)],
+                [],
+            ])
+
+        self.assertEquals([quote.total for quote in quotes], [2, 4, 0])
+        self.assertEquals([quote.lines for quote in quotes], [1, 2, 0])
+
+    def test_price_lines(self):
+        """ Test the lines are priced with the line rules only """
+        engine = PricingEngine(line_rules=[ThreeForTwo()],
+                               cart_rules=[FullMenu([0, 1], 0.5)])
+        product_1 = mommy.make('Product', price=1, unitary=True, category=0)
+        product_2 = mommy.make('Product', price=2, unitary=False, category=1)
+
+        lines = [(product_1, 3), (product_2, 150)]
+        self.assertEquals(engine.price_lines(lines), [2, 3])
+        self.assertEquals(engine.quote(lines).total, (2 + 3) * 0.5)
+
+    def test_quote_same_as_order_price(self):
+        """ Test a cart is priced the same as an order with its products """
+        order = mommy.make('Order')
+        for category, _ in Product.CATEGORY_CHOICES:
+            product = mommy.make('Product', category=category, unitary=True)
+            mommy.make('OrderProduct', order=order, product=product,
+                       quantity=4)
+
+        self.assertEquals(
+            Order.pricing_engine.quote(order.get_lines()).total,
+            order.price()
+        )
+        self.assertEquals(
+            Order.pricing_engine.quote(order.get_lines()).discounts,
+            ['3x2', 'full_menu']
+        )
@@ -0,0 +1,518 @@
+import os
+import redis
+import threading
+from unittest import skipUnless
+from django.conf import settings
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from mock import patch
+from model_mommy import mommy
+
+from products import reservations, stock
+from products.api.resources_v1 import OrderResource
+from products.models import Product
+
+
+# Redis nodes to test the RedisRingBackend with, comma separated urls of
+# running redis servers, e.g. redis://127.0.0.1:6380/0,redis://127.0.0.1:6381/0
+RING_NODES = [
+    url for url in os.environ.get('RESERVATION_REDIS_TEST_NODES', '')
+    .split(',') if url
+]
+
+
+def is_redis_available(url):
+    """ Check whether a redis server answers at the url """
+    try:
+        return redis.StrictRedis.from_url(url, socket_connect_timeout=1).ping()
+    except redis.RedisError:
+        return False
+
+
+# Cache keeping the reservations of the RedisBackend tests, on REDIS_URL under
+# a prefix of their own
+REDIS_CACHES = {
+    'default': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': settings.REDIS_URL,
+        'KEY_PREFIX': 'test_reservations',
+        'OPTIONS': {
+            'CLIENT_CLASS': 'django_redis.client.DefaultClient'
+        }
+    }
+}
+
+
+class ReservationsTests(TestCase):
+
+    def tearDown(self):
+        """ Make sure cache and reservations are empty before every test """
+        reservations.get_backend().clear()
+        cache.clear()
+
+    def test_get_reserved(self):
+        """ Test getting the reserved amount of several products at once """
+        product_1 = mommy.make('Product', stock=10)
+        product_2 = mommy.make('Product', stock=10)
+        product_1.reserve_stock(3)
+
+        self.assertEquals(
+            reservations.get_reserved([product_1.id, product_2.id]),
+            {product_1.id: 3, product_2.id: 0}
+        )
+
+    def test_reserve(self):
+        """ Test reserving several products at once """
+        product_1 = mommy.make('Product', stock=10)
+        product_2 = mommy.make('Product', stock=10)
+
+        reservations.reserve([(product_1, 3), (product_2, 5)])
+
+        self.assertEquals(product_1.reserved, 3)
+        self.assertEquals(product_2.reserved, 5)
+
+    def test_reserve_all_or_nothing(self):
+        """ Test nothing is reserved when one of the products lacks stock """
+        product_1 = mommy.make('Product', stock=10)
+        product_2 = mommy.make('Product', stock=2)
+
+        with self.assertRaises(ValueError):
+            reservations.reserve([(product_1, 3), (product_2, 5)])
+
+        self.assertEquals(product_1.reserved, 0)
+        self.assertEquals(product_2.reserved, 0)
+
+    def test_reserve_many(self):
+        """
+        Test each order of a batch is reserved on its own, seeing the stock
+        reserved by the previous ones
+        """
+        product_1 = mommy.make('Product', stock=10)
+        product_2 = mommy.make('Product', stock=2)
+
+        self.assertEquals(reservations.reserve_many([
+            [(product_1, 3), (product_2, 2)],
+            [(product_1, 3), (product_2, 1)],
+            [(product_1, 8)],
+            [(product_1, 4)],
+        ]), [True, False, False, True])
+
+        self.assertEquals(product_1.reserved, 7)
+        self.assertEquals(product_2.reserved, 2)
+
+    def test_reserve_same_product_twice(self):
+        """ Test lines of the same product are checked together """
+        product = mommy.make('Product', stock=10)
+
+        with self.assertRaises(ValueError):
+            reservations.reserve([(product, 6), (product, 6)])
+
+        reservations.reserve([(product, 4), (product, 6)])
+        self.assertEquals(product.reserved, 10)
+
+    def test_reserve_negative_quantity(self):
+        """ Test exception is raised when reserving a negative quantity """
+        product = mommy.make('Product', stock=10)
+
+        with self.assertRaises(ValueError):
+            reservations.reserve([(product, -1)])
+
+    def test_release(self):
+        """ Test releasing several products at once """
+        product_1 = mommy.make('Product', stock=10)
+        product_2 = mommy.make('Product', stock=10)
+        reservations.reserve([(product_1, 3), (product_2, 5)])
+
+        reservations.release([(product_1, 1), (product_2, 5)])
+
+        self.assertEquals(product_1.reserved, 2)
+        self.assertEquals(product_2.reserved, 0)
+
+    def test_sell(self):
+        """ Test the units sold are still taken until they are forgotten """
+        product = mommy.make('Product', stock=10)
+        reservations.reserve([(product, 6)])
+
+        reservations.sell([(product, 4)])
+        self.assertEquals(reservations.get_counts([product.id]),
+                          {product.id: (2, 4)})
+        self.assertEquals(product.reserved, 6)
+        with self.assertRaises(ValueError):
+            reservations.reserve([(product, 5)])
+
+        reservations.forget_sold([(product, 4)])
+        self.assertEquals(reservations.get_counts([product.id]),
+                          {product.id: (2, 0)})
+        reservations.reserve([(product, 8)])
+
+    def test_rebuild(self):
+        """ Test every reservation is replaced by the ones given """
+        product_1 = mommy.make('Product', stock=10)
+        product_2 = mommy.make('Product', stock=10)
+        reservations.reserve([(product_1, 3)])
+        reservations.reserve([(product_2, 4)])
+
+        reservations.rebuild(lambda: {product_2.id: (6, 0, 10)})
+
+        self.assertEquals(
+            reservations.get_reserved([product_1.id, product_2.id]),
+            {product_1.id: 0, product_2.id: 6}
+        )
+        reservations.release([(product_2, 6)])
+        self.assertEquals(product_2.reserved, 0)
+
+    def test_warm_start(self):
+        """ Test the reservations are only rebuilt once they are lost """
+        product = mommy.make('Product', stock=10)
+        reservations.get_backend().clear()
+
+        self.assertTrue(
+            reservations.warm_start(lambda: {product.id: (2, 0, 10)})
+        )
+        self.assertEquals(product.reserved, 2)
+
+        self.assertFalse(
+            reservations.warm_start(lambda: {product.id: (7, 0, 10)})
+        )
+        self.assertEquals(product.reserved, 2)
+
+
+@override_settings(RESERVATION_BACKEND='products.reservations.DatabaseBackend')
+class DatabaseReservationsTests(ReservationsTests):
+    """ The very same tests, keeping the reservations in the database """
+
+    def test_sell(self):
+        """ Test the units sold can not be kept in the database """
+        product = mommy.make('Product', stock=10)
+        reservations.reserve([(product, 6)])
+
+        with self.assertRaises(NotImplementedError):
+            reservations.sell([(product, 4)])
+
+    def test_warm_start(self):
+        """ Test the reservations kept in the database are never lost """
+        product = mommy.make('Product', stock=10)
+
+        self.assertFalse(
+            reservations.warm_start(lambda: {product.id: (2, 0, 10)})
+        )
+        self.assertEquals(product.reserved, 0)
+
+    def test_reserve_stale_product(self):
+        """ Test the stock is checked as read under the lock of the product """
+        product = mommy.make('Product', stock=10)
+        stale = Product.objects.get(pk=product.pk)
+        Product.objects.filter(pk=product.pk).update(stock=0)
+
+        self.assertEquals(reservations.reserve_many([[(stale, 5)]]), [False])
+        self.assertEquals(reservations.get_reserved([product.id]),
+                          {product.id: 0})
+
+    def test_reserve_number_of_queries(self):
+        """
+        Test a batch is reserved with the same queries as a single order
+        """
+        product_1 = mommy.make('Product', stock=10)
+        product_2 = mommy.make('Product', stock=10)
+        reservations.reserve([(product_1, 1)])
+
+        # Savepoint, lock, stock (read along with the lock where rows can be
+        # locked), reservations, insert, update and release
+        with self.assertNumQueries(7):
+            self.assertEquals(reservations.reserve_many([
+                [(product_1, 3), (product_2, 2)],
+                [(product_1, 3)],
+                [(product_2, 9)],
+            ]), [True, True, False])
+
+        self.assertEquals(
+            reservations.get_reserved([product_1.id, product_2.id]),
+            {product_1.id: 7, product_2.id: 2}
+        )
+
+
+class KeptStockTests(object):
+    """ Tests of the backends keeping the stock along with the counts """
+
+    def test_reserve_stale_product_flushed(self):
+        """
+        Test the stock of a product read before a flush is not used, neither
+        while nor after the flush takes the units sold out of the stock
+        """
+        product = mommy.make('Product', stock=10)
+        # Kept once the product is committed, which tests never are
+        reservations.keep_stock([(product, 10)])
+        stale = Product.objects.get(pk=product.pk)
+        order = mommy.make('Order', complete=True, stock_pending=True)
+        mommy.make('OrderProduct', order=order, product=product, quantity=10)
+        reservations.reserve([(product, 10)])
+        reservations.sell([(product, 10)])
+
+        forget_sold = reservations.forget_sold
+
+        def flushing(lines):
+            """ Reserve once the stock is decremented, before forgetting """
+            self.assertEquals(reservations.reserve_many([[(stale, 1)]]),
+                              [False])
+            forget_sold(lines)
+
+        with patch.object(reservations, 'forget_sold', side_effect=flushing):
+            self.assertEquals(stock.flush(), 1)
+
+        self.assertEquals(Product.objects.get(pk=product.pk).stock, 0)
+        self.assertEquals(reservations.reserve_many([[(stale, 1)]]), [False])
+        self.assertEquals(reservations.get_counts([product.id]),
+                          {product.id: (0, 0)})
+
+    def test_reserve_stale_product_paid(self):
+        """
+        Test the stock of a product read before an order is paid is not used
+        by the reservations made concurrently, neither while nor after the
+        payment takes its units out of the stock
+        """
+        product = mommy.make('Product', stock=2)
+        reservations.keep_stock([(product, 2)])
+        stale = Product.objects.get(pk=product.pk)
+        order = mommy.make('Order')
+        mommy.make('OrderProduct', order=order, product=product, quantity=2)
+        reservations.reserve([(product, 2)])
+
+        paid = threading.Event()
+        reserved = []
+
+        def reserve_stale():
+            """ Keep reserving the stale product until the order is paid """
+            while True:
+                done = paid.is_set()
+                reserved.extend(
+                    fits for fits in reservations.reserve_many([[(stale, 1)]])
+                    if fits
+                )
+                if done:
+                    return
+
+        consume = reservations.consume
+
+        def paying(lines):
+            """ Reserve once the stock is decremented, before consuming """
+            self.assertEquals(reservations.reserve_many([[(stale, 1)]]),
+                              [False])
+            consume(lines)
+
+        thread = threading.Thread(target=reserve_stale)
+        thread.start()
+        try:
+            with patch.object(reservations, 'consume', side_effect=paying):
+                OrderResource().complete_order(order)
+        finally:
+            paid.set()
+            thread.join()
+
+        self.assertEquals(reserved, [])
+        self.assertEquals(Product.objects.get(pk=product.pk).stock, 0)
+        self.assertEquals(reservations.get_counts([product.id]),
+                          {product.id: (0, 0)})
+
+    def test_restock(self):
+        """ Test restocks are added to the stock kept """
+        product = mommy.make('Product', stock=0)
+        reservations.keep_stock([(product, 0)])
+        reservations.keep_stock([(product, 8)])
+
+        reservations.restock([(product, 5), (product, -1)])
+
+        self.assertEquals(reservations.reserve_many([[(product, 5)]]),
+                          [False])
+        self.assertEquals(reservations.reserve_many([[(product, 4)]]),
+                          [True])
+
+    def test_rebuild_stock(self):
+        """ Test the stock is rebuilt along with the counts """
+        product = mommy.make('Product', stock=3)
+        stale = Product.objects.get(pk=product.pk)
+        stale.stock = 10
+
+        reservations.rebuild(lambda: {product.id: (1, 0, 3)})
+
+        self.assertEquals(reservations.reserve_many([[(stale, 3)]]),
+                          [False])
+        self.assertEquals(reservations.reserve_many([[(stale, 2)]]), [True])
+
+
+class RebuildLockTests(object):
+    """ Tests of the claims of the rebuilds of the redis nodes """
+
+    def get_client(self, product):
+        """ Get the client of the redis node keeping the product """
+        backend = reservations.get_backend()
+        if hasattr(backend, 'clients'):
+            return backend.clients[backend.get_node(product.id)]
+
+        return reservations.get_redis_client()
+
+    def test_reserve_while_rebuilding(self):
+        """ Test reservations wait for the node to be rebuilt """
+        product = mommy.make('Product', stock=10)
+        backend = reservations.get_backend()
+        client = self.get_client(product)
+        token = backend.claim_rebuild_on(client)
+
+        thread = threading.Thread(target=reservations.reserve,
+                                  args=([(product, 3)], ))
+        thread.start()
+        thread.join(0.2)
+        self.assertTrue(thread.is_alive())
+
+        self.assertTrue(
+            backend.rebuild_on(client, token, {product.id: (2, 0, 10)})
+        )
+        thread.join()
+        self.assertEquals(reservations.get_counts([product.id]),
+                          {product.id: (5, 0)})
+
+    def test_release_while_rebuilding(self):
+        """
+        Test the changes made while the node is rebuilt are left to the
+        rebuild
+        """
+        product = mommy.make('Product', stock=10)
+        reservations.reserve([(product, 4)])
+        backend = reservations.get_backend()
+        client = self.get_client(product)
+        token = backend.claim_rebuild_on(client)
+
+        reservations.release([(product, 4)])
+        self.assertEquals(reservations.get_counts([product.id]),
+                          {product.id: (4, 0)})
+
+        backend.rebuild_on(client, token, {product.id: (0, 0, 10)})
+        self.assertEquals(reservations.get_counts([product.id]),
+                          {product.id: (0, 0)})
+
+    def test_rebuild_claim_lost(self):
+        """ Test nothing is replaced once another process claims the node """
+        product = mommy.make('Product', stock=10)
+        reservations.reserve([(product, 4)])
+        backend = reservations.get_backend()
+        client = self.get_client(product)
+        token = backend.claim_rebuild_on(client)
+        client.set(cache.make_key(reservations.BUILT_KEY), 'rebuilding:other')
+
+        self.assertFalse(
+            backend.rebuild_on(client, token, {product.id: (0, 0, 10)})
+        )
+        self.assertEquals(reservations.get_counts([product.id]),
+                          {product.id: (4, 0)})
+
+    def test_rebuild_waits(self):
+        """
+        Test a rebuild waits for the one in progress and computes the counts
+        once claimed
+        """
+        product = mommy.make('Product', stock=10)
+        backend = reservations.get_backend()
+        client = self.get_client(product)
+        token = backend.claim_rebuild_on(client)
+        built_key = cache.make_key(reservations.BUILT_KEY)
+        claims = []
+
+        def compute():
+            """ Counts of the products, noting the claim of the node """
+            claims.append(client.get(built_key).decode())
+            return {product.id: (3, 0, 10)}
+
+        thread = threading.Thread(target=reservations.rebuild,
+                                  args=(compute, ))
+        thread.start()
+        thread.join(0.2)
+        self.assertEquals(claims, [])
+
+        backend.rebuild_on(client, token, {product.id: (1, 0, 10)})
+        thread.join()
+        self.assertEquals(len(claims), 1)
+        self.assertTrue(claims[0].startswith(reservations.REBUILDING))
+        self.assertNotEqual(claims[0], token)
+        self.assertEquals(reservations.get_counts([product.id]),
+                          {product.id: (3, 0)})
+
+
+@skipUnless(is_redis_available(settings.REDIS_URL),
+            'No redis server at REDIS_URL')
+@override_settings(RESERVATION_BACKEND='products.reservations.RedisBackend',
+                   CACHES=REDIS_CACHES)
+class RedisReservationsTests(KeptStockTests, RebuildLockTests,
+                             ReservationsTests):
+    """ The very same tests, keeping the reservations in a redis server """
+
+    def tearDown(self):
+        """ Forget the reservations, leaving the rest of the server alone """
+        reservations.get_backend().clear()
+
+    def test_reserve_number_of_calls(self):
+        """ Test a batch is checked and reserved by a single script call """
+        product_1 = mommy.make('Product', stock=10)
+        product_2 = mommy.make('Product', stock=10)
+        client = reservations.get_redis_client()
+
+        with patch.object(client, 'evalsha',
+                          wraps=client.evalsha) as evalsha:
+            self.assertEquals(reservations.reserve_many([
+                [(product_1, 3), (product_2, 2)],
+                [(product_1, 8)],
+            ]), [True, False])
+
+        self.assertEquals(evalsha.call_count, 1)
+
+
+@skipUnless(len(RING_NODES) > 1, 'RESERVATION_REDIS_TEST_NODES not set')
+@override_settings(
+    RESERVATION_BACKEND='products.reservations.RedisRingBackend',
+    RESERVATION_REDIS_NODES=RING_NODES
+)
+class RedisRingReservationsTests(KeptStockTests, RebuildLockTests,
+                                 ReservationsTests):
+    """ The very same tests, spreading the reservations over redis nodes """
+
+    def make_products_by_node(self, stock=10):
+        """ Create a product kept in each one of the nodes, by node """
+        backend = reservations.get_backend()
+        products = {}
+
+        while len(products) < len(RING_NODES):
+            product = mommy.make('Product', stock=stock)
+            products.setdefault(backend.get_node(product.id), product)
+
+        return [products[node] for node in sorted(products)]
+
+    def test_reserve_across_nodes(self):
+        """ Test an order spanning nodes is reserved all or nothing """
+        first, last = self.make_products_by_node()[::len(RING_NODES) - 1]
+
+        self.assertEquals(reservations.reserve_many([
+            [(first, 3), (last, 11)],
+            [(first, 8), (last, 2)],
+        ]), [False, True])
+
+        self.assertEquals(
+            reservations.get_reserved([first.id, last.id]),
+            {first.id: 8, last.id: 2}
+        )
+
+    def test_node_down(self):
+        """ Test nothing is left reserved when one of the nodes fails """
+        down = 'redis://127.0.0.1:9/0'
+        with override_settings(RESERVATION_REDIS_NODES=RING_NODES + [down]):
+            backend = reservations.get_backend()
+            product_down = product_up = None
+            while product_down is None or product_up is None:
+                product = mommy.make('Product', stock=10)
+                if backend.get_node(product.id) == down:
+                    product_down = product
+                else:
+                    product_up = product
+
+            with self.assertRaises(Exception):
+                reservations.reserve([(product_up, 1), (product_down, 1)])
+
+            self.assertEquals(reservations.get_reserved([product_up.id]),
+                              {product_up.id: 0})
@@ -0,0 +1,151 @@
+import json
+from django.core.cache import cache
+from django.test import TestCase
+from django.test.client import Client
+from django.utils import timezone
+from model_mommy import mommy
+
+from products import reservations, rollups
+from products.models import DailySales, HourlySales, Product
+
+
+class RollupTests(TestCase):
+
+    def setUp(self):
+        self.c = Client()
+        self.principal = mommy.make('Product', price=10, unitary=True,
+                                    stock=100,
+                                    category=Product.CATEGORY_PRINCIPAL)
+        self.dessert = mommy.make('Product', price=5, unitary=True,
+                                  stock=100,
+                                  category=Product.CATEGORY_DESSERT)
+
+    def tearDown(self):
+        """ Make sure cache and reservations are empty before every test """
+        reservations.get_backend().clear()
+        cache.clear()
+
+    def sell(self, *lines):
+        """ Post an order of the (product, quantity) lines and complete it """
+        response = self.c.post('/api/v1/order/', json.dumps({
+            'products': [{'product': product.id, 'quantity': quantity}
+                         for product, quantity in lines],
+        }), content_type='application/json')
+        self.assertEquals(response.status_code, 201)
+
+        order_id = json.loads(response.content.decode('utf-8'))['id']
+        response = self.c.patch('/api/v1/order/{}/'.format(order_id),
+                                json.dumps({'complete': True}),
+                                content_type='application/json')
+        self.assertEquals(response.status_code, 202)
+
+    def get_sales(self, model, product):
+        """ Get the (quantity, revenue) of the rollups of the product """
+        return list(model.objects.filter(product=product)
+                    .values_list('quantity', 'revenue'))
+
+    def test_roll_up(self):
+        """
+        Test the sales are added to the rollups of their hour and day, the
+        total of each order split among its lines
+        """
+        # 3x2 on the principal, 20 + 5
+        self.sell((self.principal, 3), (self.dessert, 1))
+        self.sell((self.dessert, 2))
+        # Pending orders are not sales
+        self.c.post('/api/v1/order/', json.dumps({
+            'products': [{'product': self.principal.id, 'quantity': 1}],
+        }), content_type='application/json')
+
+        self.assertEquals(rollups.roll_up(lag=0), 3)
+
+        self.assertEquals(self.get_sales(HourlySales, self.principal),
+                          [(3, 20)])
+        self.assertEquals(self.get_sales(HourlySales, self.dessert),
+                          [(3, 15)])
+        self.assertEquals(self.get_sales(DailySales, self.dessert),
+                          [(3, 15)])
+
+        now = timezone.localtime(timezone.now())
+        sales = HourlySales.objects.get(product=self.dessert)
+        self.assertEquals(sales.period,
+                          now.replace(minute=0, second=0, microsecond=0))
+        self.assertEquals(sales.category, Product.CATEGORY_DESSERT)
+        self.assertEquals(DailySales.objects.get(product=self.dessert).period,
+                          now.date())
+
+    def test_roll_up_again(self):
+        """
+        Test the sales already rolled up are not again and the later ones are
+        added to the same rollups
+        """
+        self.sell((self.dessert, 1))
+        rollups.roll_up(lag=0)
+        self.assertEquals(rollups.roll_up(lag=0), 0)
+
+        self.sell((self.dessert, 2))
+        self.assertEquals(rollups.roll_up(lag=0), 1)
+
+        self.assertEquals(self.get_sales(HourlySales, self.dessert),
+                          [(3, 15)])
+        self.assertEquals(self.get_sales(DailySales, self.dessert),
+                          [(3, 15)])
+
+    def test_roll_up_batches(self):
+        """ Test a roll up takes up to limit sales """
+        self.sell((self.dessert, 1))
+        self.sell((self.dessert, 1))
+        self.sell((self.dessert, 1))
+
+        self.assertEquals(rollups.roll_up(lag=0, limit=2), 2)
+        self.assertEquals(self.get_sales(HourlySales, self.dessert),
+                          [(2, 10)])
+        self.assertEquals(rollups.roll_up(lag=0, limit=2), 1)
+        self.assertEquals(self.get_sales(HourlySales, self.dessert),
+                          [(3, 15)])
+
+    def test_roll_up_lag(self):
+        """ Test the recent sales are left to a later roll up """
+        self.sell((self.dessert, 1))
+
+        self.assertEquals(rollups.roll_up(lag=60), 0)
+        self.assertFalse(HourlySales.objects.exists())
+
+    def test_revenue_as_charged(self):
+        """
+        Test the revenue is the one charged even if the prices changed since
+        the order was placed
+        """
+        self.sell((self.dessert, 2))
+        Product.objects.filter(pk=self.dessert.pk).update(price=7)
+
+        rollups.roll_up(lag=0)
+
+        self.assertEquals(self.get_sales(DailySales, self.dessert),
+                          [(2, 10)])
+
+    def test_api(self):
+        """ Test the rollups are served read only and filtered """
+        self.sell((self.principal, 1), (self.dessert, 1))
+        rollups.roll_up(lag=0)
+
+        response = self.c.get('/api/v1/hourly_sales/', {
+            'category': Product.CATEGORY_DESSERT,
+        })
+        self.assertEquals(response.status_code, 200)
+        sales, = json.loads(response.content.decode('utf-8'))['objects']
+        self.assertEquals(sales['product'], self.dessert.id)
+        self.assertEquals((sales['quantity'], sales['revenue']), (1, 5))
+
+        response = self.c.get('/api/v1/daily_sales/', {
+            'period__gte': timezone.localtime(timezone.now()).date(),
+            'product__in': '{},{}'.format(self.principal.id,
+                                          self.dessert.id),
+        })
+        self.assertEquals(
+            len(json.loads(response.content.decode('utf-8'))['objects']), 2
+        )
+
+        response = self.c.post('/api/v1/daily_sales/', json.dumps({}),
+                               content_type='application/json')
+        self.assertEquals(response.status_code, 405)
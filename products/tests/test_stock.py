@@ -0,0 +1,216 @@
+import json
+import time
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase, override_settings
+from django.test.client import Client
+from model_mommy import mommy
+
+from products import expiry, reservations, stock
+from products.models import Order, Product
+
+
+@override_settings(STOCK_WRITE_BEHIND=True)
+class StockTests(TestCase):
+
+    def setUp(self):
+        self.c = Client()
+
+    def tearDown(self):
+        """ Make sure cache and reservations are empty before every test """
+        reservations.get_backend().clear()
+        cache.clear()
+
+    def make_order(self, product, quantity):
+        """ Make a pending order of the product, reserving its stock """
+        order = mommy.make('Order', complete=False)
+        mommy.make('OrderProduct', order=order, product=product,
+                   quantity=quantity)
+        product.reserve_stock(quantity)
+
+        return order
+
+    def complete(self, order):
+        """ Complete the order through the API, returns the response """
+        return self.c.patch(
+            '/api/v1/order/{}/'.format(order.id),
+            json.dumps({'complete': True}),
+            content_type='application/json'
+        )
+
+    def test_complete(self):
+        """
+        Test completing an order leaves the stock to the flush, its units
+        still taken as sold
+        """
+        product = mommy.make('Product', stock=10)
+        order = self.make_order(product, 4)
+
+        self.assertEquals(self.complete(order).status_code, 202)
+
+        order = Order.objects.get(pk=order.pk)
+        self.assertTrue(order.complete)
+        self.assertTrue(order.stock_pending)
+        self.assertEquals(Product.objects.get(pk=product.pk).stock, 10)
+        self.assertEquals(reservations.get_counts([product.id]),
+                          {product.id: (0, 4)})
+        self.assertEquals(product.real_stock, 6)
+
+    def test_sold_not_available(self):
+        """ Test the units sold and not flushed can not be reserved """
+        product = mommy.make('Product', stock=10)
+        self.complete(self.make_order(product, 8))
+
+        with self.assertRaises(ValueError):
+            reservations.reserve([(product, 3)])
+
+    def test_flush(self):
+        """ Test the flush decrements the stock of every order at once """
+        product_1 = mommy.make('Product', stock=10)
+        product_2 = mommy.make('Product', stock=10)
+        self.complete(self.make_order(product_1, 4))
+        self.complete(self.make_order(product_1, 2))
+        self.complete(self.make_order(product_2, 3))
+
+        with self.assertNumQueries(6):
+            self.assertEquals(stock.flush(), 3)
+
+        self.assertEquals(Product.objects.get(pk=product_1.pk).stock, 4)
+        self.assertEquals(Product.objects.get(pk=product_2.pk).stock, 7)
+        self.assertFalse(Order.objects.filter(stock_pending=True).exists())
+        self.assertEquals(
+            reservations.get_counts([product_1.id, product_2.id]),
+            {product_1.id: (0, 0), product_2.id: (0, 0)}
+        )
+        self.assertEquals(stock.check(), [])
+
+    def test_flush_batches(self):
+        """ Test the flush takes up to limit orders at once """
+        product = mommy.make('Product', stock=10)
+        for _ in range(3):
+            self.complete(self.make_order(product, 1))
+
+        self.assertEquals(stock.flush(limit=2), 2)
+        self.assertEquals(Product.objects.get(pk=product.pk).stock, 8)
+        self.assertEquals(stock.flush(limit=2), 1)
+        self.assertEquals(Product.objects.get(pk=product.pk).stock, 7)
+
+    def test_flush_replay(self):
+        """ Test flushing again does not decrement any order twice """
+        product = mommy.make('Product', stock=10)
+        self.complete(self.make_order(product, 4))
+
+        self.assertEquals(stock.flush_all(), 1)
+        self.assertEquals(stock.flush_all(), 0)
+
+        self.assertEquals(Product.objects.get(pk=product.pk).real_stock, 6)
+
+    def test_check(self):
+        """ Test check reports the amounts not matching the orders """
+        product = mommy.make('Product', stock=10)
+        self.make_order(product, 2)
+        self.complete(self.make_order(product, 3))
+        self.assertEquals(stock.check(), [])
+
+        # As left by a flush dying before forgetting the units sold
+        Order.objects.update(stock_pending=False)
+
+        problem, = stock.check()
+        self.assertIn('sold (3)', problem)
+
+    def test_get_expected(self):
+        """ Test the amounts expected out of the orders take one query """
+        product_1 = mommy.make('Product', stock=10)
+        product_2 = mommy.make('Product', stock=10)
+        self.make_order(product_1, 2)
+        self.make_order(product_2, 1)
+        self.complete(self.make_order(product_1, 3))
+        self.complete(self.make_order(product_2, 4))
+        stock.flush()
+        self.complete(self.make_order(product_1, 1))
+
+        with self.assertNumQueries(1):
+            self.assertEquals(stock.get_expected(), {
+                product_1.id: (2, 1), product_2.id: (1, 0),
+            })
+
+    def test_rebuild(self):
+        """ Test the lost amounts reserved and sold are rebuilt """
+        product = mommy.make('Product', stock=10)
+        pending = self.make_order(product, 2)
+        self.complete(self.make_order(product, 3))
+        reservations.get_backend().clear()
+        self.assertEquals(len(stock.check()), 2)
+
+        self.assertEquals(stock.rebuild(), 1)
+
+        self.assertEquals(stock.check(), [])
+        self.assertEquals(Product.objects.get(pk=product.pk).real_stock, 5)
+        self.assertEquals(expiry.get_expired(now=time.time() + 60),
+                          [pending.id])
+
+    @override_settings(RESERVATION_WARM_START=True)
+    def test_warm_start(self):
+        """ Test the amounts are rebuilt on start only once lost """
+        product = mommy.make('Product', stock=10)
+        self.make_order(product, 2)
+        reservations.get_backend().clear()
+
+        self.assertTrue(stock.warm_start())
+        self.assertEquals(reservations.get_counts([product.id]),
+                          {product.id: (2, 0)})
+
+        self.make_order(product, 1)
+        self.assertFalse(stock.warm_start())
+        self.assertEquals(reservations.get_counts([product.id]),
+                          {product.id: (3, 0)})
+
+    @override_settings(RESERVATION_WARM_START=True)
+    def test_warm_start_expires_orders(self):
+        """
+        Test the pending orders still expire once the reservations and their
+        deadlines have been lost and rebuilt
+        """
+        product = mommy.make('Product', stock=10)
+        response = self.c.post('/api/v1/order/', json.dumps({
+            'products': [{'product': product.id, 'quantity': 5}],
+        }), content_type='application/json')
+        self.assertEquals(response.status_code, 201)
+        reservations.get_backend().clear()
+        cache.clear()
+
+        self.assertTrue(stock.warm_start())
+        self.assertEquals(product.reserved, 5)
+
+        self.assertEquals(
+            expiry.release_expired_orders(now=time.time() + 10 ** 6), 1
+        )
+        self.assertFalse(Order.objects.exists())
+        self.assertEquals(product.reserved, 0)
+
+    @override_settings(RESERVATION_WARM_START=False)
+    def test_warm_start_disabled(self):
+        """ Test nothing is rebuilt with RESERVATION_WARM_START off """
+        reservations.get_backend().clear()
+
+        self.assertFalse(stock.warm_start())
+
+    @override_settings(
+        RESERVATION_BACKEND='products.reservations.DatabaseBackend'
+    )
+    def test_backend_without_sold(self):
+        """ Test a backend not keeping the units sold is refused """
+        with self.assertRaises(ImproperlyConfigured):
+            reservations.get_backend()
+
+    @override_settings(STOCK_WRITE_BEHIND=False)
+    def test_disabled(self):
+        """ Test the stock is decremented right away by default """
+        product = mommy.make('Product', stock=10)
+        order = self.make_order(product, 4)
+
+        self.complete(order)
+
+        self.assertEquals(Product.objects.get(pk=product.pk).stock, 6)
+        self.assertFalse(Order.objects.get(pk=order.pk).stock_pending)
+        self.assertEquals(stock.flush(), 0)
@@ -0,0 +1,214 @@
+import json
+import os
+import tempfile
+import time
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.test.client import Client
+from model_mommy import mommy
+from redis.client import Redis
+from redis.exceptions import ConnectionError
+
+from products import expiry, reservations, tracing
+from products.tasks import check_order
+from products.tests.utils import without_debug_toolbar
+
+
+TRACEPARENT = '00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01'
+
+
+@without_debug_toolbar
+@override_settings(TRACING_ENABLED=True, TRACING_SAMPLE_RATE=1)
+class TracingTests(TestCase):
+
+    def setUp(self):
+        descriptor, self.path = tempfile.mkstemp(suffix='.jsonl')
+        os.close(descriptor)
+        self.settings = override_settings(TRACING_FILE=self.path)
+        self.settings.enable()
+        self.c = Client()
+
+    def tearDown(self):
+        """ Make sure cache and reservations are empty before every test """
+        self.settings.disable()
+        os.remove(self.path)
+        reservations.get_backend().clear()
+        cache.clear()
+
+    def post_order(self, **extra):
+        """ Post an order of a product, returns the response """
+        product = mommy.make('Product', stock=10)
+
+        return self.c.post('/api/v1/order/', json.dumps({
+            'products': [{'product': product.id, 'quantity': 2}],
+        }), content_type='application/json', **extra)
+
+    def get_spans(self, name=None):
+        """ Get the spans recorded, only the ones of the given name if any """
+        return [
+            span for span in tracing.read(self.path)
+            if name is None or span['name'] == name
+        ]
+
+    def get_attribute(self, span, key):
+        """ Get the value of an attribute of a span """
+        for attribute in span['attributes']:
+            if attribute['key'] == key:
+                return list(attribute['value'].values())[0]
+
+    def test_request_trace(self):
+        """ Test a request is recorded with its queries and cache calls """
+        response = self.post_order()
+        self.assertEquals(response.status_code, 201)
+
+        root, = self.get_spans('POST /api/v1/order/')
+        self.assertNotIn('parentSpanId', root)
+        self.assertEquals(root['kind'],
+                          tracing.SPAN_KINDS['SPAN_KIND_SERVER'])
+        self.assertEquals(self.get_attribute(root, 'http.status_code'), '201')
+        self.assertIn(root['traceId'], response['traceresponse'])
+
+        spans = self.get_spans()
+        self.assertEquals({span['traceId'] for span in spans},
+                          {root['traceId']})
+
+        save, = self.get_spans('order.save')
+        self.assertEquals(save['parentSpanId'], root['spanId'])
+
+        queries = [span for span in spans if span['name'] == 'db execute']
+        self.assertTrue(queries)
+        self.assertTrue(all(
+            self.get_attribute(span, 'db.statement') for span in queries
+        ))
+        self.assertIn(save['spanId'],
+                      [span.get('parentSpanId') for span in queries])
+
+        # The reservations go through the cache or the raw redis client,
+        # depending on the backend
+        self.assertTrue([
+            span for span in spans
+            if span['name'].startswith(('cache ', 'redis '))
+        ])
+
+    def test_export(self):
+        """ Test the spans of a trace are written as an OTLP export request """
+        with tracing.start_trace('test'):
+            with tracing.span('child'):
+                pass
+
+        with open(self.path) as stream:
+            line, = stream.readlines()
+        resource_spans, = json.loads(line)['resourceSpans']
+        self.assertEquals(resource_spans['resource']['attributes'], [{
+            'key': 'service.name', 'value': {'stringValue': 'mums'},
+        }])
+        scope_spans, = resource_spans['scopeSpans']
+        self.assertEquals(scope_spans['scope'], {'name': 'products.tracing'})
+        self.assertEquals(
+            sorted(span['name'] for span in scope_spans['spans']),
+            ['child', 'test']
+        )
+        self.assertNotIn('resource', scope_spans['spans'][0])
+
+    def test_continue_trace(self):
+        """ Test the trace of the traceparent header is continued """
+        self.post_order(HTTP_TRACEPARENT=TRACEPARENT)
+
+        root, = self.get_spans('POST /api/v1/order/')
+        self.assertEquals(root['traceId'], '0af7651916cd43dd8448eb211c80319c')
+        self.assertEquals(root['parentSpanId'], 'b7ad6b7169203331')
+
+    @override_settings(TRACING_SAMPLE_RATE=0)
+    def test_continue_untrusted_trace(self):
+        """
+        Test the traceparent header of a client can not have a request
+        recorded beyond the sample rate, unless clients are trusted
+        """
+        self.post_order(HTTP_TRACEPARENT=TRACEPARENT)
+        self.assertEquals(self.get_spans(), [])
+
+        with override_settings(TRACING_TRUST_TRACEPARENT=True):
+            self.post_order(HTTP_TRACEPARENT=TRACEPARENT)
+        root, = self.get_spans('POST /api/v1/order/')
+        self.assertEquals(root['traceId'], '0af7651916cd43dd8448eb211c80319c')
+
+    def test_continue_not_sampled_trace(self):
+        """ Test nothing is recorded if the traceparent is not sampled """
+        self.post_order(HTTP_TRACEPARENT=TRACEPARENT[:-2] + '00')
+
+        self.assertEquals(self.get_spans(), [])
+
+    @override_settings(TRACING_SAMPLE_RATE=0)
+    def test_sampling(self):
+        """ Test nothing is recorded for the traces not sampled """
+        self.post_order()
+
+        self.assertEquals(self.get_spans(), [])
+
+    def test_task_headers(self):
+        """ Test the trace in progress is sent along with the tasks """
+        headers = {}
+        with tracing.start_trace('test') as root:
+            tracing.inject_traceparent(headers=headers)
+
+        self.assertEquals(headers, {'traceparent': root.traceparent})
+
+    @override_settings(TRACING_SAMPLE_RATE=0)
+    def test_task_trace(self):
+        """
+        Test a task continues the trace of its traceparent header, the
+        decision of the process publishing it is followed
+        """
+        tracing.install()
+        order = mommy.make('Order')
+
+        check_order.apply_async(args=(order.id, ),
+                                headers={'traceparent': TRACEPARENT})
+
+        task, = self.get_spans('task products.tasks.check_order')
+        self.assertEquals(task['traceId'], '0af7651916cd43dd8448eb211c80319c')
+        self.assertEquals(task['parentSpanId'], 'b7ad6b7169203331')
+        self.assertEquals(task['kind'],
+                          tracing.SPAN_KINDS['SPAN_KIND_CONSUMER'])
+
+        self.assertIn(task['spanId'], [
+            span.get('parentSpanId') for span in self.get_spans('db execute')
+        ])
+
+    def test_release_trace(self):
+        """ Test the release of an expired order is recorded in its trace """
+        order = mommy.make('Order')
+        with tracing.start_trace('test') as root:
+            expiry.schedule([order.id], traceparent=root.traceparent)
+
+        expiry.release_expired_orders(time.time() + 60)
+
+        released, = self.get_spans('order.release')
+        self.assertEquals(released['traceId'], root.trace_id)
+        self.assertEquals(released['parentSpanId'], root.span_id)
+        self.assertEquals(self.get_attribute(released, 'order.id'),
+                          str(order.id))
+
+    def test_redis_trace(self):
+        """
+        Test the commands of the raw redis client are recorded, whatever the
+        version of redis-py
+        """
+        tracing.install()
+        with tracing.start_trace('test') as root:
+            # Nothing listens on the port, the failed command is still
+            # recorded
+            with self.assertRaises(ConnectionError):
+                Redis(port=1).get('foo')
+
+        command, = self.get_spans('redis execute_command')
+        self.assertEquals(command['parentSpanId'], root.span_id)
+        self.assertEquals(self.get_attribute(command, 'db.operation'), 'GET')
+
+    @override_settings(TRACING_ENABLED=False)
+    def test_disabled(self):
+        """ Test nothing is recorded when tracing is disabled """
+        self.c = Client()
+        self.post_order()
+
+        self.assertEquals(self.get_spans(), [])
@@ -0,0 +1,71 @@
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase
+from django.test.client import RequestFactory
+from model_mommy import mommy
+
+from products import reservations
+from products.utils import HashRing, profile
+
+
+class ProfileTests(TestCase):
+
+    def tearDown(self):
+        """ Make sure cache and reservations are empty before every test """
+        reservations.get_backend().clear()
+        cache.clear()
+
+    def test_profile(self):
+        """ Test profiling a view replies its calls and queries as HTML """
+        order = mommy.make('Order')
+        mommy.make('OrderProduct', order=order, _quantity=2)
+
+        response = profile(RequestFactory().get(
+            '/profile/api/v1/order/{}/'.format(order.id)
+        ))
+        content = response.content.decode()
+
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue(content.startswith('<html><body>'))
+        self.assertIn('/api/v1/order/{}/ (200)'.format(order.id), content)
+        # The order and its lines
+        self.assertIn('SQL: 2 queries', content)
+        self.assertIn('resources_v1.py', content)
+        self.assertIn('Calls by cumulative', content)
+
+    def test_profile_sort(self):
+        """ Test the calls can be sorted by other keys, but only by those """
+        request = RequestFactory().get('/profile/api/v1/product/',
+                                       {'profile_sort': 'tottime'})
+        self.assertIn('Calls by tottime', profile(request).content.decode())
+
+        request = RequestFactory().get('/profile/api/v1/product/',
+                                       {'profile_sort': 'foo'})
+        self.assertIn('Calls by cumulative',
+                      profile(request).content.decode())
+
+
+class HashRingTests(SimpleTestCase):
+
+    def test_spread(self):
+        """ Test the keys are spread over every node """
+        ring = HashRing(['a', 'b', 'c'])
+
+        counts = {'a': 0, 'b': 0, 'c': 0}
+        for key in range(3000):
+            counts[ring.get_node(key)] += 1
+
+        for count in counts.values():
+            self.assertGreater(count, 600)
+
+    def test_add_node(self):
+        """ Test adding a node only moves keys to the new node """
+        ring = HashRing(['a', 'b', 'c'])
+        bigger_ring = HashRing(['a', 'b', 'c', 'd'])
+
+        moved = [
+            key for key in range(1000)
+            if ring.get_node(key) != bigger_ring.get_node(key)
+        ]
+
+        self.assertTrue(moved)
+        self.assertEquals({bigger_ring.get_node(key) for key in moved}, {'d'})
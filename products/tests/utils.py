@@ -0,0 +1,38 @@
+from contextlib import contextmanager
+from django.conf import settings
+from django.test import override_settings
+
+from products import metrics
+
+
+# The debug toolbar can not render its own urls when DEBUG is off
+without_debug_toolbar = override_settings(MIDDLEWARE=[
+    middleware for middleware in settings.MIDDLEWARE
+    if not middleware.startswith('debug_toolbar.')
+])
+
+
+class BudgetTestCaseMixin(object):
+    """
+    Assertions on the number of SQL queries and cache calls (redis
+    operations) made by a block of code
+    """
+
+    @contextmanager
+    def assertBudget(self, queries, cache_calls):
+        """
+        Assert the block makes at most the given number of SQL queries and
+        cache calls
+        """
+        with metrics.collecting() as calls:
+            yield calls
+
+        self.assertLessEqual(
+            calls.counts['db'], queries,
+            '{} queries made, {} allowed'.format(calls.counts['db'], queries)
+        )
+        self.assertLessEqual(
+            calls.counts['cache'], cache_calls,
+            '{} cache calls made, {} allowed'.format(calls.counts['cache'],
+                                                     cache_calls)
+        )
@@ -0,0 +1,458 @@
+"""
+Tracing of the order workflow across the web requests, redis and celery.
+
+Every request handled by the TracingMiddleware starts a trace (or continues
+the one of the W3C traceparent header of the request) and each database
+query, cache call and celery task run within it is recorded as a span of that
+trace. The trace travels along with the tasks published in the traceparent
+header of the message, so the spans of the worker continue it.
+
+Orders are expired by a periodic sweep instead of a task per order, so the
+traceparent of the request creating an order is kept with its expiry (see
+expiry.schedule) and its release by the sweep is recorded in that very trace.
+
+Only a share of the traces (TRACING_SAMPLE_RATE) is recorded. The decision is
+made once for the whole trace and travels with it, so traces are either
+recorded whole or not at all. The decision of the traceparent header of a
+request is only followed within the TRACING_SAMPLE_RATE, unless
+TRACING_TRUST_TRACEPARENT is set, so clients can not have every request
+recorded. The spans of a trace are appended to the TRACING_FILE once its root
+span ends, as a line of OTLP JSON: an export request with the resource and
+its spans. Nothing is wrapped nor recorded unless TRACING_ENABLED is set.
+"""
+import binascii
+import functools
+import json
+import os
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+from celery.signals import before_task_publish, task_postrun, task_prerun
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import MiddlewareNotUsed
+from django.db.backends.utils import CursorWrapper
+
+from .metrics import CACHE_METHODS, get_redis_classes
+
+
+SERVICE_NAME = 'mums'
+
+# Values of the span kinds and status codes in OTLP
+SPAN_KINDS = {
+    'SPAN_KIND_INTERNAL': 1,
+    'SPAN_KIND_SERVER': 2,
+    'SPAN_KIND_CLIENT': 3,
+    'SPAN_KIND_PRODUCER': 4,
+    'SPAN_KIND_CONSUMER': 5,
+}
+STATUS_CODE_UNSET = 0
+STATUS_CODE_ERROR = 2
+
+TRACEPARENT_RE = re.compile(
+    r'^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$'
+)
+
+# Longest database statement kept as attribute of its span
+STATEMENT_LENGTH = 1000
+
+_local = threading.local()
+_lock = threading.Lock()
+_installed = False
+
+
+class Span(object):
+    """ A timed operation of a trace """
+
+    def __init__(self, name, trace_id, parent_id=None, sampled=True,
+                 kind='SPAN_KIND_INTERNAL', attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = new_id(8)
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.kind = kind
+        self.attributes = attributes or {}
+        self.error = None
+        self.start = time.time()
+        self.end = None
+
+    @property
+    def traceparent(self):
+        return format_traceparent(self.trace_id, self.span_id, self.sampled)
+
+    def to_otlp(self):
+        """ Get the span in the JSON format of OTLP """
+        data = {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'kind': SPAN_KINDS[self.kind],
+            'startTimeUnixNano': str(int(self.start * 1e9)),
+            'endTimeUnixNano': str(int(self.end * 1e9)),
+            'attributes': to_otlp_attributes(self.attributes),
+            'status': {'code': STATUS_CODE_UNSET},
+        }
+        if self.parent_id:
+            data['parentSpanId'] = self.parent_id
+        if self.error is not None:
+            data['status'] = {'code': STATUS_CODE_ERROR,
+                              'message': self.error}
+
+        return data
+
+
+def new_id(size):
+    """ Get a random id of size bytes, in hex """
+    return binascii.hexlify(os.urandom(size)).decode('ascii')
+
+
+def format_traceparent(trace_id, span_id, sampled):
+    """ Get the W3C traceparent header of a span """
+    return '00-{}-{}-{}'.format(trace_id, span_id, '01' if sampled else '00')
+
+
+def parse_traceparent(traceparent):
+    """
+    Get the trace id, parent span id and sampling decision out of a W3C
+    traceparent header, none if it is not a valid one
+    """
+    match = TRACEPARENT_RE.match((traceparent or '').strip().lower())
+    if match is None:
+        return None
+
+    trace_id, span_id, flags = match.groups()
+    return trace_id, span_id, bool(int(flags, 16) & 1)
+
+
+def is_sampled(traceparent):
+    """ Get whether the trace of the traceparent header is being recorded """
+    parent = parse_traceparent(traceparent)
+    return parent is not None and parent[2]
+
+
+def to_otlp_value(value):
+    """ Get an attribute value in the JSON format of OTLP """
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+def to_otlp_attributes(attributes):
+    """ Get attributes in the JSON format of OTLP, a list of key/values """
+    return [
+        {'key': key, 'value': to_otlp_value(value)}
+        for key, value in sorted(attributes.items())
+    ]
+
+
+def to_otlp_request(spans):
+    """
+    Get the spans in the JSON format of an OTLP export request, along with
+    the resource (this service) and the scope (this module) recording them
+    """
+    return {'resourceSpans': [{
+        'resource': {
+            'attributes': to_otlp_attributes({'service.name': SERVICE_NAME}),
+        },
+        'scopeSpans': [{
+            'scope': {'name': __name__},
+            'spans': [recorded.to_otlp() for recorded in spans],
+        }],
+    }]}
+
+
+def is_enabled():
+    return getattr(settings, 'TRACING_ENABLED', False)
+
+
+def get_stack():
+    """ Get the spans open in the current thread, innermost last """
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+
+    return stack
+
+
+def current():
+    """ Get the innermost span open in the current thread, if any """
+    stack = getattr(_local, 'stack', None)
+    return stack[-1] if stack else None
+
+
+def get_traceparent():
+    """
+    Get the traceparent header continuing the trace in progress in the
+    current thread, if any
+    """
+    span = current()
+    return span.traceparent if span is not None else None
+
+
+@contextmanager
+def start_trace(name, traceparent=None, kind='SPAN_KIND_SERVER',
+                trusted=True, **attributes):
+    """
+    Start a trace with its root span, or continue the one of the traceparent
+    header. Whether the trace is recorded is sampled when there is no
+    traceparent to take it from. The traceparent of a party not trusted
+    (e.g. a client) is only recorded if sampled here too
+    """
+    parent = parse_traceparent(traceparent)
+    if parent is not None:
+        trace_id, parent_id, sampled = parent
+        if sampled and not trusted:
+            sampled = random.random() < settings.TRACING_SAMPLE_RATE
+    else:
+        trace_id, parent_id = new_id(16), None
+        sampled = random.random() < settings.TRACING_SAMPLE_RATE
+
+    root = Span(name, trace_id, parent_id, sampled, kind, attributes)
+
+    stack = get_stack()
+    outer = _local.__dict__.get('spans')
+    _local.spans = []
+    stack.append(root)
+    try:
+        yield root
+    except Exception as e:
+        root.error = repr(e)
+        raise
+    finally:
+        stack.pop()
+        root.end = time.time()
+        spans, _local.spans = _local.spans, outer
+
+        if sampled:
+            spans.append(root)
+            export(spans)
+
+
+@contextmanager
+def span(name, kind='SPAN_KIND_INTERNAL', **attributes):
+    """
+    Record the block as a span of the trace in progress, does nothing (and
+    yields none) if there is none or it is not being recorded
+    """
+    parent = current()
+    if parent is None or not parent.sampled:
+        yield None
+        return
+
+    child = Span(name, parent.trace_id, parent.span_id, True, kind,
+                 attributes)
+
+    stack = get_stack()
+    stack.append(child)
+    try:
+        yield child
+    except Exception as e:
+        child.error = repr(e)
+        raise
+    finally:
+        stack.pop()
+        child.end = time.time()
+        _local.spans.append(child)
+
+
+def record(name, traceparent, start, end, **attributes):
+    """
+    Record an operation already done as a span of the trace of the given
+    traceparent header, if that trace is being recorded
+    """
+    if not is_sampled(traceparent):
+        return
+
+    trace_id, parent_id, _ = parse_traceparent(traceparent)
+    recorded = Span(name, trace_id, parent_id, attributes=attributes)
+    recorded.start = start
+    recorded.end = end
+    export([recorded])
+
+
+def export(spans):
+    """
+    Append the spans to the TRACING_FILE, as a line of OTLP JSON, see
+    to_otlp_request
+    """
+    if not spans:
+        return
+
+    line = json.dumps(to_otlp_request(spans), sort_keys=True) + '\n'
+    with _lock:
+        with open(settings.TRACING_FILE, 'a') as stream:
+            stream.write(line)
+
+
+def read(path=None):
+    """ Read every span written to the file (TRACING_FILE by default) """
+    try:
+        with open(path or settings.TRACING_FILE) as stream:
+            requests = [json.loads(line) for line in stream if line.strip()]
+    except FileNotFoundError:
+        return []
+
+    return [
+        recorded for request in requests
+        for resource_spans in request['resourceSpans']
+        for scope_spans in resource_spans['scopeSpans']
+        for recorded in scope_spans['spans']
+    ]
+
+
+def traced(func, name, kind, describe=None):
+    """
+    Wrap the function to record its calls as spans of the trace in progress.
+    Calls made from within another call of the same kind (e.g. the redis
+    client behind the cache) are not recorded twice
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        parent = current()
+        if parent is None or not parent.sampled:
+            return func(*args, **kwargs)
+
+        busy = _local.__dict__.setdefault('busy', set())
+        if kind in busy:
+            return func(*args, **kwargs)
+
+        attributes = describe(args) if describe is not None else {}
+        busy.add(kind)
+        try:
+            with span(name, kind='SPAN_KIND_CLIENT', **attributes):
+                return func(*args, **kwargs)
+        finally:
+            busy.discard(kind)
+
+    wrapper.tracing_traced = True
+    return wrapper
+
+
+def describe_statement(args):
+    """ Get the attributes of the span of a query out of (cursor, sql) """
+    sql = args[1] if len(args) > 1 else ''
+    return {'db.system': 'sql',
+            'db.statement': str(sql)[:STATEMENT_LENGTH]}
+
+
+def describe_cache_call(args):
+    """ Get the attributes of the span of a cache call out of (cache, key) """
+    key = args[1] if len(args) > 1 else None
+    return {'cache.key': key} if isinstance(key, str) else {}
+
+
+def describe_redis_command(args):
+    """ Get the attributes of the span of a redis command """
+    command = args[1] if len(args) > 1 else ''
+    return {'db.system': 'redis', 'db.operation': str(command)}
+
+
+def trace_methods(cls, names, kind, describe=None):
+    """ Trace the given methods of the class, unless they already are """
+    for name in names:
+        method = cls.__dict__.get(name)
+        if method is not None and \
+                not getattr(method, 'tracing_traced', False):
+            setattr(cls, name, traced(
+                method, '{} {}'.format(kind, name), kind, describe
+            ))
+
+
+def install():
+    """
+    Trace the database cursor, the caches, the redis client and the celery
+    tasks, once
+    """
+    global _installed
+
+    with _lock:
+        if _installed:
+            return
+
+        trace_methods(CursorWrapper, ('execute', 'executemany', 'callproc'),
+                      'db', describe_statement)
+
+        for alias in settings.CACHES:
+            for cls in type(caches[alias]).__mro__:
+                trace_methods(cls, CACHE_METHODS, 'cache',
+                              describe_cache_call)
+
+        redis_classes = get_redis_classes()
+        if redis_classes is not None:
+            client, pipeline = redis_classes
+            trace_methods(client, ('execute_command', ), 'redis',
+                          describe_redis_command)
+            trace_methods(pipeline, ('execute', ), 'redis')
+
+        before_task_publish.connect(inject_traceparent, weak=False)
+        task_prerun.connect(start_task_span, weak=False)
+        task_postrun.connect(end_task_span, weak=False)
+
+        _installed = True
+
+
+def inject_traceparent(headers=None, **kwargs):
+    """ Send the trace in progress along with the task published """
+    traceparent = get_traceparent()
+    if traceparent is not None and headers is not None:
+        headers['traceparent'] = traceparent
+
+
+def start_task_span(task_id=None, task=None, **kwargs):
+    """
+    Record the task run as a span of the trace it was published in, that is,
+    the one in progress when it is run eagerly or the one of the traceparent
+    header of its message
+    """
+    if not is_enabled():
+        return
+
+    name = 'task {}'.format(task.name)
+    if current() is not None:
+        context = span(name, kind='SPAN_KIND_CONSUMER', task_id=task_id)
+    else:
+        headers = getattr(task.request, 'headers', None) or {}
+        context = start_trace(name, headers.get('traceparent'),
+                              kind='SPAN_KIND_CONSUMER', task_id=task_id)
+
+    context.__enter__()
+    _local.__dict__.setdefault('tasks', {})[task_id] = context
+
+
+def end_task_span(task_id=None, **kwargs):
+    """ End the span of the task run """
+    context = _local.__dict__.get('tasks', {}).pop(task_id, None)
+    if context is not None:
+        context.__exit__(None, None, None)
+
+
+class TracingMiddleware(object):
+    """ Trace every request, see the tracing module """
+
+    def __init__(self, get_response):
+        if not is_enabled():
+            raise MiddlewareNotUsed()
+
+        self.get_response = get_response
+        install()
+
+    def __call__(self, request):
+        with start_trace(
+            '{} {}'.format(request.method, request.path),
+            request.META.get('HTTP_TRACEPARENT'),
+            trusted=getattr(settings, 'TRACING_TRUST_TRACEPARENT', False),
+            **{'http.method': request.method, 'http.target': request.path}
+        ) as root:
+            response = self.get_response(request)
+            root.attributes['http.status_code'] = response.status_code
+            if root.sampled:
+                response['traceresponse'] = root.traceparent
+
+            return response
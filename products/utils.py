@@ -1,5 +1,50 @@
+import cProfile
+import hashlib
+import io
+import pstats
+from bisect import bisect
 from django.http import HttpResponse
 from django.core import urlresolvers
+from django.utils.html import escape
+
+from . import metrics
+
+
+def get_redis_client():
+    """
+    Get the raw redis client behind the default cache, or None when the cache
+    is not backed by redis (e.g. the local memory cache used by tests)
+    """
+    try:
+        from django_redis import get_redis_connection
+        return get_redis_connection()
+    except NotImplementedError:
+        return None
+
+
+class HashRing(object):
+    """
+    Consistent hashing of keys over a set of nodes. Each node is placed at
+    many points of a ring and a key belongs to the node of the first point
+    after its own hash, so the keys are spread evenly and adding or removing
+    a node only moves the keys of that node
+    """
+
+    def __init__(self, nodes, replicas=100):
+        points = sorted(
+            (self.hash('{}-{}'.format(node, replica)), node)
+            for node in nodes for replica in range(replicas)
+        )
+        self.points = [point for point, _ in points]
+        self.nodes = [node for _, node in points]
+
+    def hash(self, key):
+        return int(hashlib.md5(str(key).encode('utf-8')).hexdigest()[:16], 16)
+
+    def get_node(self, key):
+        """ Get the node a key belongs to """
+        index = bisect(self.points, self.hash(key)) % len(self.points)
+        return self.nodes[index]
 
 
 def html_decorator(func):
@@ -35,3 +80,103 @@ def debug(request):
 
     res = view.func(request, **view.kwargs)
     return HttpResponse(res._container)
+
+
+PROFILE_SORTS = ('cumulative', 'tottime', 'ncalls')
+
+
+@html_decorator
+def profile(request):
+    """
+    Profiling variant of the debug endpoint, runs the view under cProfile and
+    replies the SQL and cache calls made, the call tree and the calls sorted
+    by profile_sort (cumulative, tottime or ncalls), top profile_limit ones
+    """
+    path = request.META.get("PATH_INFO")
+    api_url = path.replace("profile/", "", 1)
+
+    view = urlresolvers.resolve(api_url)
+
+    accept = request.META.get("HTTP_ACCEPT", "")
+    accept += ",application/json"
+    request.META["HTTP_ACCEPT"] = accept
+
+    sort = request.GET.get("profile_sort", "cumulative")
+    if sort not in PROFILE_SORTS:
+        sort = "cumulative"
+    try:
+        limit = int(request.GET.get("profile_limit", 50))
+    except ValueError:
+        limit = 50
+
+    profiler = cProfile.Profile()
+    with metrics.collecting() as calls:
+        res = profiler.runcall(view.func, request, **view.kwargs)
+
+    stats = pstats.Stats(profiler)
+
+    return HttpResponse(render_profile(api_url, res, stats, calls, sort,
+                                       limit))
+
+
+def render_profile(url, response, stats, calls, sort, limit):
+    """ Render the results of profiling the view as HTML """
+    listing = io.StringIO()
+    stats.stream = listing
+    stats.sort_stats(sort).print_stats(limit)
+
+    return (
+        "<h1>{url} ({status})</h1>"
+        "<p>Total: {total:.1f} ms, "
+        "SQL: {db_count} queries in {db_time:.1f} ms, "
+        "cache: {cache_count} calls in {cache_time:.1f} ms</p>"
+        "<h2>Call tree</h2>{tree}"
+        "<h2>Calls by {sort}</h2><pre>{listing}</pre>"
+    ).format(
+        url=escape(url),
+        status=response.status_code,
+        total=stats.total_tt * 1000,
+        db_count=calls.counts['db'],
+        db_time=calls.times['db'] * 1000,
+        cache_count=calls.counts['cache'],
+        cache_time=calls.times['cache'] * 1000,
+        tree=render_call_tree(stats),
+        sort=sort,
+        listing=escape(listing.getvalue()),
+    )
+
+
+def render_call_tree(stats, min_fraction=0.01, max_depth=40):
+    """
+    Render the calls as a nested list, from the view down, with the
+    cumulative time of each function. Calls taking less than min_fraction of
+    the total time are left out
+    """
+    callees = {}
+    roots = []
+    for func, (_, _, _, _, callers) in stats.stats.items():
+        if not callers:
+            roots.append(func)
+        for caller, (_, _, _, cumulative) in callers.items():
+            callees.setdefault(caller, []).append((cumulative, func))
+
+    min_time = stats.total_tt * min_fraction
+
+    def render(func, cumulative, path):
+        children = [
+            render(callee, callee_time, path | {func})
+            for callee_time, callee in sorted(callees.get(func, []),
+                                              reverse=True)
+            if callee_time >= min_time and callee not in path and
+            len(path) < max_depth
+        ]
+        return "<li>{:.1f} ms {}{}</li>".format(
+            cumulative * 1000,
+            escape(pstats.func_std_string(func)),
+            "<ul>{}</ul>".format("".join(children)) if children else "",
+        )
+
+    return "<ul>{}</ul>".format("".join(
+        render(root, stats.stats[root][3], frozenset()) for root in roots
+        if stats.stats[root][3] >= min_time
+    ))
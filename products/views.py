@@ -1,24 +1,48 @@
+from django.http import HttpResponse, HttpResponseForbidden
 from django.shortcuts import render
 from django.shortcuts import get_object_or_404
 from django.conf import settings
+from . import metrics, reservations
 from .models import Product, Order
 
 
 def index(request):
     context = {
-        'products': Product.objects.all().order_by('id'),
+        'products': reservations.with_reserved(
+            Product.objects.all().order_by('id')
+        ),
     }
     return render(request, 'products/index.html', context)
 
 
 def new_order(request):
     order = get_object_or_404(Order, pk=request.GET.get('order'))
+    order_products = order.orderproduct_set.select_related('product')
 
     context = {
         'order': order,
-        'products': order.orderproduct_set.all(),
+        'products': order_products,
         'timeout': settings.ORDER_TIMEOUT,
-        'price': order.price(),
+        'price': order.total,
     }
 
+    # Orders created before their price was kept with them
+    if order.total is None:
+        context['price'] = Order.pricing_engine.quote([
+            (order_product.product, order_product.quantity)
+            for order_product in order_products
+        ]).total
+
     return render(request, 'products/new_order.html', context)
+
+
+def metrics_view(request):
+    """
+    Metrics of the requests handled by this process, for Prometheus. Only
+    for the internal networks and the staff, see metrics.can_read
+    """
+    if not metrics.can_read(request):
+        return HttpResponseForbidden()
+
+    return HttpResponse(metrics.render(),
+                        content_type='text/plain; version=0.0.4')